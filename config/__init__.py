@@ -1 +0,0 @@
-print("config directory has been initialized as a package")
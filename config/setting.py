@@ -1,12 +1,139 @@
-from module import const
+import argparse
+import json
 import os
+from typing import Dict, Optional
 
-# 定数の設定
-const.APP_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+APP_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 
-# const.TRAIN_DIR = '/img'       # S45Cのみの使用
-# const.TRAIN_DIR = '/img_rough'  # S10C, S15C. S45Cのあるrough maskを使用
-const.TRAIN_DIR = "/img_fine"  # S10C, S15C. S45Cのあるfine maskを使用
+# TRAIN_DIR = '/img'       # S45Cのみの使用
+# TRAIN_DIR = '/img_rough'  # S10C, S15C. S45Cのあるrough maskを使用
+TRAIN_DIR = "/img_fine"  # S10C, S15C. S45Cのあるfine maskを使用
+SETTING_NAMES = ("app_path", "train_dir", "train_path", "checkpoint_path")
 
-const.TRAIN_PATH = const.APP_PATH + "/data" + const.TRAIN_DIR
-const.CHECKPOINT_PATH = const.APP_PATH + "/data/model"
+
+class Settings:
+    """
+    Paths used by a run.
+
+    Parameters:
+    - app_path (str, optional): Root of the application (default is the repository).
+    - train_dir (str): Dataset folder under data/ (default is TRAIN_DIR).
+    - train_path (str, optional): Dataset folder (default is app_path/data + train_dir).
+    - checkpoint_path (str, optional): Model folder (default is app_path/data/model).
+
+    Each run builds its own Settings (directly, from a JSON file with Settings.load or with the
+    --config option of the CLIs) and passes it on, instead of the process-global module.const.
+    """
+
+    def __init__(
+        self,
+        app_path: Optional[str] = None,
+        train_dir: str = TRAIN_DIR,
+        train_path: Optional[str] = None,
+        checkpoint_path: Optional[str] = None,
+    ) -> None:
+        self.app_path = app_path or APP_PATH
+        self.train_dir = train_dir
+        self.train_path = train_path or self.app_path + "/data" + train_dir
+        self.checkpoint_path = checkpoint_path or self.app_path + "/data/model"
+
+    @property
+    def unet_checkpoint_dir(self) -> str:
+        """
+        Checkpoint directory of the UNet.
+
+        Returns:
+        str: checkpoint_path/UNet.
+        """
+        return self.checkpoint_path + "/UNet"
+
+    @property
+    def best_model_path(self) -> str:
+        """
+        Default checkpoint for inference.
+
+        Returns:
+        str: checkpoint_path/UNet/best_model.pth.
+        """
+        return self.unet_checkpoint_dir + "/best_model.pth"
+
+    def to_dict(self) -> Dict[str, str]:
+        """
+        Settings as a dictionary (the format of Settings.load).
+
+        Returns:
+        Dict[str, str]: app_path, train_dir, train_path and checkpoint_path.
+        """
+        return {name: getattr(self, name) for name in SETTING_NAMES}
+
+    @classmethod
+    def load(cls, path: str) -> "Settings":
+        """
+        Read settings from a JSON file.
+
+        Parameters:
+        - path (str): JSON object with any of the parameters of Settings. Relative paths are
+          relative to app_path.
+
+        Returns:
+        Settings: Settings of the file, with the defaults for the missing keys.
+        """
+        with open(path) as f:
+            values = json.load(f)
+        unknown = set(values) - set(SETTING_NAMES)
+        if unknown:
+            raise ValueError(f"Unknown settings in {path}: {sorted(unknown)}")
+        app_path = values.get("app_path") or APP_PATH
+        for name in ("train_path", "checkpoint_path"):
+            if values.get(name) is not None:
+                values[name] = os.path.join(app_path, values[name])
+        return cls(**values)
+
+
+def add_argument(parser: argparse.ArgumentParser) -> None:
+    """
+    Add the --config option to a command line parser.
+
+    Parameters:
+    - parser (argparse.ArgumentParser): Parser of a CLI.
+
+    Returns:
+    None
+    """
+    parser.add_argument(
+        "--config", help="JSON settings file of the run (config.setting.Settings)"
+    )
+
+
+def from_arguments(args: argparse.Namespace) -> Settings:
+    """
+    Settings selected by the --config option.
+
+    Parameters:
+    - args (argparse.Namespace): Parsed options.
+
+    Returns:
+    Settings: Settings of the file, or the defaults without --config.
+    """
+    if getattr(args, "config", None) is None:
+        return Settings()
+    return Settings.load(args.config)
+
+
+def __getattr__(name: str):
+    # 旧来の setting.const を参照したときだけ module.const に値を設定する
+    if name == "const":
+        from module import const
+
+        settings = Settings()
+        for key, value in (
+            ("APP_PATH", settings.app_path),
+            ("TRAIN_DIR", settings.train_dir),
+            ("TRAIN_PATH", settings.train_path),
+            ("CHECKPOINT_PATH", settings.checkpoint_path),
+        ):
+            if key not in const.__dict__:
+                setattr(const, key, value)
+        globals()["const"] = const
+        return const
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
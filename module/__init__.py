@@ -1 +0,0 @@
-print("module directory has been initialized as a package")
@@ -0,0 +1,215 @@
+import math
+from typing import Dict, List, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+import torch
+from torch import nn
+
+from module import instrumentation, tiled_inference
+
+# 粗い確率マップで |p - 0.5| がこれ未満の画素を不確かとみなす
+DEFAULT_UNCERTAINTY_MARGIN = 0.3
+# 粗い二値マスクの相境界から何画素(粗い解像度)までを不確かとみなすか
+DEFAULT_BOUNDARY_WIDTH = 2
+# 縮小画像を作るときに一度に読む行数 (縮小後)
+_COARSE_BAND_ROWS = 64
+
+
+def coarse_image(image, factor: int) -> np.ndarray:
+    """
+    Downsample an image by an integer factor without holding the full image.
+
+    Parameters:
+    - image (np.ndarray | image_source.TiffImageSource): Image (H, W) or (H, W, C).
+    - factor (int): Downsampling factor.
+
+    Returns:
+    np.ndarray: Image (ceil(H / factor), ceil(W / factor)[, C]) averaged over factor x factor blocks.
+
+    A pyramid level of a TiffImageSource with that size is used directly; otherwise the image
+    is read in bands and each band is reduced with cv2.INTER_AREA.
+    """
+    height, width = image.shape[:2]
+    coarse_h, coarse_w = math.ceil(height / factor), math.ceil(width / factor)
+    for index, shape in enumerate(getattr(image, "levels", ())):
+        if index > 0 and shape[:2] == (coarse_h, coarse_w):
+            from module import image_source
+
+            with image_source.TiffImageSource(
+                image.path, level=index, tile_budget=image.tile_budget
+            ) as level:
+                return level[:, :]
+
+    bands = []
+    band_rows = _COARSE_BAND_ROWS * factor
+    for y in range(0, height, band_rows):
+        band = np.asarray(image[y : y + band_rows])
+        rows = math.ceil(band.shape[0] / factor)
+        bands.append(cv2.resize(band, (coarse_w, rows), interpolation=cv2.INTER_AREA))
+    return np.concatenate(bands)
+
+
+def uncertain_pixels(
+    probability: np.ndarray,
+    margin: float = DEFAULT_UNCERTAINTY_MARGIN,
+    boundary_width: int = DEFAULT_BOUNDARY_WIDTH,
+) -> np.ndarray:
+    """
+    Pixels of a probability map where the prediction may change at a finer resolution.
+
+    Parameters:
+    - probability (np.ndarray): float32 probability map (H, W).
+    - margin (float): Pixels with |p - 0.5| < margin are uncertain (default is DEFAULT_UNCERTAINTY_MARGIN).
+    - boundary_width (int): Pixels within this distance of a phase boundary (p crossing 0.5) are
+      uncertain (default is DEFAULT_BOUNDARY_WIDTH).
+
+    Returns:
+    np.ndarray: Boolean map (H, W).
+    """
+    uncertain = np.abs(probability - 0.5) < margin
+    if boundary_width > 0:
+        binary = (probability >= 0.5).astype(np.uint8)
+        kernel = np.ones((2 * boundary_width + 1, 2 * boundary_width + 1), np.uint8)
+        uncertain |= cv2.morphologyEx(binary, cv2.MORPH_GRADIENT, kernel) > 0
+    return uncertain
+
+
+def select_tiles(
+    uncertain: np.ndarray,
+    factor: int,
+    height: int,
+    width: int,
+    tile_size: int,
+    overlap: int,
+) -> Tuple[List[Tuple[int, int]], int]:
+    """
+    Full-resolution tiles that contain an uncertain coarse pixel.
+
+    Parameters:
+    - uncertain (np.ndarray): Boolean map of the coarse image (uncertain_pixels).
+    - factor (int): Downsampling factor of the coarse image.
+    - height (int): Height of the full-resolution image.
+    - width (int): Width of the full-resolution image.
+    - tile_size (int): Size of the full-resolution tiles.
+    - overlap (int): Overlap of the full-resolution tiles.
+
+    Returns:
+    Tuple[List[Tuple[int, int]], int]: (y, x) of the selected tiles of the overlapping grid and
+    the number of tiles of the whole grid.
+    """
+    stride = tile_size - overlap
+    ys = tiled_inference.axis_origins(height, tile_size, stride)
+    xs = tiled_inference.axis_origins(width, tile_size, stride)
+    # 積分画像でタイルごとの不確かな画素数を O(1) で数える
+    counts = cv2.integral(uncertain.astype(np.uint8))
+    coarse_h, coarse_w = uncertain.shape
+    selected = []
+    for y in ys:
+        top = y // factor
+        bottom = min(coarse_h, math.ceil((y + tile_size) / factor))
+        for x in xs:
+            left = x // factor
+            right = min(coarse_w, math.ceil((x + tile_size) / factor))
+            count = (
+                counts[bottom, right]
+                - counts[top, right]
+                - counts[bottom, left]
+                + counts[top, left]
+            )
+            if count > 0:
+                selected.append((y, x))
+    return selected, len(ys) * len(xs)
+
+
+def predict_adaptive(
+    model: nn.Module,
+    image,
+    factor: int = 4,
+    margin: float = DEFAULT_UNCERTAINTY_MARGIN,
+    boundary_width: int = DEFAULT_BOUNDARY_WIDTH,
+    tile_size: int = 256,
+    overlap: int = 32,
+    batch_size: int = 8,
+    num_threads: Optional[int] = None,
+    device: Union[None, str, torch.device] = None,
+    precision: str = "float32",
+    channels_last: bool = False,
+) -> Tuple[np.ndarray, Dict[str, float]]:
+    """
+    Coarse-to-fine inference: run the model on a downsampled image, then again at full
+    resolution only on the tiles where the coarse prediction is uncertain.
+
+    Parameters:
+    - model (nn.Module): Segmentation model (e.g. machine_learning_model.UNet).
+    - image (np.ndarray | image_source.TiffImageSource): Image (H, W) or (H, W, C).
+    - factor (int): Downsampling factor of the coarse pass (default is 4).
+    - margin (float): Uncertainty margin around 0.5 (default is DEFAULT_UNCERTAINTY_MARGIN).
+    - boundary_width (int): Width of the uncertain band around phase boundaries, in coarse
+      pixels (default is DEFAULT_BOUNDARY_WIDTH).
+    - tile_size (int): Tile size of both passes (default is 256).
+    - overlap (int): Tile overlap of both passes (default is 32).
+    - batch_size (int): Tiles per forward pass (default is 8).
+    - num_threads (int, optional): torch intra-op threads (default is None).
+    - device (str | torch.device, optional): Device of the model (default is the device of its parameters).
+    - precision (str): "float32" or "bfloat16" autocast (default is "float32").
+    - channels_last (bool): Feed the tiles in channels_last order (default is False).
+
+    Returns:
+    Tuple[np.ndarray, Dict[str, float]]: float32 probability map (H, W), and
+    - "refined_fraction": Fraction of the pixels predicted at full resolution.
+    - "coarse_tiles", "refined_tiles", "full_tiles": Tiles of the coarse pass, of the
+      refinement and of a plain full-resolution run (predict_tiled).
+    - "work_fraction": (coarse_tiles + refined_tiles) / full_tiles, the model compute
+      relative to predict_tiled.
+
+    Outside the refined tiles the result is the coarse probability resized to full resolution
+    (bilinear); inside them it is the blended full-resolution prediction.
+    """
+    if factor < 1:
+        raise ValueError(f"factor must be at least 1, got {factor}")
+    height, width = image.shape[:2]
+    options = {
+        "tile_size": tile_size,
+        "overlap": overlap,
+        "batch_size": batch_size,
+        "num_threads": num_threads,
+        "device": device,
+        "precision": precision,
+        "channels_last": channels_last,
+    }
+
+    with instrumentation.timer("inference.coarse"):
+        small = coarse_image(image, factor)
+        coarse = tiled_inference.predict_tiled(model, small, **options)
+    stride = tile_size - overlap
+    coarse_tiles = len(
+        tiled_inference.axis_origins(small.shape[0], tile_size, stride)
+    ) * len(tiled_inference.axis_origins(small.shape[1], tile_size, stride))
+
+    uncertain = uncertain_pixels(coarse, margin, boundary_width)
+    origins, full_tiles = select_tiles(
+        uncertain, factor, height, width, tile_size, overlap
+    )
+    probability = cv2.resize(coarse, (width, height), interpolation=cv2.INTER_LINEAR)
+
+    refined_pixels = 0
+    if origins:
+        with instrumentation.timer("inference.refine"):
+            refined = tiled_inference.predict_tiled(
+                model, image, origins=origins, **options
+            )
+        covered = np.zeros((height, width), dtype=bool)
+        for y, x in origins:
+            covered[y : y + tile_size, x : x + tile_size] = True
+        probability[covered] = refined[covered]
+        refined_pixels = int(np.count_nonzero(covered))
+    instrumentation.count("inference.refined_tiles", len(origins))
+
+    return probability, {
+        "refined_fraction": refined_pixels / (height * width),
+        "coarse_tiles": coarse_tiles,
+        "refined_tiles": len(origins),
+        "full_tiles": full_tiles,
+        "work_fraction": (coarse_tiles + len(origins)) / full_tiles,
+    }
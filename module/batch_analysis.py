@@ -0,0 +1,345 @@
+import argparse
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+from config import setting
+from module import instrumentation, tissue_analysis
+from module.batch_segmentation import list_images
+
+PHASES = ("ferrite", "perlite")
+SUMMARY_FIELDS = [
+    "image",
+    "phase",
+    "area_fraction",
+    "count",
+    "total_area",
+    "mean_area",
+    "median_area",
+    "max_area",
+    "mean_perimeter",
+    "mean_equivalent_diameter",
+]
+
+
+def summarize(stats: Dict[str, np.ndarray]) -> Dict[str, float]:
+    """
+    Summarize the per-contour statistics of one image.
+
+    Parameters:
+    - stats (Dict[str, numpy.ndarray]): Statistics from tissue_analysis.contour_statistics.
+
+    Returns:
+    Dict[str, float]: Count and area/perimeter/diameter summary of the contours.
+    """
+    area = stats["area"]
+    count = len(area)
+    if count == 0:
+        return {
+            "count": 0,
+            "total_area": 0.0,
+            "mean_area": 0.0,
+            "median_area": 0.0,
+            "max_area": 0.0,
+            "mean_perimeter": 0.0,
+            "mean_equivalent_diameter": 0.0,
+        }
+    return {
+        "count": count,
+        "total_area": float(area.sum()),
+        "mean_area": float(area.mean()),
+        "median_area": float(np.median(area)),
+        "max_area": float(area.max()),
+        "mean_perimeter": float(stats["perimeter"].mean()),
+        "mean_equivalent_diameter": float(stats["equivalent_diameter"].mean()),
+    }
+
+
+def analyze_mask_file(
+    path: str,
+    phases: Sequence[str] = PHASES,
+    expansion: Optional[int] = None,
+    with_grains: bool = False,
+    label: Optional[str] = None,
+    tile_size: Optional[int] = None,
+) -> Tuple[List[dict], List[dict]]:
+    """
+    Analyze one predicted mask file.
+
+    Parameters:
+    - path (str): Path to the predicted mask.
+    - phases (Sequence[str]): Phases to analyze, "ferrite" and/or "perlite" (default is both).
+    - expansion (int, optional): Closing kernel size of the ferrite analysis (default is None).
+    - with_grains (bool): Also return one row per grain (default is False).
+    - label (str, optional): "image" column of the rows (default is path).
+    - tile_size (int, optional): Analyze the mask tile by tile (module.streaming_analysis); TIFF
+      masks are then read tile by tile. The statistics are the same, the grain rows are in
+      raster order of their contours (default is None).
+
+    Returns:
+    Tuple[List[dict], List[dict]]: Summary rows (one per phase) and grain rows.
+    """
+    label = path if label is None else label
+    if tile_size is not None:
+        result = analyze_tiled_file(path, tile_size, expansion, tuple(phases))
+    else:
+        with instrumentation.timer("analysis.read_mask"):
+            image = cv2.imread(path)
+        if image is None:
+            raise ValueError(f"Could not read image: {path}")
+        # 両相を同じ二値化画像から解析する
+        result = tissue_analysis.analyze_phases(image, expansion, tuple(phases))
+    summary_rows = []
+    grain_rows = []
+    for phase in phases:
+        stats = result[phase]
+        summary_rows.append(
+            {
+                "image": label,
+                "phase": phase,
+                "area_fraction": result[f"{phase}_fraction"],
+                **summarize(stats),
+            }
+        )
+        if with_grains:
+            columns = {name: values.tolist() for name, values in stats.items()}
+            for i in range(len(stats["area"])):
+                grain = {name: values[i] for name, values in columns.items()}
+                grain_rows.append(
+                    {"image": label, "phase": phase, "grain": i + 1, **grain}
+                )
+    return summary_rows, grain_rows
+
+
+def analyze_tiled_file(
+    path: str,
+    tile_size: int,
+    expansion: Optional[int] = None,
+    phases: Tuple[str, ...] = PHASES,
+) -> Dict:
+    """
+    Analyze one predicted mask file tile by tile.
+
+    Parameters:
+    - path (str): Path to the predicted mask. TIFF files are read tile by tile (module.image_source).
+    - tile_size (int): Size of the tiles.
+    - expansion (int, optional): Closing kernel size of the ferrite analysis (default is None).
+    - phases (Tuple[str, ...]): Phases to analyze (default is both).
+
+    Returns:
+    Dict: Result of streaming_analysis.analyze_tiles.
+    """
+    from module import image_source, streaming_analysis
+
+    if image_source.is_tiff(path):
+        with image_source.TiffImageSource(path) as source:
+            return streaming_analysis.analyze_tiles(
+                source, tile_size, expansion, phases
+            )
+    with instrumentation.timer("analysis.read_mask"):
+        image = cv2.imread(path)
+    if image is None:
+        raise ValueError(f"Could not read image: {path}")
+    return streaming_analysis.analyze_tiles(image, tile_size, expansion, phases)
+
+
+def _init_worker(cv2_threads: int, instrument: bool) -> None:
+    # ワーカー数 × OpenCVのスレッド数がコア数を超えないようにする
+    cv2.setNumThreads(cv2_threads)
+    if instrument:
+        instrumentation.enable()
+
+
+def _analyze_task(args: Tuple) -> Tuple[List[dict], List[dict], Optional[Dict]]:
+    summaries, grains = analyze_mask_file(*args)
+    # ワーカーで計測した時間は結果と一緒に親プロセスに返す
+    state = instrumentation.export_state() if instrumentation.enabled() else None
+    return summaries, grains, state
+
+
+def analyze_masks(
+    paths: List[str],
+    phases: Sequence[str] = PHASES,
+    expansion: Optional[int] = None,
+    workers: Optional[int] = None,
+    chunksize: Optional[int] = None,
+    cv2_threads: int = 1,
+    with_grains: bool = False,
+    labels: Optional[List[str]] = None,
+    tile_size: Optional[int] = None,
+) -> Tuple[List[dict], List[dict]]:
+    """
+    Analyze many predicted masks on a process pool.
+
+    Parameters:
+    - paths (List[str]): Paths to the predicted masks.
+    - phases (Sequence[str]): Phases to analyze, "ferrite" and/or "perlite" (default is both).
+    - expansion (int, optional): Closing kernel size of the ferrite analysis (default is None).
+    - workers (int, optional): Number of worker processes (default is os.cpu_count()).
+    - chunksize (int, optional): Images sent to a worker at once (default is about 4 chunks per worker).
+    - cv2_threads (int): OpenCV threads per worker (default is 1).
+    - with_grains (bool): Also return one row per grain (default is False).
+    - labels (List[str], optional): "image" column of each path (default is the paths).
+    - tile_size (int, optional): Analyze tile by tile (see analyze_mask_file, default is None).
+
+    Returns:
+    Tuple[List[dict], List[dict]]: Summary rows and grain rows of all images, in the order of paths.
+    """
+    workers = workers or os.cpu_count() or 1
+    if chunksize is None:
+        chunksize = max(1, len(paths) // (workers * 4))
+
+    labels = paths if labels is None else labels
+    tasks = [
+        (path, tuple(phases), expansion, with_grains, label, tile_size)
+        for path, label in zip(paths, labels)
+    ]
+    summary_rows = []
+    grain_rows = []
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(cv2_threads, instrumentation.enabled()),
+    ) as executor:
+        for summaries, grains, state in executor.map(
+            _analyze_task, tasks, chunksize=chunksize
+        ):
+            summary_rows.extend(summaries)
+            grain_rows.extend(grains)
+            if state is not None:
+                instrumentation.merge_state(state)
+    return summary_rows, grain_rows
+
+
+def write_rows(path: str, rows: List[dict], fieldnames: List[str]) -> None:
+    """
+    Write rows to a CSV file.
+
+    Parameters:
+    - path (str): Output path.
+    - rows (List[dict]): Rows to write.
+    - fieldnames (List[str]): Column names.
+
+    Returns:
+    None
+    """
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def segment_cached(
+    image_paths: List[str],
+    cache_dir: str,
+    checkpoint: Optional[str] = None,
+    exported: Optional[str] = None,
+    settings: Optional[setting.Settings] = None,
+) -> Tuple[List[str], List[str]]:
+    """
+    Segment micrographs through the result cache, running the model only for new images.
+
+    Parameters:
+    - image_paths (List[str]): Micrographs.
+    - cache_dir (str): Directory of the result cache (module.result_cache).
+    - checkpoint (str, optional): Checkpoint path (default is the best_model_path of settings).
+    - exported (str, optional): TorchScript model exported by module.model_export.
+    - settings (config.setting.Settings, optional): Settings of the run (default is Settings()).
+
+    Returns:
+    Tuple[List[str], List[str]]: Predicted masks (cache entries) and the micrographs they belong to.
+    """
+    from module import batch_segmentation, result_cache
+
+    path = batch_segmentation.model_file(checkpoint, exported, settings)
+    cache = result_cache.ResultCache(cache_dir)
+    rows = batch_segmentation.segment_images(
+        None,
+        image_paths,
+        None,
+        cache=cache,
+        model_digest=result_cache.model_digest(path),
+        model_loader=lambda: batch_segmentation.load_model(
+            path, exported=exported is not None
+        ),
+    )
+    print(f"cache: {sum(row['cached'] for row in rows)}/{len(rows)} hits")
+    return [row["mask"] for row in rows], [row["image"] for row in rows]
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Analyze the ferrite/perlite phases of many predicted masks in parallel."
+    )
+    parser.add_argument(
+        "inputs",
+        nargs="+",
+        help="mask files, directories or .txt file lists (micrographs with --cache-dir)",
+    )
+    parser.add_argument("-o", "--output", required=True, help="summary CSV path")
+    parser.add_argument("--grains", help="also write one row per grain to this CSV")
+    parser.add_argument("--phase", nargs="+", choices=PHASES, default=list(PHASES))
+    parser.add_argument("--expansion", type=int)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--chunksize", type=int)
+    parser.add_argument("--cv2-threads", type=int, default=1)
+    parser.add_argument(
+        "--cache-dir",
+        help="segment the input micrographs through this result cache (module.result_cache) first",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help="checkpoint path with --cache-dir (default: checkpoint_path/UNet/best_model.pth of --config)",
+    )
+    parser.add_argument(
+        "--model", help="TorchScript model exported by module.model_export"
+    )
+    parser.add_argument(
+        "--tile-size",
+        type=int,
+        help="analyze large masks tile by tile (module.streaming_analysis), "
+        "with the same statistics",
+    )
+    setting.add_argument(parser)
+    instrumentation.add_arguments(parser, profiler=False)
+    args = parser.parse_args(argv)
+    instrumentation.from_arguments(args)
+
+    paths = list_images(args.inputs)
+    labels = None
+    if args.cache_dir is not None:
+        paths, labels = segment_cached(
+            paths,
+            args.cache_dir,
+            args.checkpoint,
+            args.model,
+            setting.from_arguments(args),
+        )
+    summary_rows, grain_rows = analyze_masks(
+        paths,
+        phases=args.phase,
+        expansion=args.expansion,
+        workers=args.workers,
+        chunksize=args.chunksize,
+        cv2_threads=args.cv2_threads,
+        with_grains=args.grains is not None,
+        labels=labels,
+        tile_size=args.tile_size,
+    )
+    write_rows(args.output, summary_rows, SUMMARY_FIELDS)
+    if args.grains is not None:
+        write_rows(
+            args.grains,
+            grain_rows,
+            ["image", "phase", "grain"] + list(tissue_analysis.STATISTIC_NAMES),
+        )
+    instrumentation.write_outputs(args, {"run": "analysis"})
+    print(f"analyzed {len(paths)} images -> {args.output}")
+
+
+if __name__ == "__main__":
+    main()
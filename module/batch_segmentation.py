@@ -0,0 +1,659 @@
+import argparse
+import csv
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, Optional, Set
+
+import cv2
+import numpy as np
+
+from config import setting
+from module import dataset_manifest, instrumentation
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp")
+SUMMARY_FIELDS = [
+    "image",
+    "mask",
+    "height",
+    "width",
+    "foreground_fraction",
+    "mean_probability",
+    "seconds",
+    "cached",
+    "refined_fraction",
+]
+
+
+def list_images(inputs: Iterable[str]) -> List[str]:
+    """
+    Expand files and directories into a list of image files.
+
+    Parameters:
+    - inputs (Iterable[str]): Image files, directories of images, or text files (".txt") listing one image per line.
+
+    Returns:
+    List[str]: Image paths. Directory contents are sorted by name.
+    """
+    paths = []
+    for entry in inputs:
+        if os.path.isdir(entry):
+            names = sorted(
+                name
+                for name in os.listdir(entry)
+                if name.lower().endswith(IMAGE_EXTENSIONS)
+            )
+            paths.extend(os.path.join(entry, name) for name in names)
+        elif entry.endswith(".txt"):
+            with open(entry, "r") as f:
+                paths.extend(line.strip() for line in f if line.strip())
+        else:
+            paths.append(entry)
+    return paths
+
+
+def read_image(path: str) -> np.ndarray:
+    """
+    Decode a micrograph as an RGB (or grayscale) uint8 image.
+
+    Parameters:
+    - path (str): Path to the image.
+
+    Returns:
+    np.ndarray: Image (H, W) or (H, W, 3) in RGB order, like skimage.io.imread in LoadDataSet.
+    """
+    image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise ValueError(f"Could not read image: {path}")
+    return _to_rgb_uint8(image)
+
+
+def decode_image(data: bytes) -> np.ndarray:
+    """
+    Decode an encoded micrograph (PNG, JPEG, TIFF, BMP) like read_image.
+
+    Parameters:
+    - data (bytes): Content of the image file.
+
+    Returns:
+    np.ndarray: Image (H, W) or (H, W, 3) in RGB order.
+    """
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise ValueError("Could not decode image")
+    return _to_rgb_uint8(image)
+
+
+def _to_rgb_uint8(image: np.ndarray) -> np.ndarray:
+    if image.dtype != np.uint8:
+        image = cv2.convertScaleAbs(image, alpha=255.0 / max(int(image.max()), 1))
+    if image.ndim == 3 and image.shape[2] == 4:
+        image = cv2.cvtColor(image, cv2.COLOR_BGRA2RGB)
+    elif image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    return image
+
+
+def probability_to_uint8(probability: np.ndarray) -> np.ndarray:
+    """
+    Scale a probability map to 0-255.
+
+    Parameters:
+    - probability (np.ndarray): float32 probability map (H, W).
+
+    Returns:
+    np.ndarray: uint8 map (H, W).
+    """
+    return np.clip(np.rint(probability * 255.0), 0, 255).astype(np.uint8)
+
+
+@instrumentation.timed("segment.encode")
+def write_mask(path: str, probability: np.ndarray, threshold: Optional[float]) -> None:
+    """
+    Encode a predicted mask as a grayscale PNG.
+
+    Parameters:
+    - path (str): Output path.
+    - probability (np.ndarray): float32 probability map (H, W).
+    - threshold (float, optional): When given, the mask is binarized (0/255) at this probability.
+      Otherwise the probability is stored scaled to 0-255 (tissue_analysis thresholds it at 128).
+
+    Returns:
+    None
+    """
+    if threshold is None:
+        mask = probability_to_uint8(probability)
+    else:
+        mask = np.where(probability >= threshold, 255, 0).astype(np.uint8)
+    if not cv2.imwrite(path, mask):
+        raise ValueError(f"Could not write mask: {path}")
+
+
+def unique_name(path: str, used_names: Set[str]) -> str:
+    """
+    Output name of an input image that no other input of the run uses.
+
+    Parameters:
+    - path (str): Path to the input image.
+    - used_names (Set[str]): Names already given to other inputs. The returned name is added.
+
+    Returns:
+    str: File name of path without extension, with "_2", "_3", ... appended when another
+    input (e.g. in another folder) already has that name.
+    """
+    base = os.path.splitext(os.path.basename(path))[0]
+    name = base
+    number = 2
+    while name in used_names:
+        name = f"{base}_{number}"
+        number += 1
+    used_names.add(name)
+    return name
+
+
+def segment_images(
+    model,
+    image_paths: List[str],
+    output_dir: Optional[str],
+    tile_size: int = 256,
+    overlap: int = 32,
+    batch_size: int = 8,
+    num_threads: Optional[int] = None,
+    io_workers: int = 4,
+    threshold: Optional[float] = None,
+    device: str = "cpu",
+    precision: str = "float32",
+    channels_last: bool = False,
+    cache=None,
+    model_digest: Optional[str] = None,
+    model_loader: Optional[Callable] = None,
+    profiler: Optional[instrumentation.StepProfiler] = None,
+    coarse_factor: Optional[int] = None,
+    uncertainty_margin: Optional[float] = None,
+) -> List[dict]:
+    """
+    Segment micrographs and write the predicted masks and a per-image summary.
+
+    Parameters:
+    - model (nn.Module, optional): Loaded segmentation model. May be None when model_loader is given.
+    - image_paths (List[str]): Images to segment.
+    - output_dir (str, optional): Directory of the predicted masks and summary.csv. With None
+      nothing is written and the "mask" of the rows is the cache entry (requires cache).
+    - tile_size (int): Tile size of the tiled inference (default is 256).
+    - overlap (int): Tile overlap (default is 32).
+    - batch_size (int): Tiles per forward pass (default is 8).
+    - num_threads (int, optional): torch intra-op threads (default is None).
+    - io_workers (int): Threads decoding and encoding images (default is 4).
+    - threshold (float, optional): Binarize the written masks at this probability (default is None).
+    - device (str): Device of the model (default is "cpu").
+    - precision (str): "float32" or "bfloat16" autocast (default is "float32").
+    - channels_last (bool): Run in channels_last order (default is False).
+    - cache (ResultCache, optional): Segmentation result cache (module.result_cache). Images
+      whose (content, model, settings) are cached skip decoding and the model (default is None).
+    - model_digest (str, optional): Digest of the model file, required with cache (default is None).
+    - model_loader (callable, optional): Loads the model on the first image that is not cached (default is None).
+    - profiler (instrumentation.StepProfiler, optional): Stepped after every image (default is None).
+    - coarse_factor (int, optional): Run coarse-to-fine inference (adaptive_inference.predict_adaptive)
+      with this downsampling factor; the rows get the "refined_fraction" (default is None).
+    - uncertainty_margin (float, optional): Uncertainty margin of the coarse-to-fine inference
+      (default is adaptive_inference.DEFAULT_UNCERTAINTY_MARGIN).
+
+    Returns:
+    List[dict]: Summary row of every image.
+
+    Images are decoded ahead and masks are encoded on a thread pool while the model
+    runs on the main thread, so I/O overlaps with model compute.
+    Results taken from the cache are the 8-bit probability maps (see write_mask).
+    """
+    from module import tiled_inference
+
+    if cache is not None and model_digest is None:
+        raise ValueError("model_digest is required with cache")
+    if output_dir is None and cache is None:
+        raise ValueError("output_dir or cache is required")
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    settings = {
+        "tile_size": tile_size,
+        "overlap": overlap,
+        "window": "cosine",
+        "precision": precision,
+        "channels_last": channels_last,
+    }
+    if coarse_factor is not None:
+        from module import adaptive_inference
+
+        if uncertainty_margin is None:
+            uncertainty_margin = adaptive_inference.DEFAULT_UNCERTAINTY_MARGIN
+        settings["coarse_factor"] = coarse_factor
+        settings["uncertainty_margin"] = uncertainty_margin
+
+    def decode(path: str) -> np.ndarray:
+        with instrumentation.timer("segment.decode"):
+            return read_image(path)
+
+    def load(path: str):
+        if cache is None:
+            return None, decode(path), None
+        with instrumentation.timer("segment.cache_lookup"):
+            key = cache.key(dataset_manifest.file_digest(path), model_digest, settings)
+            cached = cache.get(key)
+        if cached is not None:
+            return key, None, cached
+        return key, decode(path), None
+
+    summary_threshold = 0.5 if threshold is None else threshold
+    rows = []
+    with ThreadPoolExecutor(max_workers=io_workers) as executor:
+        decoding = deque()
+        writes = []
+        used_names = set()
+        paths = iter(image_paths)
+
+        def submit_next() -> None:
+            path = next(paths, None)
+            if path is not None:
+                decoding.append((path, executor.submit(load, path)))
+
+        # 先読みする枚数はI/Oスレッド数と同じにしてメモリ使用量を抑える
+        for _ in range(max(io_workers, 1)):
+            submit_next()
+
+        while decoding:
+            path, future = decoding.popleft()
+            key, image, cached = future.result()
+            submit_next()
+
+            start = time.perf_counter()
+            refined_fraction = None
+            if cached is not None:
+                probability = cached.astype(np.float32) / np.float32(255.0)
+            else:
+                if model is None:
+                    with instrumentation.timer("segment.load_model"):
+                        model = model_loader()
+                options = {
+                    "tile_size": tile_size,
+                    "overlap": overlap,
+                    "batch_size": batch_size,
+                    "num_threads": num_threads,
+                    "device": device,
+                    "precision": precision,
+                    "channels_last": channels_last,
+                }
+                if coarse_factor is None:
+                    probability = tiled_inference.predict_tiled(model, image, **options)
+                else:
+                    probability, refinement = adaptive_inference.predict_adaptive(
+                        model,
+                        image,
+                        factor=coarse_factor,
+                        margin=uncertainty_margin,
+                        **options,
+                    )
+                    refined_fraction = refinement["refined_fraction"]
+                if cache is not None:
+                    writes.append(
+                        executor.submit(
+                            cache.put, key, probability_to_uint8(probability)
+                        )
+                    )
+            seconds = time.perf_counter() - start
+            instrumentation.record("segment.predict", seconds)
+            instrumentation.count("segment.images")
+            if cached is not None:
+                instrumentation.count("segment.cache_hits")
+
+            if output_dir is None:
+                mask_path = cache.path(key)
+            else:
+                name = unique_name(path, used_names)
+                mask_path = os.path.join(output_dir, f"Predicted_Mask_{name}.png")
+                writes.append(
+                    executor.submit(write_mask, mask_path, probability, threshold)
+                )
+            rows.append(
+                {
+                    "image": path,
+                    "mask": mask_path,
+                    "height": probability.shape[0],
+                    "width": probability.shape[1],
+                    "foreground_fraction": float(
+                        np.count_nonzero(probability >= summary_threshold)
+                        / probability.size
+                    ),
+                    "mean_probability": float(probability.mean()),
+                    "seconds": round(seconds, 4),
+                    "cached": cached is not None,
+                    "refined_fraction": refined_fraction,
+                }
+            )
+            note = " (cached)" if cached is not None else ""
+            if refined_fraction is not None:
+                note = f" (refined {refined_fraction:.1%})"
+            print(f"{path}: {seconds:.2f}s{note}")
+            if profiler is not None:
+                profiler.step()
+
+        for future in writes:
+            future.result()
+
+    if output_dir is not None:
+        with open(os.path.join(output_dir, "summary.csv"), "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+    return rows
+
+
+def segment_large_image(
+    model,
+    source,
+    output_path: str,
+    tile_size: int = 256,
+    overlap: int = 32,
+    batch_size: int = 8,
+    num_threads: Optional[int] = None,
+    threshold: Optional[float] = None,
+    device: str = "cpu",
+    precision: str = "float32",
+    channels_last: bool = False,
+) -> dict:
+    """
+    Segment an image too large for memory and write the mask as a tiled TIFF.
+
+    Parameters:
+    - model (nn.Module): Loaded segmentation model.
+    - source (image_source.TiffImageSource): Opened uint8 image.
+    - output_path (str): Output TIFF path.
+    - tile_size (int): Tile size of the tiled inference (default is 256).
+    - overlap (int): Tile overlap (default is 32).
+    - batch_size (int): Tiles per forward pass (default is 8).
+    - num_threads (int, optional): torch intra-op threads (default is None).
+    - threshold (float, optional): Binarize the mask at this probability (default is None).
+    - device (str): Device of the model (default is "cpu").
+    - precision (str): "float32" or "bfloat16" autocast (default is "float32").
+    - channels_last (bool): Run in channels_last order (default is False).
+
+    Returns:
+    dict: Summary row (SUMMARY_FIELDS) of the image.
+
+    The probability map is produced band by band (tiled_inference.predict_bands) and written
+    as it arrives, so the memory use is the tile budget of the source plus one row of tiles.
+    """
+    from module import image_source, tiled_inference
+
+    if source.dtype != np.uint8:
+        raise ValueError(f"Expected a uint8 image, got {source.dtype}: {source.path}")
+    summary_threshold = 0.5 if threshold is None else threshold
+    totals = {"foreground": 0, "probability": 0.0}
+
+    def masks():
+        for y, band in tiled_inference.predict_bands(
+            model,
+            source,
+            tile_size=tile_size,
+            overlap=overlap,
+            batch_size=batch_size,
+            num_threads=num_threads,
+            device=device,
+            precision=precision,
+            channels_last=channels_last,
+        ):
+            totals["foreground"] += int(np.count_nonzero(band >= summary_threshold))
+            totals["probability"] += float(band.sum(dtype=np.float64))
+            if threshold is None:
+                yield y, probability_to_uint8(band)
+            else:
+                yield y, np.where(band >= threshold, 255, 0).astype(np.uint8)
+
+    start = time.perf_counter()
+    image_source.write_tiled_tiff(output_path, masks(), (source.height, source.width))
+    seconds = time.perf_counter() - start
+    instrumentation.record("segment.predict", seconds)
+    instrumentation.count("segment.images")
+    pixels = source.height * source.width
+    return {
+        "image": source.path,
+        "mask": output_path,
+        "height": source.height,
+        "width": source.width,
+        "foreground_fraction": totals["foreground"] / pixels,
+        "mean_probability": totals["probability"] / pixels,
+        "seconds": round(seconds, 4),
+        "cached": False,
+        "refined_fraction": None,
+    }
+
+
+def model_file(
+    checkpoint: Optional[str] = None,
+    exported: Optional[str] = None,
+    settings: Optional[setting.Settings] = None,
+) -> str:
+    """
+    Model file used for the segmentation.
+
+    Parameters:
+    - checkpoint (str, optional): Checkpoint path (default is the best_model_path of settings).
+    - exported (str, optional): TorchScript model exported by module.model_export, used instead of the checkpoint.
+    - settings (config.setting.Settings, optional): Settings of the run (default is Settings()).
+
+    Returns:
+    str: Path of the model file.
+    """
+    if exported is not None:
+        return exported
+    if checkpoint is None:
+        checkpoint = (settings or setting.Settings()).best_model_path
+    return checkpoint
+
+
+def load_model(
+    path: str,
+    exported: bool = False,
+    device: str = "cpu",
+    channels_last: bool = False,
+    compile: bool = False,
+):
+    """
+    Load a segmentation model for inference.
+
+    Parameters:
+    - path (str): Model file (model_file).
+    - exported (bool): The file is an exported TorchScript model instead of a checkpoint (default is False).
+    - device (str): Device of the model (default is "cpu").
+    - channels_last (bool): Convert the model to channels_last (default is False).
+    - compile (bool): Use torch.compile (default is False).
+
+    Returns:
+    nn.Module: Model in evaluation mode.
+    """
+    from module import model_runtime
+
+    if exported:
+        from module import model_export
+
+        model, _ = model_export.load_exported(path, map_location=device)
+    else:
+        from module import machine_learning_model
+
+        model = machine_learning_model.load_unet(path, map_location=device)
+    return model_runtime.prepare_model(
+        model, device, channels_last=channels_last, compile=compile
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Segment micrographs with a trained UNet checkpoint (no Jupyter, CPU by default)."
+    )
+    parser.add_argument(
+        "inputs", nargs="+", help="image files, directories or .txt file lists"
+    )
+    parser.add_argument("-o", "--output-dir", required=True)
+    parser.add_argument(
+        "--checkpoint",
+        help="checkpoint path (default: checkpoint_path/UNet/best_model.pth of --config)",
+    )
+    parser.add_argument(
+        "--model", help="TorchScript model exported by module.model_export"
+    )
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--tile-size", type=int, default=256)
+    parser.add_argument("--overlap", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--threads", type=int, help="torch intra-op threads")
+    parser.add_argument("--io-workers", type=int, default=4)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        help="write binary masks at this probability instead of 0-255 probabilities",
+    )
+    parser.add_argument(
+        "--precision",
+        choices=("float32", "bfloat16"),
+        default="float32",
+        help="bfloat16 autocast is faster on CPUs with AVX512-BF16/AMX",
+    )
+    parser.add_argument("--channels-last", action="store_true")
+    parser.add_argument("--compile", action="store_true", help="use torch.compile")
+    parser.add_argument(
+        "--cache-dir", help="reuse results of unchanged images (module.result_cache)"
+    )
+    parser.add_argument(
+        "--cache-max-mb", type=float, help="evict old cache entries above this size"
+    )
+    parser.add_argument(
+        "--coarse-factor",
+        type=int,
+        help="coarse-to-fine inference: run on the image downsampled by this factor and "
+        "refine only uncertain tiles at full resolution (module.adaptive_inference)",
+    )
+    parser.add_argument(
+        "--uncertainty-margin",
+        type=float,
+        help="refine where |p - 0.5| of the coarse pass is below this (default 0.3)",
+    )
+    parser.add_argument(
+        "--tile-budget-mb",
+        type=float,
+        help="stream TIFF inputs tile by tile with this much decoded image in memory "
+        "and write tiled TIFF masks (module.image_source)",
+    )
+    setting.add_argument(parser)
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.tile_budget_mb is not None:
+        # タイルごとに読み書きする経路はキャッシュと粗い推論に対応していない
+        for option, value in (
+            ("--cache-dir", args.cache_dir),
+            ("--coarse-factor", args.coarse_factor),
+            ("--uncertainty-margin", args.uncertainty_margin),
+        ):
+            if value is not None:
+                parser.error(f"{option} cannot be used with --tile-budget-mb")
+    profiler = instrumentation.from_arguments(args)
+
+    path = model_file(args.checkpoint, args.model, setting.from_arguments(args))
+
+    def model_loader():
+        return load_model(
+            path,
+            exported=args.model is not None,
+            device=args.device,
+            channels_last=args.channels_last,
+            compile=args.compile,
+        )
+
+    cache = None
+    digest = None
+    if args.cache_dir is not None:
+        from module import result_cache
+
+        max_bytes = None
+        if args.cache_max_mb is not None:
+            max_bytes = int(args.cache_max_mb * 1024 * 1024)
+        cache = result_cache.ResultCache(args.cache_dir, max_bytes=max_bytes)
+        digest = result_cache.model_digest(path)
+
+    image_paths = list_images(args.inputs)
+    if args.tile_budget_mb is not None:
+        with profiler:
+            segment_streamed(args, image_paths, model_loader(), profiler)
+        return
+    # キャッシュを使う場合は、すべての画像がキャッシュにあればモデルを読み込まない
+    with profiler:
+        rows = segment_images(
+            None if cache is not None else model_loader(),
+            image_paths,
+            args.output_dir,
+            tile_size=args.tile_size,
+            overlap=args.overlap,
+            batch_size=args.batch_size,
+            num_threads=args.threads,
+            io_workers=args.io_workers,
+            threshold=args.threshold,
+            device=args.device,
+            precision=args.precision,
+            channels_last=args.channels_last,
+            cache=cache,
+            model_digest=digest,
+            model_loader=model_loader,
+            profiler=profiler,
+            coarse_factor=args.coarse_factor,
+            uncertainty_margin=args.uncertainty_margin,
+        )
+    if cache is not None:
+        print(f"cache: {sum(row['cached'] for row in rows)}/{len(rows)} hits")
+    instrumentation.write_outputs(args, {"run": "segment"})
+    print(f"segmented {len(image_paths)} images -> {args.output_dir}")
+
+
+def segment_streamed(
+    args: argparse.Namespace,
+    image_paths: List[str],
+    model,
+    profiler: Optional[instrumentation.StepProfiler] = None,
+) -> None:
+    from module import image_source
+
+    budget = int(args.tile_budget_mb * 1024 * 1024)
+    os.makedirs(args.output_dir, exist_ok=True)
+    rows = []
+    used_names = set()
+    for path in image_paths:
+        if not image_source.is_tiff(path):
+            raise ValueError(f"--tile-budget-mb needs TIFF inputs, got {path}")
+        name = unique_name(path, used_names)
+        output_path = os.path.join(args.output_dir, f"Predicted_Mask_{name}.tif")
+        with image_source.TiffImageSource(path, tile_budget=budget) as source:
+            row = segment_large_image(
+                model,
+                source,
+                output_path,
+                tile_size=args.tile_size,
+                overlap=args.overlap,
+                batch_size=args.batch_size,
+                num_threads=args.threads,
+                threshold=args.threshold,
+                device=args.device,
+                precision=args.precision,
+                channels_last=args.channels_last,
+            )
+        rows.append(row)
+        print(f"{path}: {row['seconds']:.2f}s")
+        if profiler is not None:
+            profiler.step()
+    with open(os.path.join(args.output_dir, "summary.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"peak RSS: {image_source.peak_rss_bytes() / 2**20:.0f} MiB")
+    instrumentation.write_outputs(args, {"run": "segment"})
+    print(f"segmented {len(image_paths)} images -> {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,603 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+from scipy.spatial import cKDTree
+
+SUITES = ("loader", "unet", "analysis", "imports")
+# 解析だけを行うワーカーが読み込むモジュールと, その読み込み時間の上限
+ANALYSIS_IMPORTS = ("module.tissue_analysis", "module.batch_analysis")
+ANALYSIS_IMPORT_BUDGET_SECONDS = 0.5
+# 解析だけのときに読み込まれてはいけないモジュール
+HEAVY_MODULES = ("torch", "matplotlib", "albumentations", "skimage", "scipy", "PIL")
+# 合成画像の明るさ(フェライト, パーライトのラメラ2色, 粒界)
+FERRITE_LEVEL = 200
+PERLITE_LEVELS = (60, 130)
+BOUNDARY_LEVEL = 40
+
+
+def synthetic_microstructure(
+    image_size: int,
+    n_grains: int,
+    perlite_fraction: float = 0.3,
+    boundary_width: float = 1.5,
+    lamella_period: float = 6.0,
+    noise: float = 8.0,
+    seed: int = 0,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Generate a synthetic ferrite-perlite micrograph and its mask from Voronoi grains.
+
+    Parameters:
+    - image_size (int): Height and width of the image.
+    - n_grains (int): Number of Voronoi grains.
+    - perlite_fraction (float): Target area fraction of perlite (default is 0.3).
+    - boundary_width (float): Width in pixels of the grain boundaries (default is 1.5).
+    - lamella_period (float): Period in pixels of the perlite lamellae (default is 6.0).
+    - noise (float): Standard deviation of the Gaussian noise of the micrograph (default is 8.0).
+    - seed (int): Random seed (default is 0).
+
+    Returns:
+    Tuple[numpy.ndarray, numpy.ndarray]: Micrograph (H, W, 3) uint8 and mask (H, W) uint8,
+    where ferrite is 255 and perlite and grain boundaries are 0 (same as the labeled masks).
+    """
+    rng = np.random.default_rng(seed)
+    seeds = rng.uniform(0, image_size, size=(n_grains, 2))
+    y, x = np.mgrid[0:image_size, 0:image_size]
+    pixels = np.stack([x.ravel(), y.ravel()], axis=1).astype(np.float64)
+
+    # 最も近い2つの種点との距離の差が小さい画素を粒界にする
+    distances, nearest = cKDTree(seeds).query(pixels, k=2)
+    labels = nearest[:, 0].reshape(image_size, image_size)
+    boundary = (distances[:, 1] - distances[:, 0] < boundary_width).reshape(
+        image_size, image_size
+    )
+
+    # 面積の合計が目標に達するまでランダムな順番で粒をパーライトにする
+    areas = np.bincount(labels.ravel(), minlength=n_grains)
+    order = rng.permutation(n_grains)
+    cumulative = np.cumsum(areas[order]) / labels.size
+    n_perlite = int(np.searchsorted(cumulative, perlite_fraction))
+    is_perlite = np.zeros(n_grains, dtype=bool)
+    is_perlite[order[:n_perlite]] = True
+    perlite = is_perlite[labels]
+
+    # パーライトは粒ごとに向きの異なるラメラ
+    angles = rng.uniform(0, np.pi, size=n_grains)
+    projection = x * np.cos(angles)[labels] + y * np.sin(angles)[labels]
+    lamellae = np.sin(2 * np.pi * projection / lamella_period) > 0
+
+    gray = np.full((image_size, image_size), FERRITE_LEVEL, dtype=np.float64)
+    gray[perlite] = np.where(lamellae[perlite], *PERLITE_LEVELS)
+    gray[boundary] = BOUNDARY_LEVEL
+    gray += rng.normal(0, noise, size=gray.shape)
+    gray = cv2.GaussianBlur(np.clip(gray, 0, 255).astype(np.uint8), (3, 3), 0)
+    image = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+
+    mask = np.where(perlite | boundary, 0, 255).astype(np.uint8)
+    return image, mask
+
+
+def write_dataset(
+    path: str,
+    n_samples: int,
+    image_size: int,
+    n_grains: int,
+    perlite_fraction: float = 0.3,
+    seed: int = 0,
+) -> List[str]:
+    """
+    Write synthetic samples in the N-M/images, N-M/masks layout of LoadDataSet.
+
+    Parameters:
+    - path (str): Dataset folder.
+    - n_samples (int): Number of samples.
+    - image_size (int): Height and width of the images.
+    - n_grains (int): Number of grains per image.
+    - perlite_fraction (float): Target area fraction of perlite (default is 0.3).
+    - seed (int): Random seed of the first sample, incremented per sample (default is 0).
+
+    Returns:
+    List[str]: Sample folder names.
+    """
+    sample_ids = []
+    for i in range(n_samples):
+        sample_id = f"{i + 1}-1"
+        image, mask = synthetic_microstructure(
+            image_size, n_grains, perlite_fraction, seed=seed + i
+        )
+        for folder, array in (("images", image), ("masks", mask)):
+            directory = os.path.join(path, sample_id, folder)
+            os.makedirs(directory, exist_ok=True)
+            cv2.imwrite(os.path.join(directory, f"{sample_id}.png"), array)
+        sample_ids.append(sample_id)
+    return sample_ids
+
+
+def measure(fn: Callable[[], None], repeats: int = 5, warmup: int = 1) -> Dict:
+    """
+    Time a function.
+
+    Parameters:
+    - fn (Callable[[], None]): Function to time.
+    - repeats (int): Number of timed calls (default is 5).
+    - warmup (int): Number of calls before timing (default is 1).
+
+    Returns:
+    Dict: "median_seconds", "min_seconds", "mean_seconds" and "repeats".
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {
+        "median_seconds": statistics.median(times),
+        "min_seconds": min(times),
+        "mean_seconds": statistics.fmean(times),
+        "repeats": repeats,
+    }
+
+
+def benchmark_loader(
+    path: str, input_size: int = 256, repeats: int = 3, warmup: int = 1
+) -> List[Dict]:
+    """
+    Throughput of LoadDataSet.__getitem__ over a whole dataset.
+
+    Parameters:
+    - path (str): Dataset folder (write_dataset).
+    - input_size (int): Size the samples are resized to (default is 256).
+    - repeats (int): Timed passes over the dataset (default is 3).
+    - warmup (int): Untimed passes, which also warm the page cache (default is 1).
+
+    Returns:
+    List[Dict]: One result for the float pipeline (get_train_transform) and one for the
+    uint8 pipeline (get_uint8_transform, uint8=True), with "samples_per_second".
+    """
+    from module import image_loader
+
+    pipelines = (
+        (
+            "float32",
+            image_loader.get_train_transform(
+                input_size, input_size, horizontal_flip=0.0, vertical_flip=0.0
+            ),
+            False,
+        ),
+        ("uint8", image_loader.get_uint8_transform(input_size, input_size), True),
+    )
+    results = []
+    for name, transform, uint8 in pipelines:
+        dataset = image_loader.LoadDataSet(
+            path, input_size, input_size, transform=transform, uint8=uint8
+        )
+
+        def run() -> None:
+            for i in range(len(dataset)):
+                dataset[i]
+
+        timing = measure(run, repeats, warmup)
+        results.append(
+            {
+                "benchmark": "loader_getitem",
+                "params": {
+                    "pipeline": name,
+                    "input_size": input_size,
+                    "samples": len(dataset),
+                },
+                **timing,
+                "samples_per_second": len(dataset) / timing["median_seconds"],
+            }
+        )
+    return results
+
+
+def benchmark_unet(
+    resolutions: Sequence[int] = (128, 256, 512),
+    batch_sizes: Sequence[int] = (1, 4),
+    repeats: int = 3,
+    warmup: int = 1,
+    device: str = "cpu",
+) -> List[Dict]:
+    """
+    Forward and forward+backward latency of the UNet.
+
+    Parameters:
+    - resolutions (Sequence[int]): Input heights and widths (default is 128, 256 and 512).
+    - batch_sizes (Sequence[int]): Batch sizes (default is 1 and 4).
+    - repeats (int): Timed calls per configuration (default is 3).
+    - warmup (int): Untimed calls per configuration (default is 1).
+    - device (str): Device of the model (default is "cpu").
+
+    Returns:
+    List[Dict]: One "unet_forward" (inference mode) and one "unet_forward_backward" result
+    per resolution and batch size, with "samples_per_second".
+    """
+    import torch
+
+    from module import machine_learning_model
+
+    model = machine_learning_model.UNet(3, 1).to(device)
+    results = []
+    for resolution in resolutions:
+        for batch_size in batch_sizes:
+            batch = torch.randn(batch_size, 3, resolution, resolution, device=device)
+
+            def forward() -> None:
+                model.eval()
+                with torch.inference_mode():
+                    model(batch)
+
+            def forward_backward() -> None:
+                model.train()
+                model.zero_grad(set_to_none=True)
+                model(batch).mean().backward()
+
+            for name, fn in (
+                ("unet_forward", forward),
+                ("unet_forward_backward", forward_backward),
+            ):
+                timing = measure(fn, repeats, warmup)
+                results.append(
+                    {
+                        "benchmark": name,
+                        "params": {
+                            "resolution": resolution,
+                            "batch_size": batch_size,
+                            "device": device,
+                        },
+                        **timing,
+                        "samples_per_second": batch_size / timing["median_seconds"],
+                    }
+                )
+    return results
+
+
+def benchmark_analysis(
+    grain_counts: Sequence[int] = (50, 200, 800),
+    image_size: int = 1024,
+    perlite_fraction: float = 0.3,
+    repeats: int = 3,
+    warmup: int = 1,
+) -> List[Dict]:
+    """
+    Time of exec_ferrite_analysis and exec_perlite_analysis against the number of grains.
+
+    Parameters:
+    - grain_counts (Sequence[int]): Numbers of Voronoi grains (default is 50, 200 and 800).
+    - image_size (int): Height and width of the masks (default is 1024).
+    - perlite_fraction (float): Target area fraction of perlite (default is 0.3).
+    - repeats (int): Timed calls per mask (default is 3).
+    - warmup (int): Untimed calls per mask (default is 1).
+
+    Returns:
+    List[Dict]: One result per phase and grain count, with the number of detected contours.
+
+    The figures are drawn with the Agg backend and closed, and the printed statistics are discarded.
+    """
+    import matplotlib.pyplot as plt
+
+    from module import tissue_analysis
+
+    plt.switch_backend("Agg")
+
+    def quiet(fn: Callable[[], None]) -> Callable[[], None]:
+        def run() -> None:
+            with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+                # Aggでplt.show()を呼ぶと出る警告を無視する
+                warnings.simplefilter("ignore")
+                fn()
+            plt.close("all")
+
+        return run
+
+    results = []
+    for n_grains in grain_counts:
+        _, mask = synthetic_microstructure(image_size, n_grains, perlite_fraction)
+        mask = cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR)
+        phases = (
+            (
+                "ferrite",
+                lambda: tissue_analysis.exec_ferrite_analysis(mask),
+                tissue_analysis.analyze_ferrite(mask),
+            ),
+            (
+                "perlite",
+                lambda: tissue_analysis.exec_perlite_analysis(mask),
+                tissue_analysis.analyze_perlite(mask),
+            ),
+        )
+        for phase, fn, stats in phases:
+            results.append(
+                {
+                    "benchmark": f"exec_{phase}_analysis",
+                    "params": {"grains": n_grains, "image_size": image_size},
+                    **measure(quiet(fn), repeats, warmup),
+                    "contours": len(stats["area"]),
+                }
+            )
+    return results
+
+
+def measure_import(module_name: str) -> Tuple[float, List[str]]:
+    """
+    Import a module in a new interpreter.
+
+    Parameters:
+    - module_name (str): Module to import, e.g. "module.batch_analysis".
+
+    Returns:
+    Tuple[float, List[str]]: Seconds spent in the import statement and the HEAVY_MODULES it loaded.
+    """
+    code = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        f"import {module_name}\n"
+        "seconds = time.perf_counter() - start\n"
+        f"heavy = [name for name in {HEAVY_MODULES!r} if name in sys.modules]\n"
+        "print(json.dumps([seconds, heavy]))\n"
+    )
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=root,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    seconds, heavy = json.loads(output.strip().splitlines()[-1])
+    return seconds, heavy
+
+
+def benchmark_imports(
+    modules: Sequence[str] = ANALYSIS_IMPORTS,
+    budget: float = ANALYSIS_IMPORT_BUDGET_SECONDS,
+    repeats: int = 5,
+) -> List[Dict]:
+    """
+    Import time of the analysis-only path against its budget.
+
+    Parameters:
+    - modules (Sequence[str]): Modules imported by an analysis worker (default is ANALYSIS_IMPORTS).
+    - budget (float): Maximum median import time in seconds (default is ANALYSIS_IMPORT_BUDGET_SECONDS).
+    - repeats (int): Fresh interpreters per module (default is 5).
+
+    Returns:
+    List[Dict]: One "import" result per module with the HEAVY_MODULES it pulled in and
+    "within_budget", which is False when the median is over budget or a heavy module was loaded.
+    """
+    results = []
+    for module_name in modules:
+        times = []
+        heavy = set()
+        for _ in range(repeats):
+            seconds, loaded = measure_import(module_name)
+            times.append(seconds)
+            heavy.update(loaded)
+        median = statistics.median(times)
+        results.append(
+            {
+                "benchmark": "import",
+                "params": {"module": module_name},
+                "median_seconds": median,
+                "min_seconds": min(times),
+                "mean_seconds": statistics.fmean(times),
+                "repeats": repeats,
+                "budget_seconds": budget,
+                "heavy_modules": sorted(heavy),
+                "within_budget": median <= budget and not heavy,
+            }
+        )
+    return results
+
+
+def environment() -> Dict:
+    """
+    Description of the machine and library versions the benchmarks ran with.
+
+    Returns:
+    Dict: Platform, CPU count, torch threads and library versions.
+    """
+    import torch
+
+    return {
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+    }
+
+
+def result_key(result: Dict) -> str:
+    """
+    Identifier of a benchmark result that is the same across runs.
+
+    Parameters:
+    - result (Dict): Benchmark result.
+
+    Returns:
+    str: Benchmark name and sorted parameters.
+    """
+    return result["benchmark"] + json.dumps(result["params"], sort_keys=True)
+
+
+def compare(baseline: Dict, current: Dict, tolerance: float = 0.2) -> List[Dict]:
+    """
+    Compare two benchmark reports.
+
+    Parameters:
+    - baseline (Dict): Earlier report (the JSON written by main).
+    - current (Dict): New report.
+    - tolerance (float): Relative slowdown of the median time counted as a regression (default is 0.2).
+
+    Returns:
+    List[Dict]: For every benchmark in both reports, the median times, their ratio
+    (current / baseline) and whether it is a regression.
+    """
+    baseline_results = {result_key(result): result for result in baseline["results"]}
+    rows = []
+    for result in current["results"]:
+        reference = baseline_results.get(result_key(result))
+        if reference is None:
+            continue
+        ratio = result["median_seconds"] / reference["median_seconds"]
+        rows.append(
+            {
+                "benchmark": result["benchmark"],
+                "params": result["params"],
+                "baseline_seconds": reference["median_seconds"],
+                "current_seconds": result["median_seconds"],
+                "ratio": ratio,
+                "regression": ratio > 1.0 + tolerance,
+            }
+        )
+    return rows
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the data loader, the UNet and the tissue analysis on synthetic microstructures."
+    )
+    parser.add_argument("-o", "--output", required=True, help="result JSON path")
+    parser.add_argument("--suite", nargs="+", choices=SUITES, default=list(SUITES))
+    parser.add_argument("--baseline", help="earlier result JSON to compare with")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="relative slowdown reported as a regression",
+    )
+    parser.add_argument(
+        "--fail-on-regression",
+        action="store_true",
+        help="exit with an error when a benchmark regressed",
+    )
+    parser.add_argument(
+        "--data-dir", help="keep the synthetic dataset here (default: temporary)"
+    )
+    parser.add_argument("--samples", type=int, default=16)
+    parser.add_argument("--sample-size", type=int, default=512)
+    parser.add_argument("--input-size", type=int, default=256)
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[128, 256, 512])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--grain-counts", type=int, nargs="+", default=[50, 200, 800])
+    parser.add_argument("--analysis-size", type=int, default=1024)
+    parser.add_argument("--perlite-fraction", type=float, default=0.3)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--threads", type=int, help="torch intra-op threads")
+    parser.add_argument(
+        "--import-budget",
+        type=float,
+        default=ANALYSIS_IMPORT_BUDGET_SECONDS,
+        help="maximum import time in seconds of the analysis-only modules",
+    )
+    args = parser.parse_args(argv)
+
+    if args.threads is not None:
+        import torch
+
+        torch.set_num_threads(args.threads)
+
+    results = []
+    if "loader" in args.suite:
+        with contextlib.ExitStack() as stack:
+            data_dir = args.data_dir
+            if data_dir is None:
+                data_dir = stack.enter_context(tempfile.TemporaryDirectory())
+            write_dataset(
+                data_dir,
+                args.samples,
+                args.sample_size,
+                n_grains=200,
+                perlite_fraction=args.perlite_fraction,
+            )
+            results.extend(
+                benchmark_loader(data_dir, args.input_size, args.repeats, args.warmup)
+            )
+    if "unet" in args.suite:
+        results.extend(
+            benchmark_unet(
+                args.resolutions, args.batch_sizes, args.repeats, args.warmup
+            )
+        )
+    if "analysis" in args.suite:
+        results.extend(
+            benchmark_analysis(
+                args.grain_counts,
+                args.analysis_size,
+                args.perlite_fraction,
+                args.repeats,
+                args.warmup,
+            )
+        )
+    if "imports" in args.suite:
+        results.extend(
+            benchmark_imports(budget=args.import_budget, repeats=max(args.repeats, 3))
+        )
+
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "environment": environment(),
+        "results": results,
+    }
+    for result in results:
+        print(
+            f"{result['benchmark']} {json.dumps(result['params'], sort_keys=True)}: "
+            f"{result['median_seconds'] * 1000:.2f} ms"
+        )
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"-> {args.output}")
+
+    over_budget = [
+        result for result in results if not result.get("within_budget", True)
+    ]
+    for result in over_budget:
+        print(
+            f"import {result['params']['module']}: {result['median_seconds']:.3f}s "
+            f"(budget {result['budget_seconds']}s), heavy modules: {result['heavy_modules']}"
+        )
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        rows = compare(baseline, report, args.tolerance)
+        for row in rows:
+            flag = "  REGRESSION" if row["regression"] else ""
+            print(
+                f"{row['benchmark']} {json.dumps(row['params'], sort_keys=True)}: "
+                f"x{row['ratio']:.2f}{flag}"
+            )
+        regressions = [row for row in rows if row["regression"]]
+        if regressions and args.fail_on_regression:
+            raise SystemExit(
+                f"{len(regressions)} benchmarks regressed by more than {args.tolerance:.0%}"
+            )
+    if over_budget:
+        raise SystemExit("the analysis-only imports are over their budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+import inspect
+import os
+import queue
+import re
+import shutil
+import threading
+from contextlib import nullcontext
+from typing import Any, Dict, List, Optional, Union
+
+import numpy as np
+import torch
+
+BEST_MODEL_FILE = "best_model.pth"
+LAST_CHECKPOINT_FILE = "last_checkpoint.pth"
+EPOCH_FILE_PATTERN = re.compile(r"^checkpoint_(\d+)\.pth$")
+
+
+def snapshot(state: Any) -> Any:
+    """
+    Copy a (nested) checkpoint to CPU memory.
+
+    Parameters:
+    - state (Any): Checkpoint, e.g. {"state_dict": model.state_dict(), "optimizer": ...}.
+
+    Returns:
+    Any: Same structure with every tensor detached and copied to the CPU, so training can
+    continue to update the original tensors while the copy is written.
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {key: snapshot(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+def save_atomic(state: Any, path: str) -> None:
+    """
+    Save a checkpoint with torch.save so that path is never left half written.
+
+    Parameters:
+    - state (Any): Checkpoint to save.
+    - path (str): Destination path.
+
+    Returns:
+    None
+    """
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    try:
+        with open(tmp_path, "wb") as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _link_atomic(source: str, path: str) -> None:
+    # 同じ内容をもう一度書かずにハードリンクを張り替える (失敗したらコピー)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _numpy_globals() -> List[Any]:
+    # ノートブックのチェックポイントに含まれるnumpyのスカラー(valid_loss_minなど)の復元に必要なもの
+    globals_ = [np.float64(0).__reduce__()[0], np.dtype]
+    for scalar_type in (np.float64, np.float32, np.int64, np.int32):
+        globals_.append(type(np.dtype(scalar_type)))
+    return globals_
+
+
+def load_checkpoint(
+    path: str,
+    map_location: Union[str, torch.device] = "cpu",
+    mmap: bool = True,
+    trusted: bool = False,
+) -> Dict:
+    """
+    Load a checkpoint for inference.
+
+    Parameters:
+    - path (str): Path to the checkpoint.
+    - map_location (str | torch.device): Device of the loaded tensors (default is "cpu").
+    - mmap (bool): Memory-map the file instead of reading it (default is True).
+    - trusted (bool): Use the full unpickler, which can run arbitrary code from the file.
+      Only for checkpoints of a trusted source that the weights-only unpickler rejects
+      (default is False).
+
+    Returns:
+    Dict: Checkpoint. With mmap the tensors are backed by the file and only the pages that are
+    used (e.g. "state_dict", not "optimizer") are read.
+
+    The weights-only unpickler allows the numpy scalars of the checkpoints saved by the
+    notebook (valid_loss_min) and nothing else; other objects raise pickle.UnpicklingError.
+    """
+    options = {}
+    # mmap は torch 2.1 以降
+    if mmap and "mmap" in inspect.signature(torch.load).parameters:
+        options["mmap"] = True
+    if trusted:
+        return torch.load(
+            path, map_location=map_location, weights_only=False, **options
+        )
+    # safe_globals は torch 2.5 以降 (それより前はnumpyのスカラーを含むファイルを読めない)
+    safe_globals = getattr(torch.serialization, "safe_globals", None)
+    context = nullcontext() if safe_globals is None else safe_globals(_numpy_globals())
+    with context:
+        return torch.load(path, map_location=map_location, weights_only=True, **options)
+
+
+class CheckpointManager:
+    """
+    Asynchronous, atomic checkpoint writer with a retention policy.
+
+    Parameters:
+    - directory (str): Directory of the checkpoints.
+    - keep_last (int): Number of epoch checkpoints (checkpoint_NNNN.pth) kept (default is 3).
+
+    save() copies the checkpoint to CPU memory and returns; a background thread serializes it
+    to checkpoint_NNNN.pth through a temporary file and os.replace, points last_checkpoint.pth
+    (and best_model.pth when it is the best so far) at it, and deletes older epoch files.
+    At most one checkpoint waits behind the one being written, so save() blocks only when the
+    writer is two checkpoints behind. Call close() (or use it as a context manager) to wait
+    for the pending writes; errors of the writer are raised there or by the next save().
+    """
+
+    def __init__(self, directory: str, keep_last: int = 3) -> None:
+        if keep_last < 1:
+            raise ValueError(f"keep_last must be >= 1, got {keep_last}")
+        self.directory = directory
+        self.keep_last = keep_last
+        os.makedirs(directory, exist_ok=True)
+        self._queue: "queue.Queue" = queue.Queue(maxsize=1)
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def path(self, name: str) -> str:
+        """
+        Path of a file in the checkpoint directory.
+
+        Parameters:
+        - name (str): File name.
+
+        Returns:
+        str: Path of the file.
+        """
+        return os.path.join(self.directory, name)
+
+    def latest(self) -> Optional[str]:
+        """
+        Path of the latest complete checkpoint.
+
+        Returns:
+        str | None: last_checkpoint.pth, or None when nothing was saved yet.
+        """
+        path = self.path(LAST_CHECKPOINT_FILE)
+        return path if os.path.exists(path) else None
+
+    def epoch_files(self) -> List[str]:
+        """
+        Epoch checkpoints in the directory, oldest first.
+
+        Returns:
+        List[str]: Paths of the checkpoint_NNNN.pth files.
+        """
+        names = [
+            name
+            for name in os.listdir(self.directory)
+            if EPOCH_FILE_PATTERN.match(name)
+        ]
+        names.sort(key=lambda name: int(EPOCH_FILE_PATTERN.match(name).group(1)))
+        return [self.path(name) for name in names]
+
+    def save(self, state: Dict, epoch: int, is_best: bool = False) -> None:
+        """
+        Queue a checkpoint for writing.
+
+        Parameters:
+        - state (Dict): Checkpoint (tensors may live on any device and keep changing after the call).
+        - epoch (int): Epoch number of the file name.
+        - is_best (bool): Also make it best_model.pth (default is False).
+
+        Returns:
+        None
+        """
+        self._raise_error()
+        self._queue.put((snapshot(state), epoch, is_best))
+
+    def wait(self) -> None:
+        """
+        Wait until every queued checkpoint is written.
+
+        Returns:
+        None
+        """
+        self._queue.join()
+        self._raise_error()
+
+    def close(self) -> None:
+        """
+        Wait for the pending writes and stop the writer thread.
+
+        Returns:
+        None
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def __enter__(self) -> "CheckpointManager":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("checkpoint writer failed") from error
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except BaseException as error:
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def _write(self, state: Dict, epoch: int, is_best: bool) -> None:
+        path = self.path(f"checkpoint_{epoch:04d}.pth")
+        save_atomic(state, path)
+        _link_atomic(path, self.path(LAST_CHECKPOINT_FILE))
+        if is_best:
+            _link_atomic(path, self.path(BEST_MODEL_FILE))
+        # best_model.pth と last_checkpoint.pth はハードリンクなので古いファイルを消しても残る
+        for old_path in self.epoch_files()[: -self.keep_last]:
+            os.remove(old_path)
@@ -0,0 +1,301 @@
+import argparse
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+MANIFEST_VERSION = 1
+SPLIT_NAMES = ("train", "val")
+
+
+def sample_sort_key(sample_id: str) -> Tuple[int, ...]:
+    """
+    Sort key of a "N-M" sample folder name (same order as LoadDataSet).
+
+    Parameters:
+    - sample_id (str): Sample folder name.
+
+    Returns:
+    Tuple[int, ...]: Tuple of the integers in the folder name.
+    """
+    return tuple(map(int, sample_id.split("-")))
+
+
+def file_digest(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Compute the SHA-256 digest of a file.
+
+    Parameters:
+    - path (str): Path to the file.
+    - chunk_size (int): Read size in bytes (default is 1 MiB).
+
+    Returns:
+    str: Hex digest of the file content.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def describe_file(root: str, relpath: str, with_hash: bool = True) -> Dict:
+    """
+    Describe a file of the dataset.
+
+    Parameters:
+    - root (str): Path to the dataset folder.
+    - relpath (str): Path of the file relative to root.
+    - with_hash (bool): Whether to compute the SHA-256 digest (default is True).
+
+    Returns:
+    Dict: {"path", "size", "mtime_ns"[, "sha256"]} of the file.
+    """
+    path = os.path.join(root, relpath)
+    stat = os.stat(path)
+    entry = {"path": relpath, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if with_hash:
+        entry["sha256"] = file_digest(path)
+    return entry
+
+
+def scan_sample(root: str, sample_id: str, with_hash: bool = True) -> Dict:
+    """
+    Scan one "N-M" sample folder.
+
+    Parameters:
+    - root (str): Path to the dataset folder.
+    - sample_id (str): Sample folder name.
+    - with_hash (bool): Whether to compute the SHA-256 digest of the files (default is True).
+
+    Returns:
+    Dict: {"image": file entry, "mask": file entry or None} of the sample.
+
+    As in LoadDataSet, the first file of images/ and the last file of masks/ are used.
+    """
+    image_folder = os.path.join(sample_id, "images")
+    mask_folder = os.path.join(sample_id, "masks")
+    image_name = os.listdir(os.path.join(root, image_folder))[0]
+    mask_names = os.listdir(os.path.join(root, mask_folder))
+
+    mask = None
+    if mask_names:
+        mask = describe_file(root, os.path.join(mask_folder, mask_names[-1]), with_hash)
+    return {
+        "image": describe_file(root, os.path.join(image_folder, image_name), with_hash),
+        "mask": mask,
+    }
+
+
+def load_manifest(manifest_path: str) -> Dict:
+    """
+    Load a dataset manifest.
+
+    Parameters:
+    - manifest_path (str): Path to the manifest JSON file.
+
+    Returns:
+    Dict: Manifest with "version", "root", "with_hash" and "samples" (sample id -> entry).
+    """
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError(
+            f"Unsupported manifest version {manifest.get('version')} in {manifest_path}"
+        )
+    return manifest
+
+
+def save_manifest(manifest: Dict, manifest_path: str) -> None:
+    """
+    Save a dataset manifest atomically.
+
+    Parameters:
+    - manifest (Dict): Manifest to save.
+    - manifest_path (str): Path to the manifest JSON file.
+
+    Returns:
+    None
+    """
+    directory = os.path.dirname(os.path.abspath(manifest_path))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+
+def build_manifest(root: str, with_hash: bool = True) -> Dict:
+    """
+    Build the manifest of a dataset folder.
+
+    Parameters:
+    - root (str): Path to the dataset folder (the "N-M" folders are directly under it).
+    - with_hash (bool): Whether to compute the SHA-256 digest of the files (default is True).
+
+    Returns:
+    Dict: Manifest of the dataset.
+    """
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "root": os.path.abspath(root),
+        "with_hash": with_hash,
+        "samples": {},
+    }
+    refresh_manifest(manifest)
+    return manifest
+
+
+def refresh_manifest(
+    manifest: Dict, rescan_changed: bool = False, prune: bool = True
+) -> Tuple[List[str], List[str]]:
+    """
+    Incrementally update a manifest with the current content of its dataset folder.
+
+    Parameters:
+    - manifest (Dict): Manifest to update in place.
+    - rescan_changed (bool): Also re-scan known samples whose files changed size or mtime (default is False).
+    - prune (bool): Remove samples whose folder no longer exists (default is True).
+
+    Returns:
+    Tuple[List[str], List[str]]: Ids of the added or re-scanned samples and ids of the removed samples.
+
+    Only the top-level folder is listed; known samples are not touched unless rescan_changed is set.
+    """
+    root = manifest["root"]
+    with_hash = manifest["with_hash"]
+    samples = manifest["samples"]
+    folders = set(os.listdir(root))
+
+    updated = sorted(folders - set(samples), key=sample_sort_key)
+    if rescan_changed:
+        for sample_id in sorted(folders & set(samples), key=sample_sort_key):
+            if _sample_changed(root, samples[sample_id]):
+                updated.append(sample_id)
+    for sample_id in updated:
+        samples[sample_id] = scan_sample(root, sample_id, with_hash)
+
+    removed = []
+    if prune:
+        removed = sorted(set(samples) - folders, key=sample_sort_key)
+        for sample_id in removed:
+            del samples[sample_id]
+
+    manifest["samples"] = {
+        sample_id: samples[sample_id]
+        for sample_id in sorted(samples, key=sample_sort_key)
+    }
+    return updated, removed
+
+
+def _sample_changed(root: str, sample: Dict) -> bool:
+    for entry in (sample["image"], sample["mask"]):
+        if entry is None:
+            continue
+        try:
+            stat = os.stat(os.path.join(root, entry["path"]))
+        except FileNotFoundError:
+            return True
+        if stat.st_size != entry["size"] or stat.st_mtime_ns != entry["mtime_ns"]:
+            return True
+    return False
+
+
+def split_of(sample_id: str, val_ratio: float, seed: int = 0) -> str:
+    """
+    Deterministically assign a sample to the train or validation split.
+
+    Parameters:
+    - sample_id (str): Sample folder name.
+    - val_ratio (float): Fraction of samples assigned to the validation split.
+    - seed (int): Seed of the assignment (default is 0).
+
+    Returns:
+    str: "train" or "val".
+
+    The assignment only depends on (seed, sample_id), so adding samples never moves existing ones.
+    """
+    digest = hashlib.sha256(f"{seed}:{sample_id}".encode()).digest()
+    u = int.from_bytes(digest[:8], "big") / 2**64
+    return "val" if u < val_ratio else "train"
+
+
+def write_splits(
+    manifest: Dict, split_dir: str, val_ratio: float = 0.25, seed: int = 0
+) -> Dict[str, List[str]]:
+    """
+    Write the train/val split files of a manifest.
+
+    Parameters:
+    - manifest (Dict): Dataset manifest.
+    - split_dir (str): Directory of the split files (train.txt and val.txt).
+    - val_ratio (float): Fraction of samples assigned to the validation split (default is 0.25).
+    - seed (int): Seed of the assignment (default is 0).
+
+    Returns:
+    Dict[str, List[str]]: Sample ids of each split.
+    """
+    splits = {name: [] for name in SPLIT_NAMES}
+    for sample_id in manifest["samples"]:
+        splits[split_of(sample_id, val_ratio, seed)].append(sample_id)
+
+    os.makedirs(split_dir, exist_ok=True)
+    for name, sample_ids in splits.items():
+        with open(os.path.join(split_dir, f"{name}.txt"), "w") as f:
+            f.write("".join(f"{sample_id}\n" for sample_id in sample_ids))
+    return splits
+
+
+def load_split(split_path: str) -> List[str]:
+    """
+    Load the sample ids of a split file.
+
+    Parameters:
+    - split_path (str): Path to the split file (one sample id per line).
+
+    Returns:
+    List[str]: Sample ids of the split.
+    """
+    with open(split_path, "r") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Build or refresh the manifest of a LoadDataSet folder."
+    )
+    parser.add_argument("root", help="dataset folder containing the N-M folders")
+    parser.add_argument("manifest", help="path to the manifest JSON file")
+    parser.add_argument("--no-hash", action="store_true", help="skip SHA-256 digests")
+    parser.add_argument(
+        "--rescan-changed",
+        action="store_true",
+        help="re-scan known samples whose files changed",
+    )
+    parser.add_argument("--split-dir", help="write train.txt/val.txt to this folder")
+    parser.add_argument("--val-ratio", type=float, default=0.25)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if os.path.exists(args.manifest):
+        manifest = load_manifest(args.manifest)
+        manifest["root"] = os.path.abspath(args.root)
+        updated, removed = refresh_manifest(manifest, args.rescan_changed)
+    else:
+        manifest = build_manifest(args.root, with_hash=not args.no_hash)
+        updated, removed = list(manifest["samples"]), []
+    save_manifest(manifest, args.manifest)
+    print(
+        f"{len(manifest['samples'])} samples "
+        f"({len(updated)} scanned, {len(removed)} removed) -> {args.manifest}"
+    )
+
+    if args.split_dir is not None:
+        splits = write_splits(manifest, args.split_dir, args.val_ratio, args.seed)
+        print(
+            f"train: {len(splits['train'])}, val: {len(splits['val'])} -> {args.split_dir}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import argparse
+import os
+from typing import List, Optional
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+# torchrun などのランチャーが設定する環境変数
+RENDEZVOUS_VARIABLES = ("MASTER_ADDR", "MASTER_PORT", "RANK", "WORLD_SIZE")
+
+
+def init_process_group(
+    backend: str = "gloo",
+    rank: Optional[int] = None,
+    world_size: Optional[int] = None,
+    master_addr: Optional[str] = None,
+    master_port: Optional[int] = None,
+) -> None:
+    """
+    Join the process group of a data-parallel training.
+
+    Parameters:
+    - backend (str): torch.distributed backend, "gloo" for CPU nodes (default is "gloo").
+    - rank (int, optional): Global rank of this process (default is $RANK).
+    - world_size (int, optional): Number of processes over all nodes (default is $WORLD_SIZE).
+    - master_addr (str, optional): Rendezvous host, the address of node 0 (default is $MASTER_ADDR).
+    - master_port (int, optional): Rendezvous port (default is $MASTER_PORT).
+
+    Returns:
+    None
+    """
+    if master_addr is not None:
+        os.environ["MASTER_ADDR"] = master_addr
+    if master_port is not None:
+        os.environ["MASTER_PORT"] = str(master_port)
+    rank = int(os.environ["RANK"]) if rank is None else rank
+    world_size = int(os.environ["WORLD_SIZE"]) if world_size is None else world_size
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+
+
+def _worker(
+    local_rank: int,
+    nproc_per_node: int,
+    node_rank: int,
+    nnodes: int,
+    master_addr: str,
+    master_port: int,
+    threads: Optional[int],
+    trainer_argv: List[str],
+) -> None:
+    from module import trainer
+
+    # プロセスごとのスレッド数 × プロセス数がコア数を超えないようにする
+    if threads is not None:
+        torch.set_num_threads(threads)
+    init_process_group(
+        "gloo",
+        rank=node_rank * nproc_per_node + local_rank,
+        world_size=nnodes * nproc_per_node,
+        master_addr=master_addr,
+        master_port=master_port,
+    )
+    try:
+        trainer.main(trainer_argv)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(
+    trainer_argv: List[str],
+    nproc_per_node: int,
+    nnodes: int = 1,
+    node_rank: int = 0,
+    master_addr: str = "127.0.0.1",
+    master_port: int = 29500,
+    threads: Optional[int] = None,
+) -> None:
+    """
+    Start the training processes of this node.
+
+    Parameters:
+    - trainer_argv (List[str]): Arguments of module.trainer given to every process.
+    - nproc_per_node (int): Processes started on this node.
+    - nnodes (int): Number of nodes (default is 1).
+    - node_rank (int): Index of this node, 0 for the node at master_addr (default is 0).
+    - master_addr (str): Rendezvous host (default is "127.0.0.1", single node).
+    - master_port (int): Rendezvous port (default is 29500).
+    - threads (int, optional): torch threads per process (default is cores / nproc_per_node).
+
+    Returns:
+    None
+    """
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // nproc_per_node)
+    mp.spawn(
+        _worker,
+        args=(
+            nproc_per_node,
+            node_rank,
+            nnodes,
+            master_addr,
+            master_port,
+            threads,
+            trainer_argv,
+        ),
+        nprocs=nproc_per_node,
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Data-parallel UNet training on CPU nodes (gloo backend). "
+        "Arguments after -- are passed to module.trainer."
+    )
+    parser.add_argument("--nproc-per-node", type=int, default=2)
+    parser.add_argument("--nnodes", type=int, default=1)
+    parser.add_argument("--node-rank", type=int, default=0)
+    parser.add_argument("--master-addr", default="127.0.0.1")
+    parser.add_argument("--master-port", type=int, default=29500)
+    parser.add_argument("--threads", type=int, help="torch threads per process")
+    parser.add_argument("trainer_args", nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+
+    trainer_argv = args.trainer_args
+    if trainer_argv and trainer_argv[0] == "--":
+        trainer_argv = trainer_argv[1:]
+
+    # torchrunで起動された場合はこのプロセスがそのままワーカーになる
+    if all(name in os.environ for name in RENDEZVOUS_VARIABLES):
+        from module import trainer
+
+        init_process_group("gloo")
+        try:
+            trainer.main(trainer_argv)
+        finally:
+            dist.destroy_process_group()
+        return
+
+    launch(
+        trainer_argv,
+        args.nproc_per_node,
+        nnodes=args.nnodes,
+        node_rank=args.node_rank,
+        master_addr=args.master_addr,
+        master_port=args.master_port,
+        threads=args.threads,
+    )
+
+
+if __name__ == "__main__":
+    main()
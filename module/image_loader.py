@@ -1,12 +1,21 @@
 import os
 
-from skimage import io, transform
-from PIL import Image
 import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import Tensor
 from torch.utils.data import Dataset
-import albumentations as alb
-from albumentations.pytorch import ToTensorV2
-from typing import Optional, Tuple
+from typing import TYPE_CHECKING, Optional, Tuple, Union
+
+from module import dataset_manifest, instrumentation, sample_cache
+
+# albumentations, skimage, PILは読み込みに時間がかかるので使うときに読み込む
+if TYPE_CHECKING:
+    import albumentations as alb
+
+# alb.Normalizeに渡す値(albumentations.augmentations.transforms.Normalizeのデフォルトの値)
+NORMALIZE_MEAN = (0.485, 0.456, 0.406)
+NORMALIZE_STD = (0.229, 0.224, 0.225)
 
 
 def get_train_transform(
@@ -14,7 +23,7 @@ def get_train_transform(
     image_width: int,
     horizontal_flip: float = 0.25,
     vertical_flip: float = 0.25,
-) -> alb.Compose:
+) -> "alb.Compose":
     """
     Returns the image data augmentation transformation for training.
 
@@ -35,13 +44,15 @@ def get_train_transform(
     - Apply vertical flipping with the given probability.
     - Convert the image to PyTorch tensor format.
     """
+    import albumentations as alb
+    from albumentations.pytorch import ToTensorV2
 
     return alb.Compose(
         [
             # リサイズ(元画像ですでにしているが)
             alb.Resize(image_height, image_width),
             # 正規化(こちらの細かい値はalbumentations.augmentations.transforms.Normalizeのデフォルトの値を適用)
-            alb.Normalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)),
+            alb.Normalize(mean=NORMALIZE_MEAN, std=NORMALIZE_STD),
             # 水平フリップ（pはフリップする確率）
             alb.HorizontalFlip(p=horizontal_flip),
             # 垂直フリップ
@@ -51,6 +62,111 @@ def get_train_transform(
     )
 
 
+def get_uint8_transform(image_height: int, image_width: int) -> "alb.Compose":
+    """
+    Returns the transformation of the uint8 input pipeline.
+
+    Parameters:
+    - image_height (int): Height of the resized image.
+    - image_width (int): Width of the resized image.
+
+    Returns:
+    alb.Compose: Resize and conversion to uint8 tensors (image (3, H, W), mask (1, H, W)).
+
+    Normalization and flips are left to BatchTransform, which applies them to whole
+    batches after the transfer to the device.
+    """
+    import albumentations as alb
+    from albumentations.pytorch import ToTensorV2
+
+    return alb.Compose(
+        [
+            alb.Resize(image_height, image_width),
+            ToTensorV2(transpose_mask=True),
+        ]
+    )
+
+
+class BatchTransform:
+    """
+    Batched normalization and random flips of uint8 batches (same result as get_train_transform).
+
+    Parameters:
+    - image_height (int): Expected height of the images.
+    - image_width (int): Expected width of the images.
+    - horizontal_flip (float): Probability of horizontal flipping of each sample (default is 0.25).
+    - vertical_flip (float): Probability of vertical flipping of each sample (default is 0.25).
+    - device (str | torch.device, optional): Device to move the batches to (default is None, keep the device).
+
+    Returns:
+    Tuple[Tensor, Tensor]: float32 normalized images (N, 3, H, W) and float32 masks in [0, 1] (N, 1, H, W).
+
+    Used with LoadDataSet(..., uint8=True) and get_uint8_transform, the DataLoader workers only
+    move uint8 data and the normalization runs once per batch on the device.
+    """
+
+    def __init__(
+        self,
+        image_height: int,
+        image_width: int,
+        horizontal_flip: float = 0.25,
+        vertical_flip: float = 0.25,
+        device: Union[None, str, torch.device] = None,
+    ) -> None:
+        self.image_height = image_height
+        self.image_width = image_width
+        self.horizontal_flip = horizontal_flip
+        self.vertical_flip = vertical_flip
+        self.device = device
+        # alb.Normalize(max_pixel_value=255) と同じ (x - mean * 255) / (std * 255)
+        self.mean = torch.tensor(NORMALIZE_MEAN).reshape(1, 3, 1, 1) * 255.0
+        self.std = torch.tensor(NORMALIZE_STD).reshape(1, 3, 1, 1) * 255.0
+
+    @instrumentation.timed("loader.batch_transform")
+    def __call__(
+        self, images: Tensor, masks: Optional[Tensor] = None
+    ) -> Tuple[Tensor, Optional[Tensor]]:
+        if self.device is not None:
+            images = images.to(self.device, non_blocking=True)
+            if masks is not None:
+                masks = masks.to(self.device, non_blocking=True)
+        device = images.device
+
+        images = images.float()
+        if images.shape[-2:] != (self.image_height, self.image_width):
+            images = F.interpolate(
+                images,
+                size=(self.image_height, self.image_width),
+                mode="bilinear",
+                align_corners=False,
+            )
+        images = (images - self.mean.to(device)) / self.std.to(device)
+
+        if masks is not None:
+            if masks.ndim == 3:
+                masks = masks.unsqueeze(1)
+            masks = masks.float()
+            if masks.shape[-2:] != (self.image_height, self.image_width):
+                masks = F.interpolate(
+                    masks,
+                    size=(self.image_height, self.image_width),
+                    mode="bilinear",
+                    align_corners=False,
+                )
+            masks = masks / 255.0
+
+        # サンプルごとにフリップするかを決める
+        n = images.shape[0]
+        for probability, dim in ((self.horizontal_flip, 3), (self.vertical_flip, 2)):
+            if probability <= 0:
+                continue
+            flip = (torch.rand(n, device=device) < probability).reshape(n, 1, 1, 1)
+            images = torch.where(flip, images.flip(dim), images)
+            if masks is not None:
+                masks = torch.where(flip, masks.flip(dim), masks)
+        return images, masks
+
+
 class LoadDataSet(Dataset):
     """
     Dataset class for loading images and masks.
@@ -60,11 +176,20 @@ class LoadDataSet(Dataset):
     - image_height (int): Height of the resized image.
     - image_width (int): Width of the resized image.
     - transform (optional): Image transformation pipeline (default is None).
+    - cache_dir (str, optional): Directory of the decoded sample cache (default is None).
+    - manifest (str, optional): Path to a dataset manifest (default is None).
+    - split (str, optional): Path to a split file restricting the samples (default is None).
+    - uint8 (bool): Keep the mask as uint8 in [0, 255] like the image, for get_uint8_transform
+      and BatchTransform (default is False).
 
     Returns:
     Tuple[np.ndarray, np.ndarray]: Tuple containing the image and its corresponding mask.
 
     This class loads images and masks from the specified dataset folder.
+    When cache_dir is given, every image and mask is decoded and resized once into a
+    memory-mapped cache (see module.sample_cache) and later epochs read from it.
+    When manifest is given, the sample files are taken from it (see module.dataset_manifest)
+    and the dataset folder is never listed.
     """
 
     def __init__(
@@ -73,13 +198,29 @@ class LoadDataSet(Dataset):
         image_height: int,
         image_width: int,
         transform: Optional[callable] = None,
+        cache_dir: Optional[str] = None,
+        manifest: Optional[str] = None,
+        split: Optional[str] = None,
+        uint8: bool = False,
     ) -> None:
         self.path = path
-        folders = os.listdir(path)
-        self.folders = sorted(folders, key=lambda x: tuple(map(int, x.split("-"))))
+        self.uint8 = uint8
+        self.manifest = None
+        if manifest is not None:
+            self.manifest = dataset_manifest.load_manifest(manifest)
+            folders = list(self.manifest["samples"])
+        else:
+            folders = os.listdir(path)
+        if split is not None:
+            split_ids = set(dataset_manifest.load_split(split))
+            folders = [folder for folder in folders if folder in split_ids]
+        self.folders = sorted(folders, key=dataset_manifest.sample_sort_key)
         self.image_height = image_height
         self.image_width = image_width
         self.transforms = transform  # get_train_transform(256, 256)
+        self.cache = None
+        if cache_dir is not None:
+            self.build_cache(cache_dir)
 
     def __len__(self) -> int:
         return len(self.folders)
@@ -94,20 +235,101 @@ class LoadDataSet(Dataset):
         Returns:
         Tuple[np.ndarray, np.ndarray]: Tuple containing the image and its corresponding mask.
         """
+        if self.cache is not None:
+            with instrumentation.timer("loader.cache_read"):
+                img, mask = self.cache[idx]
+                if not self.uint8:
+                    mask = sample_cache.mask_from_uint8(mask)
+        else:
+            img, mask = self.load_sample(idx)
+            if self.uint8:
+                mask = sample_cache.mask_to_uint8(mask)
+
+        # 前処理をするためにひとつにまとめる
+        with instrumentation.timer("loader.transform"):
+            augmented = self.transforms(image=img, mask=mask)
+        img = augmented["image"]
+        mask = augmented["mask"]
+        return (img, mask)
+
+    def sample_paths(self, idx: int) -> Tuple[str, Optional[str]]:
+        """
+        Get the image path and the mask path of the specified index.
+
+        Parameters:
+        - idx (int): Index of the data item.
+
+        Returns:
+        Tuple[str, Optional[str]]: Path to the image file and path to the mask file (None when there is no mask).
+        """
+        if self.manifest is not None:
+            sample = self.manifest["samples"][self.folders[idx]]
+            image_path = os.path.join(self.path, sample["image"]["path"])
+            mask_path = None
+            if sample["mask"] is not None:
+                mask_path = os.path.join(self.path, sample["mask"]["path"])
+            return image_path, mask_path
+
         image_folder = os.path.join(self.path, self.folders[idx], "images/")
         mask_folder = os.path.join(self.path, self.folders[idx], "masks/")
         image_path = os.path.join(image_folder, os.listdir(image_folder)[0])
+        mask_files = os.listdir(mask_folder)
+        mask_path = None
+        if mask_files:
+            mask_path = os.path.join(mask_folder, mask_files[-1])
+        return image_path, mask_path
 
-        img = io.imread(image_path)
-        img = self.conv_2D_to_3Darray(img)
+    def load_sample(self, idx: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Decode the image and mask at the specified index from the source files.
 
-        mask = self.get_mask(mask_folder, self.image_height, self.image_width)
+        Parameters:
+        - idx (int): Index of the data item.
 
-        # 前処理をするためにひとつにまとめる
-        augmented = self.transforms(image=img, mask=mask)
-        img = augmented["image"]
-        mask = augmented["mask"]
-        return (img, mask)
+        Returns:
+        Tuple[np.ndarray, np.ndarray]: RGB uint8 image at its original size and the resized mask.
+        """
+        image_path, mask_path = self.sample_paths(idx)
+
+        with instrumentation.timer("loader.decode_image"):
+            from skimage import io
+
+            img = io.imread(image_path)
+            img = self.conv_2D_to_3Darray(img)
+
+        if mask_path is None:
+            mask = np.zeros((self.image_height, self.image_width, 1), dtype=bool)
+        else:
+            with instrumentation.timer("loader.decode_mask"):
+                mask = self.read_mask(mask_path, self.image_height, self.image_width)
+        return img, mask
+
+    def build_cache(self, cache_dir: str) -> int:
+        """
+        Create or refresh the decoded sample cache and read samples from it.
+
+        Parameters:
+        - cache_dir (str): Directory of the sample cache.
+
+        Returns:
+        int: Number of samples that were (re)decoded.
+        """
+        # マニフェストの記録ではなく実際のファイルのサイズ・更新時刻を使う
+        # (マニフェスト作成後に編集された画像を古いキャッシュから返さないため)
+        fingerprints = []
+        for idx in range(len(self.folders)):
+            paths = [path for path in self.sample_paths(idx) if path is not None]
+            fingerprints.append([sample_cache.source_stat(path) for path in paths])
+
+        def decode(idx: int) -> Tuple[np.ndarray, np.ndarray]:
+            img, mask = self.load_sample(idx)
+            img = sample_cache.resize_image(img, self.image_height, self.image_width)
+            return img, sample_cache.mask_to_uint8(mask)
+
+        cache = sample_cache.SampleCache(cache_dir, self.image_height, self.image_width)
+        n_decoded = cache.sync(self.folders, fingerprints, decode)
+        self.cache = cache
+        return n_decoded
 
     def conv_2D_to_3Darray(self, arr: np.ndarray) -> np.ndarray:
         """
@@ -119,6 +341,8 @@ class LoadDataSet(Dataset):
         Returns:
         np.ndarray: Converted 3D array.
         """
+        from PIL import Image
+
         image = Image.fromarray(arr)
         image = image.convert("RGB")
         arr = np.asarray(image, np.uint8)
@@ -134,6 +358,8 @@ class LoadDataSet(Dataset):
         Returns:
         np.ndarray: Converted 2D array.
         """
+        from PIL import Image
+
         image = Image.fromarray(arr)
         image = image.convert("L")
         arr = np.asarray(image, np.uint8)
@@ -153,11 +379,31 @@ class LoadDataSet(Dataset):
         """
         mask = np.zeros((IMG_HEIGHT, IMG_WIDTH, 1), dtype=bool)
         # print(f'len(os.listdir(mask_folder)): {len(os.listdir(mask_folder))}')
-        for mask_ in os.listdir(mask_folder):
-            mask_ = io.imread(os.path.join(mask_folder, mask_))
-            mask_ = self.conv_3D_to_2Darray(mask_)
-            mask_ = transform.resize(mask_, (IMG_HEIGHT, IMG_WIDTH))
-            mask_ = np.expand_dims(mask_, axis=-1)
-            mask = mask_
+        # 最後のマスクだけが使われるので, それ以外は読み込まない
+        mask_files = os.listdir(mask_folder)
+        if mask_files:
+            mask = self.read_mask(
+                os.path.join(mask_folder, mask_files[-1]), IMG_HEIGHT, IMG_WIDTH
+            )
+
+        return mask
+
+    def read_mask(self, mask_path: str, IMG_HEIGHT: int, IMG_WIDTH: int) -> np.ndarray:
+        """
+        Read and resize one mask file.
+
+        Parameters:
+        - mask_path (str): Path to the mask file.
+        - IMG_HEIGHT (int): Height of the image.
+        - IMG_WIDTH (int): Width of the image.
+
+        Returns:
+        np.ndarray: Mask data.
+        """
+        from skimage import io, transform
 
+        mask = io.imread(mask_path)
+        mask = self.conv_3D_to_2Darray(mask)
+        mask = transform.resize(mask, (IMG_HEIGHT, IMG_WIDTH))
+        mask = np.expand_dims(mask, axis=-1)
         return mask
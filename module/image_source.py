@@ -0,0 +1,352 @@
+import os
+import resource
+import threading
+from collections import OrderedDict
+from typing import Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+TIFF_EXTENSIONS = (".tif", ".tiff", ".btf", ".tf8")
+# 既定のタイルキャッシュの上限 (256 MiB)
+DEFAULT_TILE_BUDGET = 256 * 1024 * 1024
+
+
+def peak_rss_bytes() -> int:
+    """
+    Peak resident set size of this process.
+
+    Returns:
+    int: Maximum RSS in bytes since the process started (getrusage).
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class TiffImageSource:
+    """
+    Read-only view of a (Big)TIFF image that decodes only the requested regions.
+
+    Parameters:
+    - path (str): Path to the TIFF file.
+    - level (int): Pyramid level, 0 being the full resolution (default is 0).
+    - series (int): Image series in the file (default is 0).
+    - tile_budget (int): Maximum bytes of decoded tiles kept in memory (default is DEFAULT_TILE_BUDGET).
+
+    Tiled and stripped files (compressed or not) are read tile by tile (strip by strip) with
+    an LRU cache of decoded tiles bounded by tile_budget. Uncompressed contiguous files are
+    memory-mapped instead, and the mapping is dropped whenever tile_budget bytes were read
+    through it so that its resident pages stay within the budget.
+
+    The object behaves like a read-only array for 2D slicing (source[y0:y1, x0:x1]), so it can
+    be passed as the image of tiled_inference.predict_tiled or predict_bands.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        level: int = 0,
+        series: int = 0,
+        tile_budget: int = DEFAULT_TILE_BUDGET,
+    ) -> None:
+        import tifffile
+
+        self.path = path
+        self.level = level
+        self.series = series
+        self.tile_budget = tile_budget
+        self._tiff = tifffile.TiffFile(path)
+        levels = self._tiff.series[series].levels
+        if not 0 <= level < len(levels):
+            raise ValueError(f"{path} has {len(levels)} levels, got level {level}")
+        self.levels = [tuple(image.shape) for image in levels]
+        self._page = levels[level].keyframe
+        page = self._page
+        if page.planarconfig != 1 and page.samplesperpixel > 1:
+            raise ValueError(f"Planar (separate) samples are not supported: {path}")
+        self.shape = tuple(levels[level].shape)
+        self.dtype = np.dtype(levels[level].dtype)
+        self.ndim = len(self.shape)
+        if self.ndim not in (2, 3):
+            raise ValueError(f"Expected a 2D or RGB image, got shape {self.shape}")
+        self.height, self.width = self.shape[:2]
+        self.channels = self.shape[2] if self.ndim == 3 else 1
+        # タイル(ストリップ)の大きさと並び
+        self.chunk_shape = tuple(page.chunks[:2])
+        self.chunk_grid = tuple(page.chunked[:2])
+
+        self.memmappable = bool(page.is_memmappable)
+        self._memmap = None
+        self._mapped_bytes = 0
+        self._cache: "OrderedDict[int, np.ndarray]" = OrderedDict()
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "TiffImageSource":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Close the file and free the cached tiles.
+
+        Returns:
+        None
+        """
+        self._memmap = None
+        self._cache.clear()
+        self._cache_bytes = 0
+        self._tiff.close()
+
+    def __len__(self) -> int:
+        return self.height
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > self.ndim or any(not isinstance(k, slice) for k in key):
+            raise TypeError(
+                "TiffImageSource only supports slicing, e.g. source[y0:y1, x0:x1]"
+            )
+        rows = key[0].indices(self.height)
+        columns = (
+            key[1].indices(self.width)
+            if len(key) > 1
+            else slice(None).indices(self.width)
+        )
+        if rows[2] != 1 or columns[2] != 1:
+            raise TypeError("TiffImageSource does not support slicing with a step")
+        region = self.read_region(
+            rows[0],
+            columns[0],
+            max(0, rows[1] - rows[0]),
+            max(0, columns[1] - columns[0]),
+        )
+        if len(key) > 2:
+            region = region[:, :, key[2]]
+        return region
+
+    def read_region(self, y: int, x: int, height: int, width: int) -> np.ndarray:
+        """
+        Read a rectangle of the image.
+
+        Parameters:
+        - y (int): Top of the region.
+        - x (int): Left of the region.
+        - height (int): Height of the region (clipped at the image border).
+        - width (int): Width of the region (clipped at the image border).
+
+        Returns:
+        np.ndarray: Region (h, w) or (h, w, C) in the dtype of the image.
+        """
+        y0, x0 = max(0, y), max(0, x)
+        y1, x1 = min(self.height, y + height), min(self.width, x + width)
+        shape = (max(0, y1 - y0), max(0, x1 - x0)) + self.shape[2:]
+        if self.memmappable:
+            return self._read_mapped(y0, x0, y1, x1, shape)
+
+        region = np.empty(shape, dtype=self.dtype)
+        if region.size == 0:
+            return region
+        chunk_h, chunk_w = self.chunk_shape
+        for row in range(y0 // chunk_h, (y1 - 1) // chunk_h + 1):
+            for column in range(x0 // chunk_w, (x1 - 1) // chunk_w + 1):
+                chunk = self._chunk(row * self.chunk_grid[1] + column)
+                cy, cx = row * chunk_h, column * chunk_w
+                ty0, tx0 = max(y0, cy), max(x0, cx)
+                ty1, tx1 = min(y1, cy + chunk_h), min(x1, cx + chunk_w)
+                region[ty0 - y0 : ty1 - y0, tx0 - x0 : tx1 - x0] = chunk[
+                    ty0 - cy : ty1 - cy, tx0 - cx : tx1 - cx
+                ]
+        return region
+
+    def _read_mapped(
+        self, y0: int, x0: int, y1: int, x1: int, shape: Tuple[int, ...]
+    ) -> np.ndarray:
+        import tifffile
+
+        with self._lock:
+            # 読んだ量が上限を超えたらマップし直して常駐ページを手放す
+            if self._memmap is None or self._mapped_bytes > self.tile_budget:
+                self._memmap = tifffile.memmap(
+                    self.path, series=self.series, level=self.level, mode="r"
+                ).reshape(self.shape)
+                self._mapped_bytes = 0
+            memmap = self._memmap
+            row_bytes = self.width * self.channels * self.dtype.itemsize
+            self._mapped_bytes += (y1 - y0) * row_bytes
+        region = np.empty(shape, dtype=self.dtype)
+        region[...] = memmap[y0:y1, x0:x1]
+        return region
+
+    def _chunk(self, index: int) -> np.ndarray:
+        with self._lock:
+            chunk = self._cache.get(index)
+            if chunk is not None:
+                self._cache.move_to_end(index)
+                return chunk
+            page = self._page
+            handle = self._tiff.filehandle
+            handle.seek(page.dataoffsets[index])
+            data = handle.read(page.databytecounts[index])
+        segment = page.decode(data, index, jpegtables=page.jpegtables)[0]
+        # 最後のストリップは短いことがある
+        chunk = segment.reshape((-1, self.chunk_shape[1]) + self.shape[2:])
+
+        with self._lock:
+            self._cache[index] = chunk
+            self._cache_bytes += chunk.nbytes
+            # 古いタイルから捨てて上限内に収める (最低1タイルは残す)
+            while self._cache_bytes > self.tile_budget and len(self._cache) > 1:
+                _, old = self._cache.popitem(last=False)
+                self._cache_bytes -= old.nbytes
+        return chunk
+
+    def regions(
+        self, region_size: Union[int, Tuple[int, int]], overlap: int = 0
+    ) -> Iterator[Tuple[int, int, np.ndarray]]:
+        """
+        Iterate over the image in row-major regions.
+
+        Parameters:
+        - region_size (int | Tuple[int, int]): Height and width of the regions.
+        - overlap (int): Pixels shared by neighbouring regions (default is 0).
+
+        Returns:
+        Iterator[Tuple[int, int, np.ndarray]]: (y, x, region) with regions clipped at the image border.
+        """
+        if isinstance(region_size, int):
+            region_size = (region_size, region_size)
+        region_h, region_w = region_size
+        if not 0 <= overlap < min(region_h, region_w):
+            raise ValueError(
+                f"overlap must be in [0, {min(region_h, region_w)}), got {overlap}"
+            )
+        for y in range(0, self.height, region_h - overlap):
+            for x in range(0, self.width, region_w - overlap):
+                yield y, x, self.read_region(y, x, region_h, region_w)
+                if x + region_w >= self.width:
+                    break
+            if y + region_h >= self.height:
+                break
+
+    def rows(self, row_height: int) -> Iterator[Tuple[int, np.ndarray]]:
+        """
+        Iterate over full-width horizontal bands.
+
+        Parameters:
+        - row_height (int): Height of the bands.
+
+        Returns:
+        Iterator[Tuple[int, np.ndarray]]: (y, band) from top to bottom.
+        """
+        for y in range(0, self.height, row_height):
+            yield y, self.read_region(y, 0, row_height, self.width)
+
+    def tiles(self) -> Iterator[Tuple[int, int, np.ndarray]]:
+        """
+        Iterate over the native tiles (strips) of the file in storage order.
+
+        Returns:
+        Iterator[Tuple[int, int, np.ndarray]]: (y, x, tile) clipped at the image border.
+        """
+        chunk_h, chunk_w = self.chunk_shape
+        yield from self.regions((chunk_h, chunk_w))
+
+
+def is_tiff(path: str) -> bool:
+    """
+    Whether a path is a TIFF file by its extension.
+
+    Parameters:
+    - path (str): Path.
+
+    Returns:
+    bool: True for .tif, .tiff, .btf and .tf8.
+    """
+    return path.lower().endswith(TIFF_EXTENSIONS)
+
+
+def level_for_scale(source: TiffImageSource, scale: float) -> int:
+    """
+    Coarsest pyramid level that still has at least the requested resolution.
+
+    Parameters:
+    - source (TiffImageSource): Opened image (any level).
+    - scale (float): Wanted size relative to level 0, e.g. 0.25.
+
+    Returns:
+    int: Index of the level.
+    """
+    full_width = source.levels[0][1]
+    best = 0
+    for index, shape in enumerate(source.levels):
+        if shape[1] >= full_width * scale:
+            best = index
+    return best
+
+
+def write_tiled_tiff(
+    path: str,
+    bands: Iterator[Tuple[int, np.ndarray]],
+    shape: Tuple[int, ...],
+    dtype: Union[str, np.dtype] = np.uint8,
+    tile_size: int = 256,
+    compression: Optional[str] = "zlib",
+) -> None:
+    """
+    Write an image arriving as horizontal bands to a tiled BigTIFF without holding it in memory.
+
+    Parameters:
+    - path (str): Output path.
+    - bands (Iterator[Tuple[int, np.ndarray]]): (y, band) from top to bottom covering every row once.
+    - shape (Tuple[int, ...]): Shape of the whole image, (H, W) or (H, W, C).
+    - dtype (str | np.dtype): Data type (default is uint8).
+    - tile_size (int): Tile size of the file, a multiple of 16 (default is 256).
+    - compression (str, optional): tifffile compression (default is "zlib").
+
+    Returns:
+    None
+
+    Only one row of tiles is buffered.
+    """
+    import tifffile
+
+    height, width = shape[:2]
+
+    def tile_rows() -> Iterator[np.ndarray]:
+        # 行を溜めてタイル1行分になったらタイルに切り分ける
+        buffer: List[np.ndarray] = []
+        buffered = 0
+        next_y = 0
+        for y, band in bands:
+            if y != next_y:
+                raise ValueError(
+                    f"Bands must be contiguous, expected y={next_y}, got {y}"
+                )
+            next_y += band.shape[0]
+            buffer.append(band)
+            buffered += band.shape[0]
+            while buffered >= tile_size or (next_y == height and buffered > 0):
+                rows = np.concatenate(buffer) if len(buffer) > 1 else buffer[0]
+                current, rest = rows[:tile_size], rows[tile_size:]
+                buffer = [rest] if len(rest) else []
+                buffered = len(rest)
+                yield from _split_row(current, tile_size)
+
+    def _split_row(rows: np.ndarray, size: int) -> Iterator[np.ndarray]:
+        for x in range(0, width, size):
+            tile = np.zeros((size, size) + shape[2:], dtype=dtype)
+            part = rows[:, x : x + size]
+            tile[: part.shape[0], : part.shape[1]] = part
+            yield tile
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with tifffile.TiffWriter(path, bigtiff=True) as writer:
+        writer.write(
+            tile_rows(),
+            shape=tuple(shape),
+            dtype=dtype,
+            tile=(tile_size, tile_size),
+            compression=compression,
+        )
@@ -0,0 +1,713 @@
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import cv2
+import numpy as np
+
+from config import setting
+from module import batch_segmentation, instrumentation
+
+DEFAULT_PORT = 8765
+DEFAULT_MAX_BATCH = 8
+DEFAULT_MAX_WAIT_MS = 10.0
+DEFAULT_MAX_QUEUE = 32
+# 受け付けるリクエスト本体の上限 (64 MiB)
+MAX_BODY_BYTES = 64 * 1024 * 1024
+# 直近のスループットを求める時間幅 (秒)
+THROUGHPUT_WINDOW = 60.0
+HTTP_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+class ServerStats:
+    """
+    Latency and throughput statistics of the server.
+
+    Parameters:
+    - reservoir_size (int): Number of recent request latencies kept for the quantiles
+      (default is instrumentation.RESERVOIR_SIZE).
+    """
+
+    def __init__(self, reservoir_size: int = instrumentation.RESERVOIR_SIZE) -> None:
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.rejected = 0
+        self.errors = 0
+        self.batches = 0
+        self.batch_tiles = 0
+        self.compute_seconds = 0.0
+        self._latencies: Deque[float] = deque(maxlen=reservoir_size)
+        self._finished: Deque[float] = deque()
+
+    def record_request(self, seconds: float) -> None:
+        """
+        Record a completed request.
+
+        Parameters:
+        - seconds (float): Time from receiving the request to sending the response.
+
+        Returns:
+        None
+        """
+        now = time.perf_counter()
+        self.requests += 1
+        self._latencies.append(seconds)
+        self._finished.append(now)
+        while self._finished and self._finished[0] < now - THROUGHPUT_WINDOW:
+            self._finished.popleft()
+
+    def record_batch(self, tiles: int, seconds: float) -> None:
+        """
+        Record a forward pass.
+
+        Parameters:
+        - tiles (int): Tiles in the batch.
+        - seconds (float): Time of the model call.
+
+        Returns:
+        None
+        """
+        self.batches += 1
+        self.batch_tiles += tiles
+        self.compute_seconds += seconds
+
+    def snapshot(self, queue_depth: int, max_queue: int) -> Dict:
+        """
+        Current statistics (the /stats response).
+
+        Parameters:
+        - queue_depth (int): Requests waiting for the model.
+        - max_queue (int): Capacity of the queue.
+
+        Returns:
+        Dict: Counters, throughput (overall and over the last THROUGHPUT_WINDOW seconds),
+        latency mean and p50/p90/p99, and the mean batch size.
+        """
+        uptime = time.perf_counter() - self.started
+        latencies = sorted(self._latencies)
+        latency = {
+            "mean_seconds": sum(latencies) / len(latencies) if latencies else 0.0
+        }
+        for q in instrumentation.QUANTILES:
+            index = min(
+                len(latencies) - 1, max(0, int(round(q * (len(latencies) - 1))))
+            )
+            latency[f"p{int(q * 100)}_seconds"] = latencies[index] if latencies else 0.0
+        window = min(uptime, THROUGHPUT_WINDOW)
+        return {
+            "uptime_seconds": uptime,
+            "requests": self.requests,
+            "rejected": self.rejected,
+            "errors": self.errors,
+            "queue_depth": queue_depth,
+            "max_queue": max_queue,
+            "throughput_rps": self.requests / uptime if uptime > 0 else 0.0,
+            "recent_throughput_rps": (
+                len(self._finished) / window if window > 0 else 0.0
+            ),
+            "latency": latency,
+            "batches": self.batches,
+            "mean_batch_size": self.batch_tiles / self.batches if self.batches else 0.0,
+            "compute_seconds": self.compute_seconds,
+        }
+
+
+class _Job:
+    def __init__(self, image: np.ndarray, tile_size: int, stride: int) -> None:
+        from module import tiled_inference
+
+        self.image = image
+        height, width = image.shape[:2]
+        self.ys = tiled_inference.axis_origins(height, tile_size, stride)
+        self.xs = tiled_inference.axis_origins(width, tile_size, stride)
+        self.origins = [(y, x) for y in self.ys for x in self.xs]
+        self.next_tile = 0
+        self.remaining = len(self.origins)
+        self.out = np.zeros((height, width), dtype=np.float32)
+        self.future: Optional[asyncio.Future] = None
+
+
+class DynamicBatcher:
+    """
+    Coalesce the tiles of concurrent requests into batches for one loaded model.
+
+    Parameters:
+    - model (nn.Module): Loaded segmentation model.
+    - tile_size (int): Tile size of the tiled inference (default is 256).
+    - overlap (int): Tile overlap (default is 32).
+    - max_batch (int): Maximum tiles per forward pass (default is DEFAULT_MAX_BATCH).
+    - max_wait (float): Seconds to wait for more requests before running an incomplete batch
+      (default is DEFAULT_MAX_WAIT_MS / 1000).
+    - max_queue (int): Requests waiting for the model before new ones are rejected (default is DEFAULT_MAX_QUEUE).
+    - device (str): Device of the model (default is "cpu").
+    - precision (str): "float32" or "bfloat16" autocast (default is "float32").
+    - channels_last (bool): Run in channels_last order (default is False).
+
+    Requests are split into the tiles of tiled_inference.predict_tiled, and a batch takes
+    tiles from the oldest requests first, so one request may span batches and one batch may
+    serve several requests. The model runs on a single worker thread, off the event loop.
+    The results are identical to predict_tiled.
+    """
+
+    def __init__(
+        self,
+        model,
+        tile_size: int = 256,
+        overlap: int = 32,
+        max_batch: int = DEFAULT_MAX_BATCH,
+        max_wait: float = DEFAULT_MAX_WAIT_MS / 1000.0,
+        max_queue: int = DEFAULT_MAX_QUEUE,
+        device: str = "cpu",
+        precision: str = "float32",
+        channels_last: bool = False,
+    ) -> None:
+        from module import tiled_inference
+
+        if not 0 <= overlap < tile_size:
+            raise ValueError(f"overlap must be in [0, {tile_size}), got {overlap}")
+        self.model = model
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.device = device
+        self.precision = precision
+        self.channels_last = channels_last
+        self.stats = ServerStats()
+        self._window = tiled_inference.blend_window(tile_size, overlap)
+        self._weights_2d = np.outer(self._window, self._window)
+        self._queue: Optional[asyncio.Queue] = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    @property
+    def queue_depth(self) -> int:
+        return 0 if self._queue is None else self._queue.qsize()
+
+    def submit(self, image: np.ndarray) -> asyncio.Future:
+        """
+        Queue an image for segmentation.
+
+        Parameters:
+        - image (np.ndarray): Image (H, W) or (H, W, 3) in RGB order.
+
+        Returns:
+        asyncio.Future: Resolves to the float32 probability map (H, W).
+
+        Raises asyncio.QueueFull when max_queue requests are already waiting.
+        """
+        if self._queue is None:
+            raise RuntimeError("DynamicBatcher.run is not running")
+        job = _Job(image, self.tile_size, self.tile_size - self.overlap)
+        job.future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(job)
+        return job.future
+
+    async def run(self) -> None:
+        """
+        Form and run batches until cancelled.
+
+        Returns:
+        None
+        """
+        loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self.model.eval()
+        active: Deque[_Job] = deque()
+        while True:
+            if not active:
+                active.append(await self._queue.get())
+            # 最大バッチサイズになるか待ち時間が過ぎるまで後続のリクエストを集める
+            deadline = loop.time() + self.max_wait
+            while self._available(active) < self.max_batch:
+                if not self._queue.empty():
+                    active.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    active.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            batch = self._take(active)
+            try:
+                finished = await loop.run_in_executor(
+                    self._executor, self._compute, batch
+                )
+            except Exception as error:
+                failed = {id(job): job for job, _, _ in batch}
+                for job in failed.values():
+                    if not job.future.done():
+                        job.future.set_exception(error)
+                active = deque(job for job in active if id(job) not in failed)
+                continue
+            for job in finished:
+                if not job.future.done():
+                    job.future.set_result(job.out)
+
+    def _available(self, active: Deque[_Job]) -> int:
+        return sum(len(job.origins) - job.next_tile for job in active)
+
+    def _take(self, active: Deque[_Job]) -> List[Tuple[_Job, int, int]]:
+        batch = []
+        while active and len(batch) < self.max_batch:
+            job = active[0]
+            count = min(self.max_batch - len(batch), len(job.origins) - job.next_tile)
+            for y, x in job.origins[job.next_tile : job.next_tile + count]:
+                batch.append((job, y, x))
+            job.next_tile += count
+            if job.next_tile == len(job.origins):
+                active.popleft()
+        return batch
+
+    def _compute(self, batch: List[Tuple[_Job, int, int]]) -> List[_Job]:
+        from module import tiled_inference
+
+        tile_size = self.tile_size
+        start = time.perf_counter()
+        tiles = tiled_inference.normalize_tiles(
+            np.stack(
+                [
+                    tiled_inference.extract_tile(job.image, y, x, tile_size)
+                    for job, y, x in batch
+                ]
+            )
+        )
+        probabilities = tiled_inference.predict_batch(
+            self.model, tiles, self.device, self.precision, self.channels_last
+        )
+        self.stats.record_batch(len(batch), time.perf_counter() - start)
+        instrumentation.count("server.tiles", len(batch))
+
+        finished = []
+        for (job, y, x), probability in zip(batch, probabilities):
+            height, width = job.out.shape
+            h = min(tile_size, height - y)
+            w = min(tile_size, width - x)
+            job.out[y : y + h, x : x + w] += (
+                probability[:h, :w] * self._weights_2d[:h, :w]
+            )
+            job.remaining -= 1
+            if job.remaining == 0:
+                # predict_tiled と同じ正規化
+                weight_y = tiled_inference.axis_weights(height, job.ys, self._window)
+                weight_x = tiled_inference.axis_weights(width, job.xs, self._window)
+                for y0 in range(0, height, tile_size):
+                    y1 = min(y0 + tile_size, height)
+                    job.out[y0:y1] /= (
+                        weight_y[y0:y1, np.newaxis] * weight_x[np.newaxis, :]
+                    )
+                job.image = None
+                finished.append(job)
+        return finished
+
+
+class InferenceServer:
+    """
+    Local HTTP/1.1 server around a DynamicBatcher.
+
+    Parameters:
+    - batcher (DynamicBatcher): Batcher of the loaded model.
+    - max_body (int): Largest accepted request body in bytes (default is MAX_BODY_BYTES).
+
+    Endpoints:
+    - POST /segment: body is an encoded image (PNG, JPEG, TIFF, BMP). Responds with the
+      predicted mask as a PNG (probability scaled to 0-255, or 0/255 with ?threshold=p), and
+      the X-Foreground-Fraction, X-Mean-Probability and X-Latency-Seconds headers.
+      With ?format=json only those values are returned as JSON.
+    - GET /stats: ServerStats.snapshot as JSON.
+    - GET /health: {"status": "ok"}.
+
+    When the queue of the batcher is full the server answers 503 with Retry-After instead of
+    accepting more work, before reading the request body, and closes the connection.
+    """
+
+    def __init__(self, batcher: DynamicBatcher, max_body: int = MAX_BODY_BYTES) -> None:
+        self.batcher = batcher
+        self.max_body = max_body
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """
+        Serve the requests of one connection (keep-alive).
+
+        Parameters:
+        - reader (asyncio.StreamReader): Connection input.
+        - writer (asyncio.StreamWriter): Connection output.
+
+        Returns:
+        None
+        """
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self._respond(writer, 400, b"header too large\n", close=True)
+                    break
+                started = time.perf_counter()
+                lines = head.decode("latin-1").split("\r\n")
+                try:
+                    method, target, version = lines[0].split(" ", 2)
+                except ValueError:
+                    await self._respond(writer, 400, b"bad request line\n", close=True)
+                    break
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                close = headers.get("connection", "").lower() == "close" or (
+                    version == "HTTP/1.0"
+                    and headers.get("connection", "").lower() != "keep-alive"
+                )
+                try:
+                    length = int(headers.get("content-length", "0") or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await self._respond(
+                        writer, 400, b"bad content-length\n", close=True
+                    )
+                    break
+                if length > self.max_body:
+                    await self._respond(writer, 413, b"body too large\n", close=True)
+                    break
+                if (
+                    method == "POST"
+                    and urlsplit(target).path == "/segment"
+                    and self.batcher.queue_depth >= self.batcher.max_queue
+                ):
+                    # 本体を読んでデコードする前に断る (読まない本体が残るので接続は閉じる)
+                    self.batcher.stats.rejected += 1
+                    await self._respond(
+                        writer,
+                        503,
+                        b"queue full, retry later\n",
+                        {"Retry-After": "1"},
+                        close=True,
+                    )
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                status, content, extra = await self._route(
+                    method, target, body, started
+                )
+                await self._respond(writer, status, content, extra, close)
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(
+        self, method: str, target: str, body: bytes, started: float
+    ) -> Tuple[int, bytes, Dict[str, str]]:
+        url = urlsplit(target)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        if url.path == "/health":
+            return 200, _json({"status": "ok"}), _JSON_HEADERS
+        if url.path == "/stats":
+            snapshot = self.batcher.stats.snapshot(
+                self.batcher.queue_depth, self.batcher.max_queue
+            )
+            return 200, _json(snapshot), _JSON_HEADERS
+        if url.path != "/segment":
+            return 404, b"not found\n", {}
+        if method != "POST":
+            return 405, b"use POST\n", {"Allow": "POST"}
+        try:
+            threshold = float(query["threshold"]) if "threshold" in query else None
+        except ValueError:
+            return 400, b"threshold must be a number\n", {}
+
+        loop = asyncio.get_running_loop()
+        try:
+            # デコードとエンコードも既定のスレッドプールで行いイベントループを止めない
+            image = await loop.run_in_executor(
+                None, batch_segmentation.decode_image, body
+            )
+        except ValueError as error:
+            return 400, f"{error}\n".encode(), {}
+        try:
+            future = self.batcher.submit(image)
+        except asyncio.QueueFull:
+            self.batcher.stats.rejected += 1
+            return 503, b"queue full, retry later\n", {"Retry-After": "1"}
+        try:
+            probability = await future
+            content, summary = await loop.run_in_executor(
+                None, _encode_result, probability, threshold
+            )
+        except Exception as error:
+            self.batcher.stats.errors += 1
+            return 500, f"{error}\n".encode(), {}
+
+        seconds = time.perf_counter() - started
+        self.batcher.stats.record_request(seconds)
+        instrumentation.record("server.request", seconds)
+        summary["latency_seconds"] = seconds
+        if query.get("format") == "json":
+            return 200, _json(summary), _JSON_HEADERS
+        return (
+            200,
+            content,
+            {
+                "Content-Type": "image/png",
+                "X-Foreground-Fraction": repr(summary["foreground_fraction"]),
+                "X-Mean-Probability": repr(summary["mean_probability"]),
+                "X-Latency-Seconds": f"{seconds:.6f}",
+            },
+        )
+
+    async def _respond(
+        self,
+        writer: asyncio.StreamWriter,
+        status: int,
+        content: bytes,
+        headers: Optional[Dict[str, str]] = None,
+        close: bool = False,
+    ) -> None:
+        lines = [f"HTTP/1.1 {status} {HTTP_REASONS[status]}"]
+        headers = {"Content-Type": "text/plain", **(headers or {})}
+        headers["Content-Length"] = str(len(content))
+        headers["Connection"] = "close" if close else "keep-alive"
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + content)
+        await writer.drain()
+
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def _json(value: Dict) -> bytes:
+    return (json.dumps(value) + "\n").encode()
+
+
+def _encode_result(
+    probability: np.ndarray, threshold: Optional[float]
+) -> Tuple[bytes, Dict[str, float]]:
+    if threshold is None:
+        mask = batch_segmentation.probability_to_uint8(probability)
+    else:
+        mask = np.where(probability >= threshold, 255, 0).astype(np.uint8)
+    ok, encoded = cv2.imencode(".png", mask)
+    if not ok:
+        raise ValueError("Could not encode mask")
+    summary_threshold = 0.5 if threshold is None else threshold
+    return encoded.tobytes(), {
+        "height": probability.shape[0],
+        "width": probability.shape[1],
+        "foreground_fraction": float(
+            np.count_nonzero(probability >= summary_threshold) / probability.size
+        ),
+        "mean_probability": float(probability.mean()),
+    }
+
+
+async def serve(
+    batcher: DynamicBatcher,
+    host: str = "127.0.0.1",
+    port: int = DEFAULT_PORT,
+    ready: Optional[asyncio.Future] = None,
+) -> None:
+    """
+    Run the server until cancelled.
+
+    Parameters:
+    - batcher (DynamicBatcher): Batcher of the loaded model.
+    - host (str): Address to listen on (default is "127.0.0.1", local only).
+    - port (int): Port (default is DEFAULT_PORT; 0 picks a free port).
+    - ready (asyncio.Future, optional): Receives the port once the server listens (default is None).
+
+    Returns:
+    None
+    """
+    server = InferenceServer(batcher)
+    batching = asyncio.create_task(batcher.run())
+    listener = await asyncio.start_server(server.handle, host, port)
+    addresses = ", ".join(str(sock.getsockname()) for sock in listener.sockets)
+    print(f"serving on {addresses}")
+    if ready is not None:
+        ready.set_result(listener.sockets[0].getsockname()[1])
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        batching.cancel()
+
+
+async def _post(host: str, port: int, path: str, body: bytes) -> Tuple[int, bytes]:
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(
+        (
+            f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode()
+        + body
+    )
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, content = response.partition(b"\r\n\r\n")
+    return int(head.split(b" ", 2)[1]), content
+
+
+async def load_test(
+    host: str,
+    port: int,
+    body: bytes,
+    requests: int = 64,
+    concurrency: int = 8,
+) -> Dict:
+    """
+    Send concurrent segmentation requests to a running server.
+
+    Parameters:
+    - host (str): Server address.
+    - port (int): Server port.
+    - body (bytes): Encoded image sent with every request.
+    - requests (int): Number of requests (default is 64).
+    - concurrency (int): Requests in flight at once (default is 8).
+
+    Returns:
+    Dict: Completed and rejected counts, throughput, and client-side latency p50/p90/p99.
+    """
+    latencies = []
+    statuses: Dict[int, int] = {}
+    remaining = iter(range(requests))
+
+    async def client() -> None:
+        for _ in remaining:
+            start = time.perf_counter()
+            status, _ = await _post(host, port, "/segment?format=json", body)
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+    latencies.sort()
+    result = {
+        "requests": requests,
+        "concurrency": concurrency,
+        "statuses": statuses,
+        "seconds": seconds,
+        "throughput_rps": len(latencies) / seconds,
+    }
+    for q in instrumentation.QUANTILES:
+        index = min(len(latencies) - 1, max(0, int(round(q * (len(latencies) - 1)))))
+        result[f"p{int(q * 100)}_seconds"] = latencies[index] if latencies else None
+    return result
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Local segmentation server batching concurrent requests for one loaded UNet (CPU by default)."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument(
+        "--checkpoint",
+        help="checkpoint path (default: checkpoint_path/UNet/best_model.pth of --config)",
+    )
+    parser.add_argument(
+        "--model", help="TorchScript model exported by module.model_export"
+    )
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--tile-size", type=int, default=256)
+    parser.add_argument("--overlap", type=int, default=32)
+    parser.add_argument(
+        "--max-batch",
+        type=int,
+        default=DEFAULT_MAX_BATCH,
+        help="maximum tiles per forward pass",
+    )
+    parser.add_argument(
+        "--max-wait-ms",
+        type=float,
+        default=DEFAULT_MAX_WAIT_MS,
+        help="wait this long for more requests before running an incomplete batch",
+    )
+    parser.add_argument(
+        "--max-queue",
+        type=int,
+        default=DEFAULT_MAX_QUEUE,
+        help="requests waiting for the model before answering 503",
+    )
+    parser.add_argument("--threads", type=int, help="torch intra-op threads")
+    parser.add_argument(
+        "--precision", choices=("float32", "bfloat16"), default="float32"
+    )
+    parser.add_argument("--channels-last", action="store_true")
+    parser.add_argument(
+        "--load-test",
+        metavar="IMAGE",
+        help="instead of serving, send IMAGE to the server at --host/--port and print the statistics",
+    )
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=8)
+    setting.add_argument(parser)
+    args = parser.parse_args(argv)
+
+    if args.load_test is not None:
+        with open(args.load_test, "rb") as f:
+            body = f.read()
+        result = asyncio.run(
+            load_test(args.host, args.port, body, args.requests, args.concurrency)
+        )
+        print(json.dumps(result, indent=2))
+        return
+
+    if args.threads is not None:
+        import torch
+
+        torch.set_num_threads(args.threads)
+    path = batch_segmentation.model_file(
+        args.checkpoint, args.model, setting.from_arguments(args)
+    )
+    model = batch_segmentation.load_model(
+        path,
+        exported=args.model is not None,
+        device=args.device,
+        channels_last=args.channels_last,
+    )
+    batcher = DynamicBatcher(
+        model,
+        tile_size=args.tile_size,
+        overlap=args.overlap,
+        max_batch=args.max_batch,
+        max_wait=args.max_wait_ms / 1000.0,
+        max_queue=args.max_queue,
+        device=args.device,
+        precision=args.precision,
+        channels_last=args.channels_last,
+    )
+    try:
+        asyncio.run(serve(batcher, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
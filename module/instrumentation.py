@@ -0,0 +1,464 @@
+import argparse
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+from typing import Callable, Dict, IO, Optional, Union
+
+# パーセンタイルの計算に残す各タイマーの直近の計測値の数
+RESERVOIR_SIZE = 10000
+QUANTILES = (0.5, 0.9, 0.99)
+PROMETHEUS_PREFIX = "tissue"
+
+_enabled = False
+_profiling = False
+_lock = threading.Lock()
+# 名前 -> [回数, 合計秒, 最大秒, 直近の計測値]
+_timings: Dict[str, list] = {}
+_counters: Dict[str, float] = {}
+_NULL_TIMER = nullcontext()
+
+
+def enable() -> None:
+    """
+    Start recording timers and counters in this process.
+
+    Returns:
+    None
+    """
+    global _enabled
+    _enabled = True
+
+
+def disable() -> None:
+    """
+    Stop recording (the recorded values are kept until reset).
+
+    Returns:
+    None
+    """
+    global _enabled
+    _enabled = False
+
+
+def enabled() -> bool:
+    """
+    Whether timers and counters are recorded.
+
+    Returns:
+    bool: True after enable().
+    """
+    return _enabled
+
+
+def reset() -> None:
+    """
+    Discard the recorded timers and counters.
+
+    Returns:
+    None
+    """
+    with _lock:
+        _timings.clear()
+        _counters.clear()
+
+
+def record(name: str, seconds: float) -> None:
+    """
+    Add one measured duration to a timer.
+
+    Parameters:
+    - name (str): Timer name, e.g. "train.forward".
+    - seconds (float): Duration.
+
+    Returns:
+    None
+    """
+    if not _enabled:
+        return
+    with _lock:
+        timing = _timings.get(name)
+        if timing is None:
+            timing = _timings[name] = [0, 0.0, 0.0, deque(maxlen=RESERVOIR_SIZE)]
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = max(timing[2], seconds)
+        timing[3].append(seconds)
+
+
+def count(name: str, value: float = 1) -> None:
+    """
+    Add to a counter.
+
+    Parameters:
+    - name (str): Counter name, e.g. "train.samples".
+    - value (float): Increment (default is 1).
+
+    Returns:
+    None
+    """
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+class _Timer:
+    __slots__ = ("name", "start", "label")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.label = None
+
+    def __enter__(self) -> "_Timer":
+        if _profiling:
+            # プロファイル中はChrome traceにも区間名を出す
+            import torch
+
+            self.label = torch.profiler.record_function(self.name)
+            self.label.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        record(self.name, time.perf_counter() - self.start)
+        if self.label is not None:
+            self.label.__exit__(*exc_info)
+
+
+def timer(name: str):
+    """
+    Context manager timing a block.
+
+    Parameters:
+    - name (str): Timer name, e.g. "loader.decode_image".
+
+    Returns:
+    ContextManager: Records the duration of the block. While disabled it is a shared no-op
+    context, so an instrumented block costs one function call and a flag check.
+    """
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(name)
+
+
+def timed(name: str) -> Callable:
+    """
+    Decorator timing every call of a function.
+
+    Parameters:
+    - name (str): Timer name.
+
+    Returns:
+    Callable: Decorator.
+    """
+
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Timer(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _quantile(values: list, q: float) -> float:
+    # 線形補間なしの最近傍順位
+    index = min(len(values) - 1, max(0, int(round(q * (len(values) - 1)))))
+    return values[index]
+
+
+def summary() -> Dict[str, Dict]:
+    """
+    Statistics of the recorded timers and counters.
+
+    Returns:
+    Dict[str, Dict]: "timers" maps each name to count, total_seconds, mean_seconds, max_seconds
+    and the p50/p90/p99 seconds of the last RESERVOIR_SIZE durations; "counters" maps each name to its value.
+    """
+    with _lock:
+        timings = {
+            name: (n, total, maximum, sorted(samples))
+            for name, (n, total, maximum, samples) in _timings.items()
+        }
+        counters = dict(_counters)
+    timers = {}
+    for name, (n, total, maximum, samples) in sorted(timings.items()):
+        stats = {
+            "count": n,
+            "total_seconds": total,
+            "mean_seconds": total / n,
+            "max_seconds": maximum,
+        }
+        for q in QUANTILES:
+            stats[f"p{int(q * 100)}_seconds"] = _quantile(samples, q)
+        timers[name] = stats
+    return {"timers": timers, "counters": dict(sorted(counters.items()))}
+
+
+def export_state() -> Dict:
+    """
+    Take the raw recorded values and reset them, e.g. to send them from a worker process.
+
+    Returns:
+    Dict: State accepted by merge_state.
+    """
+    with _lock:
+        state = {
+            "timings": {
+                name: (n, total, maximum, list(samples))
+                for name, (n, total, maximum, samples) in _timings.items()
+            },
+            "counters": dict(_counters),
+        }
+        _timings.clear()
+        _counters.clear()
+    return state
+
+
+def merge_state(state: Dict) -> None:
+    """
+    Add the values recorded by another process (export_state).
+
+    Parameters:
+    - state (Dict): State from export_state.
+
+    Returns:
+    None
+    """
+    with _lock:
+        for name, (n, total, maximum, samples) in state["timings"].items():
+            timing = _timings.get(name)
+            if timing is None:
+                timing = _timings[name] = [0, 0.0, 0.0, deque(maxlen=RESERVOIR_SIZE)]
+            timing[0] += n
+            timing[1] += total
+            timing[2] = max(timing[2], maximum)
+            timing[3].extend(samples)
+        for name, value in state["counters"].items():
+            _counters[name] = _counters.get(name, 0) + value
+
+
+def write_jsonl(output: Union[str, IO], labels: Optional[Dict] = None) -> None:
+    """
+    Append the current statistics as JSON lines (one line per timer and counter).
+
+    Parameters:
+    - output (str | file): Path of the file to append to, or an open text file.
+    - labels (Dict, optional): Fields added to every line, e.g. {"run": "train", "epoch": 3} (default is None).
+
+    Returns:
+    None
+    """
+    stats = summary()
+    common = {"time": time.time(), **(labels or {})}
+    lines = [
+        json.dumps({**common, "type": "timer", "name": name, **values})
+        for name, values in stats["timers"].items()
+    ]
+    lines += [
+        json.dumps({**common, "type": "counter", "name": name, "value": value})
+        for name, value in stats["counters"].items()
+    ]
+    text = "".join(line + "\n" for line in lines)
+    if isinstance(output, str):
+        with open(output, "a") as f:
+            f.write(text)
+    else:
+        output.write(text)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_text() -> str:
+    """
+    Current statistics in the Prometheus text exposition format.
+
+    Returns:
+    str: A summary metric "tissue_stage_seconds" with a "stage" label per timer and a counter
+    "tissue_events_total" with a "name" label per counter.
+    """
+    stats = summary()
+    seconds = f"{PROMETHEUS_PREFIX}_stage_seconds"
+    events = f"{PROMETHEUS_PREFIX}_events_total"
+    lines = [
+        f"# HELP {seconds} Duration of the instrumented stages.",
+        f"# TYPE {seconds} summary",
+    ]
+    for name, values in stats["timers"].items():
+        stage = _escape(name)
+        for q in QUANTILES:
+            value = values[f"p{int(q * 100)}_seconds"]
+            lines.append(f'{seconds}{{stage="{stage}",quantile="{q}"}} {value!r}')
+        lines.append(f'{seconds}_sum{{stage="{stage}"}} {values["total_seconds"]!r}')
+        lines.append(f'{seconds}_count{{stage="{stage}"}} {values["count"]}')
+    lines += [
+        f"# HELP {events} Instrumented event counters.",
+        f"# TYPE {events} counter",
+    ]
+    for name, value in stats["counters"].items():
+        lines.append(f'{events}{{name="{_escape(name)}"}} {float(value)!r}')
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path: str) -> None:
+    """
+    Write prometheus_text() to a file, replacing it atomically (node_exporter textfile collector).
+
+    Parameters:
+    - path (str): Output path, e.g. /var/lib/node_exporter/textfile/tissue.prom.
+
+    Returns:
+    None
+    """
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        f.write(prometheus_text())
+    os.replace(tmp_path, path)
+
+
+class StepProfiler:
+    """
+    torch.profiler over a window of steps, exported as a Chrome trace.
+
+    Parameters:
+    - trace_path (str, optional): Chrome trace output (open in chrome://tracing or Perfetto).
+      With None every method is a no-op (default is None).
+    - wait (int): Steps skipped before profiling (default is 5).
+    - warmup (int): Steps profiled but discarded (default is 2).
+    - active (int): Steps recorded in the trace (default is 5).
+    - record_shapes (bool): Record the input shapes of the operators (default is False).
+
+    Use it as a context manager around the loop and call step() after every step. While the
+    profiler records, the instrumentation timers also appear as named ranges in the trace.
+    """
+
+    def __init__(
+        self,
+        trace_path: Optional[str] = None,
+        wait: int = 5,
+        warmup: int = 2,
+        active: int = 5,
+        record_shapes: bool = False,
+    ) -> None:
+        self.trace_path = trace_path
+        self.profiler = None
+        if trace_path is None:
+            return
+        import torch
+
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(
+                wait=wait, warmup=warmup, active=active, repeat=1
+            ),
+            on_trace_ready=self._export,
+            record_shapes=record_shapes,
+        )
+
+    def _export(self, profiler) -> None:
+        directory = os.path.dirname(os.path.abspath(self.trace_path))
+        os.makedirs(directory, exist_ok=True)
+        profiler.export_chrome_trace(self.trace_path)
+
+    def __enter__(self) -> "StepProfiler":
+        global _profiling
+        if self.profiler is not None:
+            self.profiler.__enter__()
+            _profiling = True
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        global _profiling
+        if self.profiler is not None:
+            _profiling = False
+            self.profiler.__exit__(*exc_info)
+
+    def step(self) -> None:
+        """
+        Mark the end of a step.
+
+        Returns:
+        None
+        """
+        if self.profiler is not None:
+            self.profiler.step()
+
+
+def add_arguments(parser: argparse.ArgumentParser, profiler: bool = True) -> None:
+    """
+    Add the instrumentation options to a command line parser.
+
+    Parameters:
+    - parser (argparse.ArgumentParser): Parser of a CLI.
+    - profiler (bool): Also add the torch.profiler options (default is True).
+
+    Returns:
+    None
+    """
+    group = parser.add_argument_group("instrumentation")
+    group.add_argument(
+        "--metrics-jsonl", help="append per-stage timing statistics to this file"
+    )
+    group.add_argument(
+        "--metrics-prom", help="write per-stage timing statistics in Prometheus format"
+    )
+    if profiler:
+        group.add_argument(
+            "--profile-trace", help="write a torch.profiler Chrome trace of a few steps"
+        )
+        group.add_argument(
+            "--profile-steps",
+            type=int,
+            nargs=3,
+            default=[5, 2, 5],
+            metavar=("WAIT", "WARMUP", "ACTIVE"),
+        )
+
+
+def from_arguments(args: argparse.Namespace) -> StepProfiler:
+    """
+    Enable the instrumentation requested by the options of add_arguments.
+
+    Parameters:
+    - args (argparse.Namespace): Parsed options.
+
+    Returns:
+    StepProfiler: Profiler of the step loop (a no-op without --profile-trace).
+    """
+    trace_path = getattr(args, "profile_trace", None)
+    if args.metrics_jsonl or args.metrics_prom or trace_path:
+        enable()
+    if trace_path is None:
+        return StepProfiler()
+    wait, warmup, active = args.profile_steps
+    return StepProfiler(trace_path, wait=wait, warmup=warmup, active=active)
+
+
+def write_outputs(args: argparse.Namespace, labels: Optional[Dict] = None) -> None:
+    """
+    Write the statistics to the outputs of the options of add_arguments.
+
+    Parameters:
+    - args (argparse.Namespace): Parsed options.
+    - labels (Dict, optional): Fields added to every JSON line (default is None).
+
+    Returns:
+    None
+    """
+    if args.metrics_jsonl:
+        write_jsonl(args.metrics_jsonl, labels)
+    if args.metrics_prom:
+        write_prometheus(args.metrics_prom)
@@ -1,3 +1,6 @@
+from typing import Dict, Optional
+
+import torch
 from torch import nn, Tensor
 import torch.nn.functional as F
 
@@ -115,3 +118,147 @@ class IoU(nn.Module):
         IoU = (intersection + smooth) / (union + smooth)
 
         return IoU
+
+
+class MetricAccumulator:
+    """
+    Dataset-level segmentation metrics accumulated on the device of the predictions.
+
+    Parameters:
+    - threshold (float, optional): Probability at which predictions are binarized for precision/recall. Default: 0.5.
+    - smooth (float, optional): Smoothing factor of IoU and Dice (same as IoU and DiceLoss). Default: 1.
+    - sigmoid (bool, optional): Apply a sigmoid to the inputs first, as DiceBCELoss does. Default: False.
+
+    update() only adds to a small tensor of running sums, so no device sync happens per batch.
+    compute() reads the sums once and returns IoU, Dice, precision, recall and the BCE term of
+    DiceBCELoss over all pixels seen since the last reset(), instead of the mean of per-batch ratios.
+    """
+
+    # 累積する値の並び
+    FIELDS = (
+        "intersection",
+        "input_sum",
+        "target_sum",
+        "true_positive",
+        "false_positive",
+        "false_negative",
+        "bce_sum",
+        "pixels",
+        "loss_sum",
+        "batches",
+    )
+
+    def __init__(
+        self, threshold: float = 0.5, smooth: float = 1, sigmoid: bool = False
+    ) -> None:
+        self.threshold = threshold
+        self.smooth = smooth
+        self.sigmoid = sigmoid
+        self.sums: Optional[Tensor] = None
+
+    def reset(self) -> None:
+        """
+        Clear the running sums.
+        """
+        self.sums = None
+
+    @torch.no_grad()
+    def update(
+        self, inputs: Tensor, targets: Tensor, loss: Optional[Tensor] = None
+    ) -> None:
+        """
+        Add a batch to the running sums.
+
+        Parameters:
+        - inputs (Tensor): Predicted probabilities (or logits with sigmoid=True).
+        - targets (Tensor): Ground truth tensor with the same number of elements.
+        - loss (Tensor, optional): Loss of the batch, averaged into "loss". Default: None.
+        """
+        inputs = inputs.detach().float().reshape(-1)
+        if self.sigmoid:
+            inputs = torch.sigmoid(inputs)
+        targets = targets.detach().float().reshape(-1).to(inputs.device)
+        predicted = inputs >= self.threshold
+        positive = targets >= 0.5
+
+        values = torch.stack(
+            [
+                (inputs * targets).sum(),
+                inputs.sum(),
+                targets.sum(),
+                (predicted & positive).sum(),
+                (predicted & ~positive).sum(),
+                (~predicted & positive).sum(),
+                F.binary_cross_entropy(inputs, targets, reduction="sum"),
+                torch.tensor(float(inputs.numel()), device=inputs.device),
+                (
+                    loss.detach().float()
+                    if loss is not None
+                    else torch.zeros((), device=inputs.device)
+                ),
+                torch.tensor(float(loss is not None), device=inputs.device),
+            ]
+        ).double()
+        if self.sums is None:
+            self.sums = values
+        else:
+            self.sums += values
+
+    def reduced_sums(self, group: Optional[object] = None) -> Tensor:
+        """
+        Running sums of all processes.
+
+        Parameters:
+        - group (ProcessGroup, optional): torch.distributed group to reduce over. Default: the world.
+
+        Returns:
+            Tensor: Sums added over the processes (only this process without torch.distributed).
+        """
+        sums = self.sums
+        if sums is None:
+            sums = torch.zeros(len(self.FIELDS), dtype=torch.float64)
+        sums = sums.clone()
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.all_reduce(sums, group=group)
+        return sums
+
+    def compute(
+        self, reduce: bool = True, group: Optional[object] = None
+    ) -> Dict[str, float]:
+        """
+        Compute the metrics from the running sums.
+
+        Parameters:
+        - reduce (bool, optional): Sum over all torch.distributed processes first. Default: True.
+        - group (ProcessGroup, optional): torch.distributed group to reduce over. Default: the world.
+
+        Returns:
+            Dict[str, float]: "iou", "dice", "precision", "recall", "bce", "loss" (mean of the
+            losses given to update) and "pixels".
+        """
+        if reduce:
+            sums = self.reduced_sums(group)
+        elif self.sums is not None:
+            sums = self.sums
+        else:
+            sums = torch.zeros(len(self.FIELDS), dtype=torch.float64)
+        # .tolist()で1回だけデバイスと同期する
+        values = dict(zip(self.FIELDS, sums.tolist()))
+
+        intersection = values["intersection"]
+        union = values["input_sum"] + values["target_sum"] - intersection
+        tp = values["true_positive"]
+        return {
+            "iou": (intersection + self.smooth) / (union + self.smooth),
+            "dice": (2.0 * intersection + self.smooth)
+            / (values["input_sum"] + values["target_sum"] + self.smooth),
+            "precision": _ratio(tp, tp + values["false_positive"]),
+            "recall": _ratio(tp, tp + values["false_negative"]),
+            "bce": _ratio(values["bce_sum"], values["pixels"]),
+            "loss": _ratio(values["loss_sum"], values["batches"]),
+            "pixels": values["pixels"],
+        }
+
+
+def _ratio(numerator: float, denominator: float) -> float:
+    return numerator / denominator if denominator > 0 else 0.0
@@ -1,21 +1,28 @@
 import torch
 from torch import nn, Tensor
+from typing import Union
 
 
 # UNet
 class UNet(nn.Module):
-    def __init__(self, input_channels: int, output_channels: int):
+    def __init__(
+        self, input_channels: int, output_channels: int, input_scale: float = 255.0
+    ):
         """
         UNet model for semantic segmentation.
 
         Parameters:
         - input_channels (int): Number of input channels.
         - output_channels (int): Number of output channels.
+        - input_scale (float): The input is divided by this value first. The default 255.0 matches the
+          existing checkpoints, which were trained on alb.Normalize outputs divided by 255 again;
+          use 1.0 to train on the normalized images as they are (e.g. with image_loader.BatchTransform).
 
         Returns:
             output: Segmentation output tensor.
         """
         super().__init__()
+        self.input_scale = input_scale
         # Convolutional layers for the encoder (FCN part)
         self.conv1 = conv_bn_relu(input_channels, 64)
         self.conv2 = conv_bn_relu(64, 128)
@@ -53,7 +60,8 @@ class UNet(nn.Module):
             Tensor: Segmentation output tensor.
         """
         # 正規化
-        x = x / 255.0
+        if self.input_scale != 1.0:
+            x = x / self.input_scale
 
         # Forward pass through the encoder (FCN part)
         x1 = self.conv1(x)
@@ -165,3 +173,33 @@ def up_pooling(
         nn.BatchNorm2d(out_channels),
         nn.ReLU(inplace=True),
     )
+
+
+def load_unet(
+    checkpoint_path: str,
+    input_channels: int = 3,
+    output_channels: int = 1,
+    map_location: Union[str, torch.device] = "cpu",
+) -> UNet:
+    """
+    Load a trained UNet from a checkpoint saved by the training loop.
+
+    Parameters:
+    - checkpoint_path (str): Path to the checkpoint (e.g. Settings().best_model_path of config.setting).
+    - input_channels (int): Number of input channels.
+    - output_channels (int): Number of output channels.
+    - map_location (str | torch.device): Device to load the weights on (default is "cpu").
+
+    Returns:
+        UNet: Model in eval mode. Only the weights are used; the optimizer state is ignored.
+        The input_scale saved in the checkpoint is used (255.0 for checkpoints without it).
+    """
+    from module import checkpoint_manager
+
+    # optimizerの状態は読み込まずに済むようにファイルをメモリマップする
+    checkpoint = checkpoint_manager.load_checkpoint(checkpoint_path, map_location)
+    model = UNet(input_channels, output_channels, checkpoint.get("input_scale", 255.0))
+    model.load_state_dict(checkpoint["state_dict"])
+    model.to(map_location)
+    model.eval()
+    return model
@@ -0,0 +1,262 @@
+import argparse
+import copy
+import inspect
+import json
+import os
+import time
+from typing import Dict, List, Optional, Tuple, Union
+
+import torch
+from torch import nn
+
+from config import setting
+
+EXPORT_FORMATS = ("torchscript", "onnx")
+METADATA_NAME = "metadata.json"
+
+
+def fold_conv_bn(
+    conv: Union[nn.Conv2d, nn.ConvTranspose2d], bn: nn.BatchNorm2d
+) -> Union[nn.Conv2d, nn.ConvTranspose2d]:
+    """
+    Fold an eval-mode BatchNorm2d into the convolution before it.
+
+    Parameters:
+    - conv (nn.Conv2d | nn.ConvTranspose2d): Convolution followed by bn.
+    - bn (nn.BatchNorm2d): Batch normalization using its running statistics.
+
+    Returns:
+    nn.Conv2d | nn.ConvTranspose2d: New convolution computing bn(conv(x)).
+    """
+    folded = copy.deepcopy(conv)
+    scale = bn.weight.detach() / torch.sqrt(bn.running_var + bn.eps)
+    bias = conv.bias.detach() if conv.bias is not None else torch.zeros_like(scale)
+
+    # Conv2dの重みは (out, in, k, k), ConvTranspose2dの重みは (in, out, k, k)
+    if isinstance(conv, nn.ConvTranspose2d):
+        shape = (1, -1, 1, 1)
+    else:
+        shape = (-1, 1, 1, 1)
+    folded.weight = nn.Parameter(conv.weight.detach() * scale.reshape(shape))
+    folded.bias = nn.Parameter((bias - bn.running_mean) * scale + bn.bias.detach())
+    return folded
+
+
+def fold_batch_norm(model: nn.Module) -> nn.Module:
+    """
+    Copy a model with every Conv -> BatchNorm2d pair of its nn.Sequential blocks folded.
+
+    Parameters:
+    - model (nn.Module): Trained model (e.g. machine_learning_model.UNet).
+
+    Returns:
+    nn.Module: Eval-mode copy of the model without BatchNorm2d after convolutions.
+    """
+    model = copy.deepcopy(model).eval()
+    for module in list(model.modules()):
+        if not isinstance(module, nn.Sequential):
+            continue
+        layers = list(module)
+        folded = []
+        i = 0
+        while i < len(layers):
+            layer = layers[i]
+            following = layers[i + 1] if i + 1 < len(layers) else None
+            if isinstance(layer, (nn.Conv2d, nn.ConvTranspose2d)) and isinstance(
+                following, nn.BatchNorm2d
+            ):
+                folded.append(fold_conv_bn(layer, following))
+                i += 2
+            else:
+                folded.append(layer)
+                i += 1
+        if len(folded) != len(layers):
+            for name in list(module._modules):
+                del module._modules[name]
+            for j, layer in enumerate(folded):
+                module.add_module(str(j), layer)
+    return model
+
+
+def export_metadata(
+    input_channels: int,
+    output_channels: int,
+    image_size: int,
+    checkpoint_path: Optional[str] = None,
+    input_scale: float = 255.0,
+) -> Dict:
+    """
+    Metadata stored with an exported model.
+
+    Parameters:
+    - input_channels (int): Number of input channels.
+    - output_channels (int): Number of output channels.
+    - image_size (int): Tile size the model was traced/checked with.
+    - checkpoint_path (str, optional): Source checkpoint (default is None).
+    - input_scale (float): Value the model divides its normalized input by (default is 255.0).
+
+    Returns:
+    Dict: Input layout, normalization (same as get_train_transform) and provenance of the model.
+    """
+    from module import image_loader
+
+    return {
+        "input_channels": input_channels,
+        "output_channels": output_channels,
+        "image_size": image_size,
+        "input_layout": "NCHW",
+        "normalize_mean": list(image_loader.NORMALIZE_MEAN),
+        "normalize_std": list(image_loader.NORMALIZE_STD),
+        "input_scale": input_scale,
+        "output": "sigmoid probability",
+        "batch_norm_folded": True,
+        "checkpoint": checkpoint_path,
+        "torch_version": torch.__version__,
+    }
+
+
+def export_torchscript(model: nn.Module, output_path: str, metadata: Dict) -> None:
+    """
+    Trace a model and save it as a self-contained TorchScript file.
+
+    Parameters:
+    - model (nn.Module): Eval-mode model (usually from fold_batch_norm).
+    - output_path (str): Path of the TorchScript file.
+    - metadata (Dict): Metadata stored inside the file (see export_metadata).
+
+    Returns:
+    None
+    """
+    size = metadata["image_size"]
+    example = torch.zeros(1, metadata["input_channels"], size, size)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+    traced = torch.jit.freeze(traced)
+    torch.jit.save(
+        traced, output_path, _extra_files={METADATA_NAME: json.dumps(metadata)}
+    )
+
+
+def export_onnx(model: nn.Module, output_path: str, metadata: Dict) -> None:
+    """
+    Export a model to ONNX with a dynamic batch size and image size.
+
+    Parameters:
+    - model (nn.Module): Eval-mode model (usually from fold_batch_norm).
+    - output_path (str): Path of the ONNX file. The metadata is written next to it as output_path + ".json".
+    - metadata (Dict): Metadata of the model (see export_metadata).
+
+    Returns:
+    None
+    """
+    size = metadata["image_size"]
+    example = torch.zeros(1, metadata["input_channels"], size, size)
+    axes = {0: "batch", 2: "height", 3: "width"}
+    options = {}
+    # 新しいtorchはdynamoでの出力が既定なので従来のtracerを明示する
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        options["dynamo"] = False
+    torch.onnx.export(
+        model,
+        (example,),
+        output_path,
+        input_names=["image"],
+        output_names=["probability"],
+        dynamic_axes={"image": axes, "probability": axes},
+        **options,
+    )
+    with open(output_path + ".json", "w") as f:
+        json.dump(metadata, f, indent=1)
+
+
+def load_exported(
+    path: str, map_location: Union[str, torch.device] = "cpu"
+) -> Tuple[torch.jit.ScriptModule, Dict]:
+    """
+    Load an exported TorchScript model without the training code.
+
+    Parameters:
+    - path (str): Path of the TorchScript file written by export_torchscript.
+    - map_location (str | torch.device): Device to load the model on (default is "cpu").
+
+    Returns:
+    Tuple[torch.jit.ScriptModule, Dict]: Eval-mode model and its metadata.
+    """
+    extra_files = {METADATA_NAME: ""}
+    model = torch.jit.load(path, map_location=map_location, _extra_files=extra_files)
+    model.eval()
+    return model, json.loads(extra_files[METADATA_NAME])
+
+
+def max_output_difference(
+    reference: nn.Module, exported: nn.Module, image_size: int, batch_size: int = 2
+) -> float:
+    """
+    Largest output difference of two models on random normalized inputs.
+
+    Parameters:
+    - reference (nn.Module): Original model.
+    - exported (nn.Module): Exported (folded) model.
+    - image_size (int): Height and width of the inputs.
+    - batch_size (int): Number of inputs (default is 2).
+
+    Returns:
+    float: Maximum absolute difference of the outputs.
+    """
+    generator = torch.Generator().manual_seed(0)
+    batch = torch.randn(batch_size, 3, image_size, image_size, generator=generator)
+    with torch.inference_mode():
+        return float((reference(batch) - exported(batch)).abs().max())
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Fold BatchNorm into the convolutions of a UNet checkpoint and export it for inference."
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help="checkpoint path (default: checkpoint_path/UNet/best_model.pth of --config)",
+    )
+    parser.add_argument(
+        "-o", "--output", required=True, help="output path without extension"
+    )
+    parser.add_argument(
+        "--format", nargs="+", choices=EXPORT_FORMATS, default=["torchscript"]
+    )
+    parser.add_argument("--image-size", type=int, default=256)
+    parser.add_argument("--tolerance", type=float, default=1e-4)
+    setting.add_argument(parser)
+    args = parser.parse_args(argv)
+
+    from module import machine_learning_model
+
+    checkpoint = args.checkpoint or setting.from_arguments(args).best_model_path
+
+    model = machine_learning_model.load_unet(checkpoint)
+    folded = fold_batch_norm(model)
+    difference = max_output_difference(model, folded, args.image_size)
+    print(f"max difference after folding: {difference:.3g}")
+    if difference > args.tolerance:
+        raise SystemExit(f"folded model differs by more than {args.tolerance}")
+
+    metadata = export_metadata(
+        3, 1, args.image_size, os.path.abspath(checkpoint), model.input_scale
+    )
+    directory = os.path.dirname(os.path.abspath(args.output))
+    os.makedirs(directory, exist_ok=True)
+    if "torchscript" in args.format:
+        path = args.output + ".pt"
+        export_torchscript(folded, path, metadata)
+        start = time.perf_counter()
+        exported, _ = load_exported(path)
+        seconds = time.perf_counter() - start
+        difference = max_output_difference(model, exported, args.image_size)
+        print(f"{path}: loaded in {seconds:.3f}s, max difference {difference:.3g}")
+    if "onnx" in args.format:
+        path = args.output + ".onnx"
+        export_onnx(folded, path, metadata)
+        print(f"{path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+import argparse
+import time
+from contextlib import nullcontext
+from typing import ContextManager, Dict, Iterable, List, Optional, Tuple, Union
+
+import torch
+from torch import nn, Tensor
+
+from config import setting
+from module import machine_learning_metrics
+
+PRECISIONS = ("float32", "bfloat16")
+
+
+def default_device() -> str:
+    """
+    Device used when none is given: CUDA when available, otherwise the CPU.
+
+    Returns:
+    str: "cuda" or "cpu".
+    """
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def prepare_model(
+    model: nn.Module,
+    device: Union[None, str, torch.device] = None,
+    channels_last: bool = False,
+    compile: bool = False,
+) -> nn.Module:
+    """
+    Move a model to its execution device and layout.
+
+    Parameters:
+    - model (nn.Module): Model to prepare (e.g. machine_learning_model.UNet).
+    - device (str | torch.device, optional): Device to run on (default is default_device()).
+    - channels_last (bool): Store the convolution weights in channels_last (NHWC) order (default is False).
+    - compile (bool): Wrap the model with torch.compile (default is False).
+
+    Returns:
+    nn.Module: The prepared model. With compile=True this is a compiled wrapper sharing the weights of model.
+    """
+    device = torch.device(device or default_device())
+    model.to(device)
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+    if compile:
+        model = torch.compile(model)
+    return model
+
+
+def autocast(
+    device: Union[str, torch.device], precision: str = "float32"
+) -> ContextManager:
+    """
+    Autocast context of a precision.
+
+    Parameters:
+    - device (str | torch.device): Device the model runs on.
+    - precision (str): "float32" (no autocast) or "bfloat16" (default is "float32").
+
+    Returns:
+    ContextManager: torch.autocast for bfloat16, a no-op context for float32.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision: {precision}")
+    if precision == "float32":
+        return nullcontext()
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+
+
+def run_model(
+    model: nn.Module,
+    batch: Tensor,
+    device: Union[str, torch.device],
+    precision: str = "float32",
+    channels_last: bool = False,
+) -> Tensor:
+    """
+    Run a model for inference with the given execution options.
+
+    Parameters:
+    - model (nn.Module): Model prepared with prepare_model.
+    - batch (Tensor): Input batch (N, C, H, W).
+    - device (str | torch.device): Device the model runs on.
+    - precision (str): "float32" or "bfloat16" (default is "float32").
+    - channels_last (bool): Feed the batch in channels_last order (default is False).
+
+    Returns:
+    Tensor: float32 output in contiguous NCHW order.
+    """
+    batch = batch.to(device)
+    if channels_last:
+        batch = batch.contiguous(memory_format=torch.channels_last)
+    with torch.inference_mode(), autocast(device, precision):
+        output = model(batch)
+    return output.float().contiguous()
+
+
+def iou_parity(
+    model: nn.Module,
+    batches: Iterable[Tuple[Tensor, Tensor]],
+    device: Union[None, str, torch.device] = None,
+    precision: str = "bfloat16",
+    channels_last: bool = True,
+    compile: bool = False,
+    threshold: float = 0.5,
+    tolerance: float = 0.01,
+) -> Dict[str, Union[bool, float]]:
+    """
+    Compare the IoU of a faster execution path with float32 NCHW execution.
+
+    Parameters:
+    - model (nn.Module): Model in eval mode.
+    - batches (Iterable[Tuple[Tensor, Tensor]]): (images, masks) batches, e.g. a DataLoader over LoadDataSet.
+      It is iterated once.
+    - device (str | torch.device, optional): Device to run on (default is default_device()).
+    - precision (str): Precision of the fast path (default is "bfloat16").
+    - channels_last (bool): Use channels_last in the fast path (default is True).
+    - compile (bool): Use torch.compile in the fast path (default is False).
+    - threshold (float): Probability at which the predictions are binarized (default is 0.5).
+    - tolerance (float): Largest accepted IoU difference (default is 0.01).
+
+    Returns:
+    Dict[str, bool | float]:
+    - iou_float32, iou_fast: IoU (machine_learning_metrics.IoU) of each path against the masks.
+    - iou_delta: iou_fast - iou_float32.
+    - iou_agreement: IoU between the binarized predictions of both paths.
+    - max_abs_diff: Largest difference of the probabilities.
+    - seconds_float32, seconds_fast: Time spent in the model by each path.
+    - passed: Whether abs(iou_delta) <= tolerance.
+    """
+    device = torch.device(device or default_device())
+    model.eval()
+    reference = prepare_model(model, device)
+    metric = machine_learning_metrics.IoU()
+
+    # batchesはジェネレーターやshuffleするDataLoaderでもよいように一度だけ読み,
+    # 同じ画像を速い経路でも使う
+    inputs = []
+    reference_outputs = []
+    targets = []
+    seconds_float32 = 0.0
+    for images, masks in batches:
+        inputs.append(images)
+        start = time.perf_counter()
+        reference_outputs.append(run_model(reference, images, device).cpu())
+        seconds_float32 += time.perf_counter() - start
+        targets.append(_as_target(masks, reference_outputs[-1]))
+
+    fast = prepare_model(model, device, channels_last, compile)
+    fast_outputs = []
+    seconds_fast = 0.0
+    for images in inputs:
+        start = time.perf_counter()
+        fast_outputs.append(
+            run_model(fast, images, device, precision, channels_last).cpu()
+        )
+        seconds_fast += time.perf_counter() - start
+    # 以降の推論に影響しないように重みのレイアウトを元に戻す
+    model.to(memory_format=torch.contiguous_format)
+
+    reference_output = torch.cat(reference_outputs)
+    fast_output = torch.cat(fast_outputs)
+    target = torch.cat(targets)
+    reference_binary = (reference_output >= threshold).float()
+    fast_binary = (fast_output >= threshold).float()
+
+    iou_float32 = float(metric(reference_binary, target))
+    iou_fast = float(metric(fast_binary, target))
+    return {
+        "iou_float32": iou_float32,
+        "iou_fast": iou_fast,
+        "iou_delta": iou_fast - iou_float32,
+        "iou_agreement": float(metric(fast_binary, reference_binary)),
+        "max_abs_diff": float((fast_output - reference_output).abs().max()),
+        "seconds_float32": seconds_float32,
+        "seconds_fast": seconds_fast,
+        "passed": abs(iou_fast - iou_float32) <= tolerance,
+    }
+
+
+def _as_target(masks: Tensor, output: Tensor) -> Tensor:
+    # LoadDataSetのマスクは (N, H, W, 1) なのでモデルの出力 (N, 1, H, W) に揃える
+    masks = torch.as_tensor(masks).float()
+    if masks.ndim == 4 and masks.shape[1:3] == output.shape[2:]:
+        masks = masks.permute(0, 3, 1, 2)
+    return masks.reshape(output.shape).contiguous()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Check the IoU of bfloat16/channels_last/compiled UNet inference against float32."
+    )
+    parser.add_argument("data", help="dataset folder containing the N-M folders")
+    parser.add_argument(
+        "--checkpoint",
+        help="checkpoint path (default: checkpoint_path/UNet/best_model.pth of --config)",
+    )
+    parser.add_argument("--device", default=default_device())
+    parser.add_argument("--image-size", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--limit", type=int, help="number of samples to use")
+    parser.add_argument("--precision", choices=PRECISIONS, default="bfloat16")
+    parser.add_argument("--no-channels-last", action="store_true")
+    parser.add_argument("--compile", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.01)
+    setting.add_argument(parser)
+    args = parser.parse_args(argv)
+
+    from torch.utils.data import DataLoader, Subset
+
+    from module import image_loader, machine_learning_model
+
+    checkpoint = args.checkpoint or setting.from_arguments(args).best_model_path
+
+    model = machine_learning_model.load_unet(checkpoint, map_location=args.device)
+    # 比較のためフリップはしない
+    transform = image_loader.get_train_transform(
+        args.image_size, args.image_size, horizontal_flip=0.0, vertical_flip=0.0
+    )
+    dataset = image_loader.LoadDataSet(
+        args.data, args.image_size, args.image_size, transform=transform
+    )
+    if args.limit is not None:
+        dataset = Subset(dataset, range(min(args.limit, len(dataset))))
+    batches = list(DataLoader(dataset, batch_size=args.batch_size))
+
+    result = iou_parity(
+        model,
+        batches,
+        device=args.device,
+        precision=args.precision,
+        channels_last=not args.no_channels_last,
+        compile=args.compile,
+        tolerance=args.tolerance,
+    )
+    for name, value in result.items():
+        print(f"{name}: {value}")
+    if not result["passed"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
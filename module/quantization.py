@@ -0,0 +1,301 @@
+import argparse
+import copy
+import io
+import os
+import time
+import warnings
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import torch
+from torch import nn, Tensor
+
+from config import setting
+from module import machine_learning_metrics, model_export
+
+QUANTIZATION_MODES = ("static", "dynamic")
+
+
+def quantization_backend() -> str:
+    """
+    Quantized kernel backend of this machine.
+
+    Returns:
+    str: "x86" when available (fbgemm + onednn), otherwise the first supported engine.
+    """
+    engines = torch.backends.quantized.supported_engines
+    for engine in ("x86", "fbgemm", "qnnpack"):
+        if engine in engines:
+            return engine
+    raise RuntimeError("No quantized engine is available in this torch build")
+
+
+def quantize_static(
+    model: nn.Module, calibration: Iterable[Tensor], backend: Optional[str] = None
+) -> nn.Module:
+    """
+    Static int8 post-training quantization (FX graph mode).
+
+    Parameters:
+    - model (nn.Module): Float model (e.g. machine_learning_model.UNet). It is not modified.
+    - calibration (Iterable[Tensor]): Normalized image batches (N, 3, H, W) used to observe the activation ranges.
+    - backend (str, optional): Quantized engine (default is quantization_backend()).
+
+    Returns:
+    nn.Module: Quantized model. Conv -> BatchNorm -> ReLU blocks are fused into int8 convolutions;
+    operations without int8 kernels stay in float32.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    backend = backend or quantization_backend()
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).eval()
+
+    batches = iter(calibration)
+    first = next(batches)
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), (first,))
+    with torch.inference_mode():
+        prepared(first)
+        for batch in batches:
+            prepared(batch)
+    return convert_fx(prepared)
+
+
+def quantize_dynamic(model: nn.Module) -> nn.Module:
+    """
+    Dynamic int8 quantization (weights only, activations quantized on the fly).
+
+    Parameters:
+    - model (nn.Module): Float model. It is not modified.
+
+    Returns:
+    nn.Module: Model whose nn.Linear layers are quantized. Convolutions have no dynamic
+    int8 kernels in torch and stay in float32.
+
+    Raises:
+    - RuntimeError: If the model has no nn.Linear layer (e.g. UNet), since the result would be
+    an unquantized float32 copy.
+    """
+    if not any(isinstance(module, nn.Linear) for module in model.modules()):
+        raise RuntimeError(
+            "dynamic quantization only supports nn.Linear layers and the model has none; "
+            "the result would stay in float32"
+        )
+    model = copy.deepcopy(model).eval()
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def quantize_model(
+    model: nn.Module, calibration: Iterable[Tensor], mode: str = "static"
+) -> Tuple[nn.Module, str]:
+    """
+    Quantize a model, falling back to dynamic quantization when static quantization fails.
+
+    Parameters:
+    - model (nn.Module): Float model.
+    - calibration (Iterable[Tensor]): Normalized image batches for the static calibration.
+    - mode (str): "static" or "dynamic" (default is "static").
+
+    Returns:
+    Tuple[nn.Module, str]: Quantized model and the mode actually used.
+
+    Raises:
+    - RuntimeError: If neither quantization applies to the model (see quantize_dynamic).
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization mode: {mode}")
+    if mode == "static":
+        try:
+            return quantize_static(model, calibration), "static"
+        except (RuntimeError, NotImplementedError, AssertionError) as error:
+            try:
+                quantized = quantize_dynamic(model)
+            except RuntimeError:
+                raise RuntimeError(f"static quantization failed: {error}") from error
+            warnings.warn(f"static quantization failed, using dynamic: {error}")
+            return quantized, "dynamic"
+    return quantize_dynamic(model), "dynamic"
+
+
+def model_size(model: nn.Module) -> int:
+    """
+    Serialized size of the weights of a model.
+
+    Parameters:
+    - model (nn.Module): Float or quantized model.
+
+    Returns:
+    int: Size in bytes of torch.save(model.state_dict()).
+    """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def evaluate(
+    model: nn.Module,
+    batches: Iterable[Tuple[Tensor, Tensor]],
+    threshold: float = 0.5,
+) -> Dict[str, float]:
+    """
+    IoU, Dice and latency of a model on (images, masks) batches.
+
+    Parameters:
+    - model (nn.Module): Model returning probabilities (N, 1, H, W).
+    - batches (Iterable[Tuple[Tensor, Tensor]]): Batches from a DataLoader over LoadDataSet.
+    - threshold (float): Probability at which the predictions are binarized (default is 0.5).
+
+    Returns:
+    Dict[str, float]: "iou" and "dice" over all pixels and "seconds_per_batch".
+    """
+    iou = machine_learning_metrics.IoU()
+    dice_loss = machine_learning_metrics.DiceLoss()
+    predictions = []
+    targets = []
+    seconds = 0.0
+    n_batches = 0
+    for images, masks in batches:
+        start = time.perf_counter()
+        with torch.inference_mode():
+            output = model(images)
+        seconds += time.perf_counter() - start
+        n_batches += 1
+        predictions.append((output.float() >= threshold).float().reshape(-1))
+        # LoadDataSetのマスクは (N, H, W, 1) なので画素の順番を出力 (N, 1, H, W) に揃える
+        targets.append(torch.as_tensor(masks).float().permute(0, 3, 1, 2).reshape(-1))
+
+    prediction = torch.cat(predictions)
+    target = torch.cat(targets)
+    return {
+        "iou": float(iou(prediction, target)),
+        "dice": float(1 - dice_loss(prediction, target)),
+        "seconds_per_batch": seconds / max(n_batches, 1),
+    }
+
+
+def compare(
+    float_model: nn.Module,
+    quantized_model: nn.Module,
+    batches: List[Tuple[Tensor, Tensor]],
+    threshold: float = 0.5,
+) -> Dict[str, float]:
+    """
+    Compare a quantized model with its float model.
+
+    Parameters:
+    - float_model (nn.Module): Float model.
+    - quantized_model (nn.Module): Quantized model.
+    - batches (List[Tuple[Tensor, Tensor]]): Validation batches (evaluated once per model).
+    - threshold (float): Probability at which the predictions are binarized (default is 0.5).
+
+    Returns:
+    Dict[str, float]: IoU, Dice, latency and size of both models and the IoU/Dice deltas (quantized - float).
+    """
+    reference = evaluate(float_model, batches, threshold)
+    quantized = evaluate(quantized_model, batches, threshold)
+    report = {}
+    for name, result in (("float", reference), ("int8", quantized)):
+        for key, value in result.items():
+            report[f"{name}_{key}"] = value
+    report["float_bytes"] = model_size(float_model)
+    report["int8_bytes"] = model_size(quantized_model)
+    report["iou_delta"] = quantized["iou"] - reference["iou"]
+    report["dice_delta"] = quantized["dice"] - reference["dice"]
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Quantize a UNet checkpoint to int8 and export it if the IoU drop is acceptable."
+    )
+    parser.add_argument("data", help="dataset folder containing the N-M folders")
+    parser.add_argument("-o", "--output", required=True, help="TorchScript output path")
+    parser.add_argument(
+        "--checkpoint",
+        help="checkpoint path (default: checkpoint_path/UNet/best_model.pth of --config)",
+    )
+    parser.add_argument("--manifest", help="dataset manifest (module.dataset_manifest)")
+    parser.add_argument("--calibration-split", help="split file of calibration samples")
+    parser.add_argument("--validation-split", help="split file of validation samples")
+    parser.add_argument("--calibration-samples", type=int, default=32)
+    parser.add_argument("--image-size", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--mode", choices=QUANTIZATION_MODES, default="static")
+    parser.add_argument(
+        "--max-iou-drop",
+        type=float,
+        default=0.01,
+        help="do not write the model when the IoU drops by more than this",
+    )
+    setting.add_argument(parser)
+    args = parser.parse_args(argv)
+
+    from torch.utils.data import DataLoader, Subset
+
+    from module import image_loader, machine_learning_model
+
+    checkpoint = args.checkpoint or setting.from_arguments(args).best_model_path
+    model = machine_learning_model.load_unet(checkpoint)
+
+    transform = image_loader.get_train_transform(
+        args.image_size, args.image_size, horizontal_flip=0.0, vertical_flip=0.0
+    )
+
+    def load_dataset(split: Optional[str], limit: Optional[int] = None):
+        dataset = image_loader.LoadDataSet(
+            args.data,
+            args.image_size,
+            args.image_size,
+            transform=transform,
+            manifest=args.manifest,
+            split=split,
+        )
+        folders = dataset.folders
+        if limit is not None:
+            folders = folders[:limit]
+            dataset = Subset(dataset, range(len(folders)))
+        return dataset, set(folders)
+
+    calibration_set, calibration_ids = load_dataset(
+        args.calibration_split, args.calibration_samples
+    )
+    validation_set, validation_ids = load_dataset(args.validation_split)
+    # 校正に使ったサンプルで検証するとIoUの比較が甘くなるので重複を許さない
+    overlap = calibration_ids & validation_ids
+    if overlap:
+        parser.error(
+            f"{len(overlap)} calibration samples are also validation samples; "
+            "give disjoint --calibration-split and --validation-split"
+        )
+    calibration = list(DataLoader(calibration_set, batch_size=args.batch_size))
+    validation = list(DataLoader(validation_set, batch_size=args.batch_size))
+
+    try:
+        quantized, mode = quantize_model(
+            model, [images for images, _ in calibration], args.mode
+        )
+    except RuntimeError as error:
+        raise SystemExit(f"{error}, {args.output} was not written")
+    report = compare(model, quantized, validation)
+    print(f"mode: {mode}")
+    for name, value in report.items():
+        print(f"{name}: {value}")
+
+    iou_drop = -report["iou_delta"]
+    if iou_drop > args.max_iou_drop:
+        raise SystemExit(
+            f"IoU dropped by {iou_drop:.4f} (> {args.max_iou_drop}), {args.output} was not written"
+        )
+
+    metadata = model_export.export_metadata(
+        3, 1, args.image_size, os.path.abspath(checkpoint), model.input_scale
+    )
+    metadata["quantization"] = mode
+    metadata["batch_norm_folded"] = mode == "static"
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    model_export.export_torchscript(quantized, args.output, metadata)
+    print(f"-> {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from module import dataset_manifest
+
+CACHE_EXTENSION = ".png"
+
+_model_digests: Dict[Tuple[str, int, int], str] = {}
+
+
+def model_digest(path: str) -> str:
+    """
+    SHA-256 digest of a model checkpoint or exported model, computed once per file version.
+
+    Parameters:
+    - path (str): Path to the model file.
+
+    Returns:
+    str: Hex digest of the file content.
+    """
+    stat = os.stat(path)
+    version = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if version not in _model_digests:
+        _model_digests[version] = dataset_manifest.file_digest(path)
+    return _model_digests[version]
+
+
+class ResultCache:
+    """
+    Content-addressed cache of segmentation results.
+
+    Parameters:
+    - cache_dir (str): Directory of the cache.
+    - max_bytes (int, optional): Evict the least recently used entries above this total size (default is None).
+    - max_entries (int, optional): Evict the least recently used entries above this count (default is None).
+
+    An entry is keyed by the SHA-256 of the image file, the digest of the model and the inference
+    settings, and holds the probability map scaled to 0-255 as a PNG (the same image
+    batch_segmentation writes without --threshold, so tissue_analysis can read it directly).
+    The modification time of an entry is its last use; eviction removes the oldest ones.
+    The cache may be shared by threads (batch_segmentation writes entries on its I/O pool).
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        max_bytes: Optional[int] = None,
+        max_entries: Optional[int] = None,
+    ) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # 使用量・ヒット数・削除はスレッド間で排他する
+        self._lock = threading.RLock()
+        # 使用量 (バイト数, エントリー数) は最初に必要になったときに1回だけ走査する
+        self._usage: Optional[Tuple[int, int]] = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, image_digest: str, model_digest: str, settings: Dict) -> str:
+        """
+        Cache key of a segmentation result.
+
+        Parameters:
+        - image_digest (str): SHA-256 of the image file (dataset_manifest.file_digest).
+        - model_digest (str): Digest of the model (model_digest).
+        - settings (Dict): Inference settings affecting the result (tile size, overlap, precision, ...).
+
+        Returns:
+        str: Hex key.
+        """
+        payload = json.dumps(
+            {"image": image_digest, "model": model_digest, "settings": settings},
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def path(self, key: str) -> str:
+        """
+        Path of the entry of a key.
+
+        Parameters:
+        - key (str): Cache key.
+
+        Returns:
+        str: Path of the PNG file (it may not exist).
+        """
+        # 1つのフォルダーにファイルが集中しないように先頭2文字で分ける
+        return os.path.join(self.cache_dir, key[:2], key + CACHE_EXTENSION)
+
+    def lookup(self, key: str) -> Optional[str]:
+        """
+        Find an entry and mark it as recently used.
+
+        Parameters:
+        - key (str): Cache key.
+
+        Returns:
+        str | None: Path of the entry, or None on a miss.
+        """
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """
+        Read an entry.
+
+        Parameters:
+        - key (str): Cache key.
+
+        Returns:
+        numpy.ndarray | None: uint8 probability map (H, W) in 0-255, or None on a miss.
+        """
+        path = self.lookup(key)
+        if path is None:
+            return None
+        mask = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if mask is None:
+            # 壊れたエントリー(または別スレッドが削除したもの)は計算し直させる
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            with self._lock:
+                self.hits -= 1
+                self.misses += 1
+        return mask
+
+    def put(self, key: str, mask: np.ndarray) -> str:
+        """
+        Store an entry and evict old entries when the cache is over its limits.
+
+        Parameters:
+        - key (str): Cache key.
+        - mask (numpy.ndarray): uint8 probability map (H, W) in 0-255.
+
+        Returns:
+        str: Path of the entry.
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        ok, encoded = cv2.imencode(CACHE_EXTENSION, mask)
+        if not ok:
+            raise ValueError(f"Could not encode cache entry {key}")
+        # 同じキーを書く他のスレッド・プロセスと衝突しない一時ファイル名にする
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), prefix=key, suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(encoded.tobytes())
+            with self._lock:
+                existed = os.path.exists(path)
+                os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        if self.max_bytes is None and self.max_entries is None:
+            return path
+        with self._lock:
+            if self._usage is None or existed:
+                self._usage = self._scan_usage()
+            else:
+                total, count = self._usage
+                self._usage = (total + encoded.size, count + 1)
+            total, count = self._usage
+            if (self.max_bytes is not None and total > self.max_bytes) or (
+                self.max_entries is not None and count > self.max_entries
+            ):
+                self.evict()
+        return path
+
+    def entries(self) -> List[Tuple[int, int, str]]:
+        """
+        Entries of the cache, least recently used first.
+
+        Returns:
+        List[Tuple[int, int, str]]: Last use (mtime in ns), size in bytes and path of every entry.
+        """
+        entries = []
+        for directory, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith(CACHE_EXTENSION):
+                    path = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        # 走査中に別のスレッド・プロセスが削除した
+                        continue
+                    entries.append((stat.st_mtime_ns, stat.st_size, path))
+        entries.sort()
+        return entries
+
+    def _scan_usage(self) -> Tuple[int, int]:
+        entries = self.entries()
+        return sum(size for _, size, _ in entries), len(entries)
+
+    def evict(self) -> int:
+        """
+        Remove the least recently used entries until the cache is within its limits.
+
+        Returns:
+        int: Number of removed entries.
+        """
+        with self._lock:
+            entries = self.entries()
+
+            total = sum(size for _, size, _ in entries)
+            removed = 0
+            for _, size, path in entries:
+                over_bytes = self.max_bytes is not None and total > self.max_bytes
+                over_entries = (
+                    self.max_entries is not None
+                    and len(entries) - removed > self.max_entries
+                )
+                if not over_bytes and not over_entries:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                removed += 1
+            self._usage = (total, len(entries) - removed)
+        return removed
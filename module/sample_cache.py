@@ -0,0 +1,258 @@
+import json
+import os
+import tempfile
+from typing import Callable, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+INDEX_FILE = "index.json"
+IMAGE_FILE = "images.u8"
+MASK_FILE = "masks.u8"
+
+# 画像は RGB の 3 チャンネル, マスクは 1 チャンネルで保存する
+IMAGE_CHANNELS = 3
+MASK_CHANNELS = 1
+
+
+def source_stat(path: str) -> List:
+    """
+    Get the fingerprint of a source file used for cache invalidation.
+
+    Parameters:
+    - path (str): Path to the source file.
+
+    Returns:
+    List: [path, mtime_ns, size] of the file.
+    """
+    stat = os.stat(path)
+    return [path, stat.st_mtime_ns, stat.st_size]
+
+
+class SampleCache:
+    """
+    Memory-mapped store of decoded and resized samples.
+
+    Parameters:
+    - cache_dir (str): Directory holding the cache files.
+    - image_height (int): Height of the cached images and masks.
+    - image_width (int): Width of the cached images and masks.
+
+    Every sample is decoded and resized once and written into two contiguous uint8 files
+    (``images.u8`` with shape (N, H, W, 3) and ``masks.u8`` with shape (N, H, W, 1)).
+    ``index.json`` records the byte offset of every sample together with the mtime and size
+    of its source files, so that a sample is re-decoded only when one of its sources changes.
+    Changing ``image_height``/``image_width`` or the set of samples rebuilds the whole cache.
+    """
+
+    def __init__(self, cache_dir: str, image_height: int, image_width: int) -> None:
+        self.cache_dir = cache_dir
+        self.image_height = image_height
+        self.image_width = image_width
+        self.index = None
+        self._images = None
+        self._masks = None
+
+    @property
+    def image_bytes(self) -> int:
+        return self.image_height * self.image_width * IMAGE_CHANNELS
+
+    @property
+    def mask_bytes(self) -> int:
+        return self.image_height * self.image_width * MASK_CHANNELS
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.cache_dir, name)
+
+    def _load_index(self) -> Optional[dict]:
+        try:
+            with open(self._path(INDEX_FILE), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_index(self, index: dict) -> None:
+        # 書き込み途中で落ちても壊れたインデックスが残らないように一時ファイル経由で置き換える
+        # 一時ファイルの名前はプロセスごとに一意にする
+        fd, tmp_path = tempfile.mkstemp(
+            dir=self.cache_dir, prefix=INDEX_FILE, suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self._path(INDEX_FILE))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def sync(
+        self,
+        keys: List[str],
+        fingerprints: List[List],
+        decode: Callable[[int], Tuple[np.ndarray, np.ndarray]],
+    ) -> int:
+        """
+        Bring the cache up to date with the given samples.
+
+        Parameters:
+        - keys (List[str]): Identifier of every sample (e.g. the dataset folder name).
+        - fingerprints (List[List]): [path, mtime_ns, size] of the source files of every sample (see source_stat).
+        - decode (Callable[[int], Tuple[np.ndarray, np.ndarray]]): Function returning the
+          (image, mask) pair of a sample index, already resized to (image_height, image_width).
+
+        Returns:
+        int: Number of samples that were (re)decoded.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        index = self._load_index()
+        rebuild = (
+            index is None
+            or index.get("image_height") != self.image_height
+            or index.get("image_width") != self.image_width
+            or [sample["key"] for sample in index["samples"]] != keys
+            or not os.path.exists(self._path(IMAGE_FILE))
+            or not os.path.exists(self._path(MASK_FILE))
+        )
+
+        if rebuild:
+            stale = list(range(len(keys)))
+            index = {
+                "image_height": self.image_height,
+                "image_width": self.image_width,
+                "samples": [
+                    {
+                        "key": key,
+                        "image_offset": i * self.image_bytes,
+                        "mask_offset": i * self.mask_bytes,
+                        "sources": None,
+                    }
+                    for i, key in enumerate(keys)
+                ],
+            }
+            mode = "w+"
+        else:
+            stale = [
+                i
+                for i, sample in enumerate(index["samples"])
+                if sample["sources"] != fingerprints[i]
+            ]
+            mode = "r+"
+
+        if stale and keys:
+            images = np.memmap(
+                self._path(IMAGE_FILE),
+                dtype=np.uint8,
+                mode=mode,
+                shape=(len(keys), self.image_height, self.image_width, IMAGE_CHANNELS),
+            )
+            masks = np.memmap(
+                self._path(MASK_FILE),
+                dtype=np.uint8,
+                mode=mode,
+                shape=(len(keys), self.image_height, self.image_width, MASK_CHANNELS),
+            )
+            for i in stale:
+                img, mask = decode(i)
+                images[i] = img
+                masks[i] = mask
+                index["samples"][i]["sources"] = fingerprints[i]
+            images.flush()
+            masks.flush()
+            del images, masks
+
+        if stale or rebuild:
+            self._write_index(index)
+        self.index = index
+        self._images = None
+        self._masks = None
+        return len(stale)
+
+    def _open(self) -> None:
+        n_samples = len(self.index["samples"])
+        self._images = np.memmap(
+            self._path(IMAGE_FILE),
+            dtype=np.uint8,
+            mode="r",
+            shape=(n_samples, self.image_height, self.image_width, IMAGE_CHANNELS),
+        )
+        self._masks = np.memmap(
+            self._path(MASK_FILE),
+            dtype=np.uint8,
+            mode="r",
+            shape=(n_samples, self.image_height, self.image_width, MASK_CHANNELS),
+        )
+
+    def __len__(self) -> int:
+        return 0 if self.index is None else len(self.index["samples"])
+
+    def __getitem__(self, idx: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the cached image and mask at the specified index.
+
+        Parameters:
+        - idx (int): Index of the sample.
+
+        Returns:
+        Tuple[np.ndarray, np.ndarray]: Read-only uint8 views of the image (H, W, 3) and the mask (H, W, 1).
+        """
+        # memmapはワーカープロセスごとに開く
+        if self._images is None:
+            self._open()
+        return self._images[idx], self._masks[idx]
+
+    def __getstate__(self) -> dict:
+        # DataLoaderのワーカーへ配列の中身をコピーしないように, memmapは渡さない
+        state = self.__dict__.copy()
+        state["_images"] = None
+        state["_masks"] = None
+        return state
+
+
+def resize_image(image: np.ndarray, image_height: int, image_width: int) -> np.ndarray:
+    """
+    Resize an image the same way as ``alb.Resize`` does.
+
+    Parameters:
+    - image (np.ndarray): Input image.
+    - image_height (int): Height of the resized image.
+    - image_width (int): Width of the resized image.
+
+    Returns:
+    np.ndarray: Resized image.
+    """
+    if image.shape[:2] == (image_height, image_width):
+        return image
+    resized = cv2.resize(
+        image, (image_width, image_height), interpolation=cv2.INTER_LINEAR
+    )
+    if image.ndim == 3 and resized.ndim == 2:
+        resized = np.expand_dims(resized, axis=-1)
+    return resized
+
+
+def mask_to_uint8(mask: np.ndarray) -> np.ndarray:
+    """
+    Quantize a [0, 1] float mask to uint8.
+
+    Parameters:
+    - mask (np.ndarray): Float mask in the range [0, 1].
+
+    Returns:
+    np.ndarray: uint8 mask in the range [0, 255].
+    """
+    return np.clip(np.rint(mask * 255.0), 0, 255).astype(np.uint8)
+
+
+def mask_from_uint8(mask: np.ndarray) -> np.ndarray:
+    """
+    Convert a uint8 mask back to a [0, 1] float32 mask.
+
+    Parameters:
+    - mask (np.ndarray): uint8 mask in the range [0, 255].
+
+    Returns:
+    np.ndarray: float32 mask in the range [0, 1].
+    """
+    return mask.astype(np.float32) * np.float32(1.0 / 255.0)
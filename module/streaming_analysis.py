@@ -0,0 +1,412 @@
+from typing import Dict, List, Sequence, Tuple, Union
+
+import cv2
+import numpy as np
+
+from module import instrumentation, tissue_analysis
+
+PHASES = ("ferrite", "perlite")
+DEFAULT_TILE_SIZE = 1024
+# 行ごとに最小値を取る量, 最大値を取る量
+_MIN_FIELDS = ("min_x", "min_y", "first")
+_MAX_FIELDS = ("max_x", "max_y")
+_FIELDS = ("id",) + _MIN_FIELDS + _MAX_FIELDS
+# GrainStitcher.add_rowが返す粒の量
+_GRAIN_FIELDS = ("bbox_x", "bbox_y", "bbox_w", "bbox_h", "first")
+
+
+def phase_halo(phase: str, expansion: Union[None, int] = None) -> int:
+    """
+    Margin a tile needs around it to reproduce the whole-image preprocessing of a phase.
+
+    Parameters:
+    - phase (str): "ferrite" or "perlite".
+    - expansion (None | int, optional): Closing kernel size of the ferrite analysis. Default is None.
+
+    Returns:
+    int: Reach of the morphology (closing) or the 3 x 3 blur.
+    """
+    if phase == "ferrite":
+        return expansion if isinstance(expansion, int) else 0
+    if phase == "perlite":
+        return 1
+    raise ValueError(f"Unknown phase: {phase}")
+
+
+def phase_image(
+    binary_image: np.ndarray, phase: str, expansion: Union[None, int] = None
+) -> np.ndarray:
+    """
+    Binary image of a phase, with the same preprocessing as tissue_analysis.analyze_phases.
+
+    Parameters:
+    - binary_image (numpy.ndarray): Binary image from tissue_analysis.binarize.
+    - phase (str): "ferrite" (closed with close_ferrite) or "perlite" (separate_perlite).
+    - expansion (None | int, optional): Closing kernel size of the ferrite analysis. Default is None.
+
+    Returns:
+    numpy.ndarray: Binary uint8 image (0 or 255) where the phase is 255.
+    """
+    if phase == "ferrite":
+        return tissue_analysis.close_ferrite(binary_image, expansion)
+    if phase == "perlite":
+        return tissue_analysis.separate_perlite(binary_image)
+    raise ValueError(f"Unknown phase: {phase}")
+
+
+def read_phases(
+    source,
+    top: int,
+    bottom: int,
+    left: int,
+    right: int,
+    expansion: Union[None, int] = None,
+    phases: Tuple[str, ...] = PHASES,
+) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """
+    Binarize a region of a mask and compute its phase images as on the whole mask.
+
+    Parameters:
+    - source (numpy.ndarray | image_source.TiffImageSource): Predicted mask (BGR color format or
+      grayscale). Anything supporting 2D slicing works.
+    - top, bottom, left, right (int): The region in the whole mask.
+    - expansion (None | int, optional): Closing kernel size of the ferrite analysis. Default is None.
+    - phases (Tuple[str, ...]): Phases whose images are computed (default is both).
+
+    Returns:
+    Tuple[numpy.ndarray, Dict[str, numpy.ndarray]]: Binary image of the region and the
+    phase_image of every phase, cropped to the region.
+
+    The region is read with a margin (phase_halo) so that the closing and the blur see the
+    same pixels as on the whole mask.
+    """
+    height, width = source.shape[:2]
+    halo = max((phase_halo(phase, expansion) for phase in phases), default=0)
+    y0, x0 = max(0, top - halo), max(0, left - halo)
+    image = np.asarray(
+        source[y0 : min(height, bottom + halo), x0 : min(width, right + halo)]
+    )
+    binary_image = tissue_analysis.binarize(image)
+    core = (slice(top - y0, bottom - y0), slice(left - x0, right - x0))
+    images = {
+        phase: phase_image(binary_image, phase, expansion)[core] for phase in phases
+    }
+    return binary_image[core], images
+
+
+@instrumentation.timed("analysis.label_tile")
+def label_tile(
+    image: np.ndarray, y0: int, x0: int, width: int
+) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """
+    Label the grains of one tile and locate them.
+
+    Parameters:
+    - image (numpy.ndarray): Phase image (phase_image) of the tile.
+    - y0 (int): Top of the tile in the whole image.
+    - x0 (int): Left of the tile in the whole image.
+    - width (int): Width of the whole image.
+
+    Returns:
+    Tuple[numpy.ndarray, Dict[str, numpy.ndarray]]: int32 labels of the tile (8-connectivity,
+    0 is background) and, for the labels 1 to n, their bounding box and first pixel in raster
+    order (y * width + x), in whole-image coordinates.
+    """
+    count, labels, cc_stats, _ = cv2.connectedComponentsWithStats(
+        np.ascontiguousarray(image), connectivity=8, ltype=cv2.CV_32S
+    )
+    height = labels.shape[0]
+    left = cc_stats[1:, cv2.CC_STAT_LEFT].astype(np.int64)
+    top = cc_stats[1:, cv2.CC_STAT_TOP].astype(np.int64)
+
+    # 各ラベルの最初の画素 = 最上行の最も左の画素
+    on_top = (labels > 0) & (
+        np.arange(height)[:, np.newaxis] == cc_stats[labels, cv2.CC_STAT_TOP]
+    )
+    top_y, top_x = np.nonzero(on_top)
+    top_labels, first_index = np.unique(labels[top_y, top_x], return_index=True)
+    first_x = np.zeros(count - 1, dtype=np.int64)
+    first_x[top_labels - 1] = top_x[first_index]
+
+    stats = {
+        "min_x": left + x0,
+        "min_y": top + y0,
+        "max_x": left + x0 + cc_stats[1:, cv2.CC_STAT_WIDTH] - 1,
+        "max_y": top + y0 + cc_stats[1:, cv2.CC_STAT_HEIGHT] - 1,
+        "first": (top + y0) * width + first_x + x0,
+    }
+    return labels, stats
+
+
+def grain_contours(
+    image: np.ndarray, top: int, left: int, first: int, width: int
+) -> List[np.ndarray]:
+    """
+    Contours of one grain, as cv2.findContours finds them on the whole image.
+
+    Parameters:
+    - image (numpy.ndarray): Phase image cropped to the bounding box of the grain.
+    - top (int): Top of the bounding box in the whole image.
+    - left (int): Left of the bounding box in the whole image.
+    - first (int): First pixel of the grain in raster order (y * width + x).
+    - width (int): Width of the whole image.
+
+    Returns:
+    List[numpy.ndarray]: Outer contour and hole contours of the grain (RETR_TREE,
+    CHAIN_APPROX_SIMPLE) in whole-image coordinates.
+
+    Other grains inside the bounding box are removed first. They are not 8-connected to the
+    grain, so the border following sees the same pixels as on the whole image.
+    """
+    _, labels = cv2.connectedComponents(image, connectivity=8, ltype=cv2.CV_32S)
+    y, x = divmod(first, width)
+    grain = (labels == labels[y - top, x - left]).astype(np.uint8)
+    contours, _ = cv2.findContours(
+        grain, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE, offset=(left, top)
+    )
+    return list(contours)
+
+
+class _UnionFind:
+    def __init__(self) -> None:
+        self.parent: Dict[int, int] = {}
+
+    def find(self, item: int) -> int:
+        parent = self.parent
+        root = item
+        while parent.get(root, root) != root:
+            root = parent[root]
+        while item != root:
+            parent[item], item = root, parent[item]
+        return root
+
+    def union(self, a: int, b: int) -> None:
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            # 小さいIDを代表にする (前の行から続く粒のIDが残る)
+            self.parent[max(a, b)] = min(a, b)
+
+
+def _border_pairs(before: np.ndarray, after: np.ndarray) -> np.ndarray:
+    # 境界の両側の画素で8近傍にあるラベルの組
+    pairs = []
+    for shift in (-1, 0, 1):
+        a = before[max(0, -shift) : len(before) - max(0, shift)]
+        b = after[max(0, shift) : len(after) - max(0, -shift)]
+        touching = (a > 0) & (b > 0)
+        pairs.append(np.stack([a[touching], b[touching]], axis=1))
+    return np.concatenate(pairs)
+
+
+class GrainStitcher:
+    """
+    Merge grains labeled tile by tile into whole-image grains.
+
+    Parameters:
+    - width (int): Width of the whole image.
+
+    Tiles are added one row at a time, left to right (add_row). Labels that touch across a
+    vertical border of the row, or across the border with the previous row, are merged with a
+    union-find over the edge pixels, and their bounding boxes are combined. A grain is complete
+    when it does not reach the bottom edge of the row, so only the bottom edge labels and the
+    grains touching it are kept between rows.
+    """
+
+    def __init__(self, width: int) -> None:
+        self.width = width
+        self._next_id = 1
+        self._bottom = np.zeros(width, dtype=np.int64)
+        self._open = {name: np.zeros(0, dtype=np.int64) for name in _FIELDS}
+
+    def add_row(
+        self,
+        tiles: Sequence[Tuple[int, np.ndarray, Dict[str, np.ndarray]]],
+        last: bool = False,
+    ) -> Dict[str, np.ndarray]:
+        """
+        Add one row of labeled tiles.
+
+        Parameters:
+        - tiles (Sequence[Tuple[int, numpy.ndarray, Dict[str, numpy.ndarray]]]): (x0, labels, stats)
+          of every tile of the row from label_tile, left to right, covering the whole width.
+        - last (bool): This is the bottom row of the image (default is False).
+
+        Returns:
+        Dict[str, numpy.ndarray]: The grains completed by this row.
+        - bbox_x, bbox_y, bbox_w, bbox_h: Bounding box in the whole image.
+        - first: First pixel in raster order (y * width + x).
+        """
+        top = np.zeros(self.width, dtype=np.int64)
+        bottom = np.zeros(self.width, dtype=np.int64)
+        row_start = self._next_id
+        row_stats = []
+        pairs = []
+        previous_right = None
+        for x0, labels, stats in tiles:
+            # タイル内のラベルを画像全体で一意なIDにする
+            ids = labels.astype(np.int64)
+            ids[labels > 0] += self._next_id - 1
+            count = len(stats["first"])
+            row_stats.append(
+                {"id": np.arange(self._next_id, self._next_id + count), **stats}
+            )
+            self._next_id += count
+            top[x0 : x0 + ids.shape[1]] = ids[0]
+            bottom[x0 : x0 + ids.shape[1]] = ids[-1]
+            if previous_right is not None:
+                pairs.append(_border_pairs(previous_right, ids[:, 0]))
+            previous_right = ids[:, -1]
+        pairs.append(_border_pairs(self._bottom, top))
+
+        union_find = _UnionFind()
+        pairs = np.concatenate(pairs)
+        if len(pairs):
+            for a, b in np.unique(pairs, axis=0).tolist():
+                union_find.union(a, b)
+
+        state = {
+            name: np.concatenate([self._open[name]] + [s[name] for s in row_stats])
+            for name in _FIELDS
+        }
+        roots = state["id"].copy()
+        for i in np.flatnonzero(np.isin(roots, list(union_find.parent))):
+            roots[i] = union_find.find(int(roots[i]))
+        merged = _reduce_by(roots, state)
+
+        # 行の下端に届いている粒だけを次の行に持ち越す
+        new_roots = roots[len(self._open["id"]) :]
+        on_bottom = bottom > 0
+        bottom[on_bottom] = new_roots[bottom[on_bottom] - row_start]
+        if last:
+            keep = np.zeros(len(merged["id"]), dtype=bool)
+        else:
+            keep = np.isin(merged["id"], bottom)
+        finished = {name: values[~keep] for name, values in merged.items()}
+        self._open = {name: values[keep] for name, values in merged.items()}
+        self._bottom = bottom
+        return {
+            "bbox_x": finished["min_x"],
+            "bbox_y": finished["min_y"],
+            "bbox_w": finished["max_x"] - finished["min_x"] + 1,
+            "bbox_h": finished["max_y"] - finished["min_y"] + 1,
+            "first": finished["first"],
+        }
+
+
+def _reduce_by(keys: np.ndarray, state: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    if len(sorted_keys) == 0:
+        return {name: values[:0] for name, values in state.items()}
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    merged = {"id": sorted_keys[starts]}
+    for names, reduce in ((_MIN_FIELDS, np.minimum), (_MAX_FIELDS, np.maximum)):
+        for name in names:
+            merged[name] = reduce.reduceat(state[name][order], starts)
+    return merged
+
+
+def analyze_tiles(
+    source,
+    tile_size: int = DEFAULT_TILE_SIZE,
+    expansion: Union[None, int] = None,
+    phases: Tuple[str, ...] = PHASES,
+) -> Dict[str, Union[float, Dict[str, np.ndarray]]]:
+    """
+    Analyze ferrite and perlite grains of a predicted mask tile by tile.
+
+    Parameters:
+    - source (numpy.ndarray | image_source.TiffImageSource): Predicted mask (BGR color format or
+      grayscale). Anything supporting 2D slicing works.
+    - tile_size (int): Size of the tiles (default is DEFAULT_TILE_SIZE).
+    - expansion (None | int, optional): Closing kernel size of the ferrite analysis. Default is None.
+    - phases (Tuple[str, ...]): Phases whose grain statistics are computed (default is both).
+
+    Returns:
+    Dict[str, float | Dict[str, numpy.ndarray]]:
+    - "ferrite" / "perlite": Per-contour statistics (see tissue_analysis.contour_statistics),
+      the same rows as tissue_analysis.analyze_phases in raster order of their first point.
+      Perlite contours smaller than tissue_analysis.MIN_PERLITE_CONTOUR_AREA are removed.
+    - "ferrite_fraction" / "perlite_fraction": Area fractions of the binarized mask (ferrite is white).
+
+    Every tile is read with a margin (read_phases), labeled on its own and stitched by
+    GrainStitcher. When a row of tiles completes a grain, its contours are found on the crop of
+    its bounding box (grain_contours), taken from the current row or read again from source
+    when the grain started in an earlier row. The statistics are identical for every tile size;
+    the memory use is one row of tiles plus the bounding box of the largest grain.
+    """
+    height, width = source.shape[:2]
+    stitchers = {phase: GrainStitcher(width) for phase in phases}
+    measured = {phase: [] for phase in phases}
+    ferrite_pixels = 0
+    for y0 in range(0, height, tile_size):
+        y1 = min(y0 + tile_size, height)
+        rows = {phase: [] for phase in phases}
+        band = {phase: np.zeros((y1 - y0, width), np.uint8) for phase in phases}
+        for x0 in range(0, width, tile_size):
+            x1 = min(x0 + tile_size, width)
+            binary_image, images = read_phases(
+                source, y0, y1, x0, x1, expansion, phases
+            )
+            ferrite_pixels += np.count_nonzero(binary_image)
+            for phase in phases:
+                band[phase][:, x0:x1] = images[phase]
+                labels, stats = label_tile(images[phase], y0, x0, width)
+                rows[phase].append((x0, labels, stats))
+
+        for phase in phases:
+            grains = stitchers[phase].add_row(rows[phase], last=y1 == height)
+            contours = []
+            for x, y, w, h, first in zip(
+                *(grains[name].tolist() for name in _GRAIN_FIELDS)
+            ):
+                if y >= y0:
+                    image = band[phase][y - y0 : y + h - y0, x : x + w]
+                else:
+                    # 前の行から続く粒は外接矩形を読み直す
+                    _, images = read_phases(
+                        source, y, y + h, x, x + w, expansion, (phase,)
+                    )
+                    image = images[phase]
+                contours.extend(grain_contours(image, y, x, first, width))
+            stats = tissue_analysis.contour_statistics(contours)
+            stats["start"] = np.array(
+                [c[0, 0, 1] * width + c[0, 0, 0] for c in contours], dtype=np.int64
+            )
+            measured[phase].append(stats)
+
+    ferrite_fraction = ferrite_pixels / (height * width)
+    result = {
+        "ferrite_fraction": ferrite_fraction,
+        "perlite_fraction": 1.0 - ferrite_fraction,
+    }
+    for phase in phases:
+        stats = {
+            name: np.concatenate([s[name] for s in measured[phase]])
+            for name in tissue_analysis.STATISTIC_NAMES + ("start",)
+        }
+        order = np.argsort(stats.pop("start"), kind="stable")
+        stats = {name: values[order] for name, values in stats.items()}
+        if phase == "perlite":
+            stats = tissue_analysis.filter_contours([], stats)[1]
+        result[phase] = stats
+    return result
+
+
+def analyze_image(
+    mask_image: np.ndarray,
+    expansion: Union[None, int] = None,
+    phases: Tuple[str, ...] = PHASES,
+) -> Dict[str, Union[float, Dict[str, np.ndarray]]]:
+    """
+    Whole-image run of analyze_tiles (a single tile).
+
+    Parameters:
+    - mask_image (numpy.ndarray): Predicted mask. BGR color format or grayscale.
+    - expansion (None | int, optional): Closing kernel size of the ferrite analysis. Default is None.
+    - phases (Tuple[str, ...]): Phases whose grain statistics are computed (default is both).
+
+    Returns:
+    Dict[str, float | Dict[str, numpy.ndarray]]: Same as analyze_tiles.
+    """
+    return analyze_tiles(mask_image, max(mask_image.shape[:2]), expansion, phases)
@@ -0,0 +1,389 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+from torch import nn, Tensor
+
+from module import image_loader, instrumentation, model_runtime
+
+
+def axis_origins(length: int, tile_size: int, stride: int) -> List[int]:
+    """
+    Start positions of the tiles along one axis.
+
+    Parameters:
+    - length (int): Length of the image along the axis.
+    - tile_size (int): Size of a tile.
+    - stride (int): Distance between the starts of neighbouring tiles.
+
+    Returns:
+    List[int]: Tile start positions. The last tile is aligned to the end of the image.
+    """
+    if length <= tile_size:
+        return [0]
+    origins = list(range(0, length - tile_size + 1, stride))
+    if origins[-1] != length - tile_size:
+        origins.append(length - tile_size)
+    return origins
+
+
+def blend_window(tile_size: int, overlap: int, mode: str = "cosine") -> np.ndarray:
+    """
+    1D blending weights of a tile.
+
+    Parameters:
+    - tile_size (int): Size of a tile.
+    - overlap (int): Overlap between neighbouring tiles.
+    - mode (str): "cosine" (raised-cosine ramp over the overlap), "gaussian" or "constant" (default is "cosine").
+
+    Returns:
+    np.ndarray: Strictly positive float32 weights of length tile_size.
+
+    The 2D window is the outer product of this vector with itself.
+    """
+    if mode == "constant" or (mode == "cosine" and overlap == 0):
+        return np.ones(tile_size, dtype=np.float32)
+    if mode == "cosine":
+        window = np.ones(tile_size, dtype=np.float64)
+        ramp = 0.5 - 0.5 * np.cos(np.pi * (np.arange(overlap) + 0.5) / overlap)
+        window[:overlap] = ramp
+        window[tile_size - overlap :] = np.minimum(
+            window[tile_size - overlap :], ramp[::-1]
+        )
+        return window.astype(np.float32)
+    if mode == "gaussian":
+        sigma = tile_size / 8.0
+        position = np.arange(tile_size) - (tile_size - 1) / 2.0
+        window = np.exp(-(position**2) / (2.0 * sigma**2))
+        return np.maximum(window, 1e-3).astype(np.float32)
+    raise ValueError(f"Unknown blend window mode: {mode}")
+
+
+def extract_tile(image: np.ndarray, y: int, x: int, tile_size: int) -> np.ndarray:
+    """
+    Cut one tile out of an image, padding it by reflection at the image border.
+
+    Parameters:
+    - image (np.ndarray): Image (H, W) or (H, W, C). Any array-like supporting 2D slicing works.
+    - y (int): Top of the tile.
+    - x (int): Left of the tile.
+    - tile_size (int): Size of the tile.
+
+    Returns:
+    np.ndarray: RGB uint8 tile (tile_size, tile_size, 3).
+    """
+    tile = np.asarray(image[y : y + tile_size, x : x + tile_size])
+    tile = to_rgb(tile)
+    pad_h = tile_size - tile.shape[0]
+    pad_w = tile_size - tile.shape[1]
+    if pad_h or pad_w:
+        tile = np.pad(tile, ((0, pad_h), (0, pad_w), (0, 0)), mode="symmetric")
+    return tile
+
+
+def to_rgb(image: np.ndarray) -> np.ndarray:
+    """
+    Convert a grayscale, RGBA or RGB image to a 3-channel uint8 image.
+
+    Parameters:
+    - image (np.ndarray): Input image (H, W), (H, W, 1), (H, W, 3) or (H, W, 4).
+
+    Returns:
+    np.ndarray: uint8 image (H, W, 3).
+    """
+    if image.ndim == 2:
+        image = image[:, :, np.newaxis]
+    if image.shape[2] == 1:
+        image = np.repeat(image, 3, axis=2)
+    elif image.shape[2] == 4:
+        image = image[:, :, :3]
+    return image.astype(np.uint8, copy=False)
+
+
+def normalize_tiles(tiles: np.ndarray) -> Tensor:
+    """
+    Apply the same normalization as get_train_transform to a batch of tiles.
+
+    Parameters:
+    - tiles (np.ndarray): uint8 tiles (N, H, W, 3).
+
+    Returns:
+    Tensor: float32 tensor (N, 3, H, W).
+    """
+    mean = np.asarray(image_loader.NORMALIZE_MEAN, dtype=np.float32) * 255.0
+    std = np.asarray(image_loader.NORMALIZE_STD, dtype=np.float32) * 255.0
+    batch = (tiles.astype(np.float32) - mean) / std
+    return torch.from_numpy(np.ascontiguousarray(batch.transpose(0, 3, 1, 2)))
+
+
+@contextmanager
+def torch_threads(num_threads: Optional[int]) -> Iterator[None]:
+    """
+    Temporarily set the number of intra-op threads of torch.
+
+    Parameters:
+    - num_threads (int, optional): Number of threads. None keeps the current setting.
+    """
+    if num_threads is None:
+        yield
+        return
+    previous = torch.get_num_threads()
+    torch.set_num_threads(num_threads)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(previous)
+
+
+def predict_batch(
+    model: nn.Module,
+    batch: Tensor,
+    device: torch.device,
+    precision: str = "float32",
+    channels_last: bool = False,
+) -> np.ndarray:
+    """
+    Run the model on a batch of normalized tiles.
+
+    Parameters:
+    - model (nn.Module): Segmentation model returning probabilities (N, C, H, W).
+    - batch (Tensor): Normalized tiles (N, 3, H, W).
+    - device (torch.device): Device to run the model on.
+    - precision (str): "float32" or "bfloat16" autocast (default is "float32").
+    - channels_last (bool): Feed the batch in channels_last order (default is False).
+
+    Returns:
+    np.ndarray: float32 probabilities of the first output channel (N, H, W).
+    """
+    output = model_runtime.run_model(model, batch, device, precision, channels_last)
+    return output[:, 0].cpu().numpy()
+
+
+def predict_tiled(
+    model: nn.Module,
+    image: np.ndarray,
+    tile_size: int = 256,
+    overlap: int = 32,
+    batch_size: int = 8,
+    num_threads: Optional[int] = None,
+    window: str = "cosine",
+    device: Union[None, str, torch.device] = None,
+    out: Optional[np.ndarray] = None,
+    origins: Optional[Sequence[Tuple[int, int]]] = None,
+    precision: str = "float32",
+    channels_last: bool = False,
+) -> np.ndarray:
+    """
+    Predict a full-resolution probability map with overlapping tiles.
+
+    Parameters:
+    - model (nn.Module): Segmentation model (e.g. machine_learning_model.UNet).
+    - image (np.ndarray): Image (H, W) or (H, W, C) of any size. Any array-like supporting 2D slicing works.
+    - tile_size (int): Size of the tiles fed to the model. Must be a multiple of 16 for UNet (default is 256).
+    - overlap (int): Overlap between neighbouring tiles (default is 32).
+    - batch_size (int): Number of tiles per forward pass (default is 8).
+    - num_threads (int, optional): Number of torch intra-op threads during the call (default is None).
+    - window (str): Blending window, "cosine", "gaussian" or "constant" (default is "cosine").
+    - device (str | torch.device, optional): Device of the model (default is the device of its parameters).
+    - out (np.ndarray, optional): float32 array (H, W) receiving the result, e.g. a np.memmap (default is None).
+    - origins (Sequence[Tuple[int, int]], optional): (y, x) of the tiles to run. Pixels not covered
+      by any tile are left as 0 (default is the full overlapping grid).
+    - precision (str): "float32" or "bfloat16" autocast (default is "float32").
+    - channels_last (bool): Feed the tiles in channels_last order; prepare the model with
+      model_runtime.prepare_model(..., channels_last=True) (default is False).
+
+    Returns:
+    np.ndarray: float32 probability map (H, W).
+
+    Tiles are generated lazily and the next batch is cut out on a background thread while the
+    current one runs through the model, so apart from `out` the memory use only depends on
+    tile_size and batch_size. The full grid is computed by predict_bands.
+    """
+    if not 0 <= overlap < tile_size:
+        raise ValueError(f"overlap must be in [0, {tile_size}), got {overlap}")
+    height, width = image.shape[:2]
+    if out is None:
+        out = np.zeros((height, width), dtype=np.float32)
+
+    if origins is None:
+        for y, band in predict_bands(
+            model,
+            image,
+            tile_size,
+            overlap,
+            batch_size,
+            num_threads,
+            window,
+            device,
+            precision,
+            channels_last,
+        ):
+            out[y : y + band.shape[0]] = band
+        return out
+
+    out[...] = 0.0
+    weights_1d = blend_window(tile_size, overlap, window)
+    weights_2d = np.outer(weights_1d, weights_1d)
+    weight_map = np.zeros((height, width), dtype=np.float32)
+    for y, x, probability in _predict_origins(
+        model,
+        image,
+        list(origins),
+        tile_size,
+        batch_size,
+        num_threads,
+        device,
+        precision,
+        channels_last,
+    ):
+        with instrumentation.timer("inference.blend"):
+            h = min(tile_size, height - y)
+            w = min(tile_size, width - x)
+            out[y : y + h, x : x + w] += probability[:h, :w] * weights_2d[:h, :w]
+            weight_map[y : y + h, x : x + w] += weights_2d[:h, :w]
+    np.divide(out, weight_map, out=out, where=weight_map > 0)
+    return out
+
+
+def predict_bands(
+    model: nn.Module,
+    image: np.ndarray,
+    tile_size: int = 256,
+    overlap: int = 32,
+    batch_size: int = 8,
+    num_threads: Optional[int] = None,
+    window: str = "cosine",
+    device: Union[None, str, torch.device] = None,
+    precision: str = "float32",
+    channels_last: bool = False,
+) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    Predict the probability map of the full overlapping grid as horizontal bands.
+
+    Parameters:
+    - model (nn.Module): Segmentation model (e.g. machine_learning_model.UNet).
+    - image (np.ndarray): Image (H, W) or (H, W, C), e.g. an image_source.TiffImageSource.
+    - tile_size (int): Size of the tiles fed to the model (default is 256).
+    - overlap (int): Overlap between neighbouring tiles (default is 32).
+    - batch_size (int): Number of tiles per forward pass (default is 8).
+    - num_threads (int, optional): Number of torch intra-op threads during the call (default is None).
+    - window (str): Blending window, "cosine", "gaussian" or "constant" (default is "cosine").
+    - device (str | torch.device, optional): Device of the model (default is the device of its parameters).
+    - precision (str): "float32" or "bfloat16" autocast (default is "float32").
+    - channels_last (bool): Feed the tiles in channels_last order (default is False).
+
+    Returns:
+    Iterator[Tuple[int, np.ndarray]]: (y, band) with the final float32 probabilities of rows
+    y to y + len(band), from top to bottom.
+
+    A band is yielded as soon as no later tile overlaps it, so only a (tile_size, W) accumulator
+    is kept and the whole map is never materialized. The values are identical to predict_tiled.
+    """
+    if not 0 <= overlap < tile_size:
+        raise ValueError(f"overlap must be in [0, {tile_size}), got {overlap}")
+    height, width = image.shape[:2]
+    weights_1d = blend_window(tile_size, overlap, window)
+    weights_2d = np.outer(weights_1d, weights_1d)
+
+    stride = tile_size - overlap
+    ys = axis_origins(height, tile_size, stride)
+    xs = axis_origins(width, tile_size, stride)
+    weight_y = axis_weights(height, ys, weights_1d)
+    weight_x = axis_weights(width, xs, weights_1d)
+    origins = [(y, x) for y in ys for x in xs]
+
+    # 行 band_y から tile_size 行分の累積バッファー
+    accumulator = np.zeros((tile_size, width), dtype=np.float32)
+    band_y = 0
+    row = 0
+    for y, x, probability in _predict_origins(
+        model,
+        image,
+        origins,
+        tile_size,
+        batch_size,
+        num_threads,
+        device,
+        precision,
+        channels_last,
+    ):
+        with instrumentation.timer("inference.blend"):
+            h = min(tile_size, height - y)
+            w = min(tile_size, width - x)
+            accumulator[y - band_y : y - band_y + h, x : x + w] += (
+                probability[:h, :w] * weights_2d[:h, :w]
+            )
+        if x != xs[-1]:
+            continue
+
+        # タイル1行が終わったら、以降のタイルと重ならない行を確定して出力する
+        row += 1
+        next_y = ys[row] if row < len(ys) else height
+        done = next_y - band_y
+        band = accumulator[:done] / (
+            weight_y[band_y:next_y, np.newaxis] * weight_x[np.newaxis, :]
+        )
+        yield band_y, band
+        accumulator[: tile_size - done] = accumulator[done:]
+        accumulator[tile_size - done :] = 0.0
+        band_y = next_y
+
+
+def _predict_origins(
+    model: nn.Module,
+    image: np.ndarray,
+    origins: List[Tuple[int, int]],
+    tile_size: int,
+    batch_size: int,
+    num_threads: Optional[int],
+    device: Union[None, str, torch.device],
+    precision: str,
+    channels_last: bool,
+) -> Iterator[Tuple[int, int, np.ndarray]]:
+    if device is None:
+        device = next(model.parameters()).device
+    device = torch.device(device)
+
+    def prepare(chunk: List[Tuple[int, int]]) -> Tensor:
+        with instrumentation.timer("inference.prepare_tiles"):
+            return normalize_tiles(
+                np.stack([extract_tile(image, y, x, tile_size) for y, x in chunk])
+            )
+
+    chunks = [origins[i : i + batch_size] for i in range(0, len(origins), batch_size)]
+    model.eval()
+    with torch_threads(num_threads), ThreadPoolExecutor(max_workers=1) as executor:
+        pending = executor.submit(prepare, chunks[0]) if chunks else None
+        for i, chunk in enumerate(chunks):
+            batch = pending.result()
+            if i + 1 < len(chunks):
+                pending = executor.submit(prepare, chunks[i + 1])
+            with instrumentation.timer("inference.forward"):
+                probabilities = predict_batch(
+                    model, batch, device, precision, channels_last
+                )
+            instrumentation.count("inference.tiles", len(chunk))
+            for (y, x), probability in zip(chunk, probabilities):
+                yield y, x, probability
+
+
+def axis_weights(length: int, origins: List[int], window: np.ndarray) -> np.ndarray:
+    """
+    Sum of the blending weights of the tiles along one axis.
+
+    Parameters:
+    - length (int): Length of the image along the axis.
+    - origins (List[int]): Tile start positions (axis_origins).
+    - window (np.ndarray): 1D blending weights of a tile (blend_window).
+
+    Returns:
+    np.ndarray: float32 weights of length `length`. The 2D weight sum of the full grid is the
+    outer product of the two axes.
+    """
+    weights = np.zeros(length, dtype=np.float32)
+    for origin in origins:
+        size = min(len(window), length - origin)
+        weights[origin : origin + size] += window[:size]
+    return weights
@@ -0,0 +1,249 @@
+from typing import Dict, List, Union
+
+import cv2
+import numpy as np
+
+from module import instrumentation
+from module.tissue_analysis import (
+    binarize,
+    contour_statistics,
+    ferrite_contours,
+    filter_contours,
+    find_contours,
+    separate_perlite,
+)
+
+
+def display_input_label_pre_image(
+    input: np.ndarray, label: np.ndarray, predicted: np.ndarray, name: str
+) -> None:
+    """
+    Display image analysis results.
+
+    Parameters:
+    - input (numpy.ndarray): Input image for analysis (in BGR color format).
+    - label (numpy.ndarray): Label image (in BGR color format).
+    - predicted (numpy.ndarray): Predicted image (in BGR color format).
+    - name (str): Name or identifier related to the image.
+
+    Returns:
+    None
+
+    Display the results of image analysis by arranging the input image, label image, and predicted image side by side.
+    """
+    import matplotlib.pyplot as plt
+
+    gray_label = cv2.cvtColor(label, cv2.COLOR_BGR2GRAY)
+    gray_predicted = cv2.cvtColor(predicted, cv2.COLOR_BGR2GRAY)
+
+    figure, ax = plt.subplots(ncols=3, figsize=(15, 18))
+
+    ax[0].imshow(input)
+    ax[1].imshow(gray_label)
+    ax[2].imshow(gray_predicted)
+    ax[0].set_title(f"Input Image {name}")
+    ax[1].set_title(f"Label Mask {name}")
+    ax[2].set_title(f"Predicted Mask {name}")
+    ax[0].set_axis_off()
+    ax[1].set_axis_off()
+    ax[2].set_axis_off()
+
+    plt.tight_layout()
+    plt.show()
+
+
+def print_statistics(stats: Dict[str, np.ndarray]) -> None:
+    """
+    Print the contour information in the format of exec_ferrite_analysis.
+
+    Parameters:
+    - stats (Dict[str, numpy.ndarray]): Statistics from contour_statistics.
+
+    Returns:
+    None
+    """
+    contour_lengths = stats["perimeter"].tolist()
+    contour_areas = stats["area"].tolist()
+
+    sum_areas = 0
+    for area in contour_areas:
+        sum_areas += area
+
+    print(f"輪郭の個数: {len(contour_areas)}")
+    print(f"各輪郭の周の長さ: {contour_lengths}")
+    print(f"各輪郭の面積: {contour_areas}")
+    print(f"各輪郭の面積(合計): {sum_areas}")
+
+
+@instrumentation.timed("analysis.plot")
+def plot_ferrite_contours(
+    ferrite_image: np.ndarray,
+    contours: List[np.ndarray],
+    stats: Dict[str, np.ndarray],
+    per_contour: bool = True,
+) -> np.ndarray:
+    """
+    Plot the analyzed ferrite contours.
+
+    Parameters:
+    - ferrite_image (numpy.ndarray): Analyzed ferrite image. BGR color format.
+    - contours (List[numpy.ndarray]): Contours from ferrite_contours.
+    - stats (Dict[str, numpy.ndarray]): Statistics of the contours.
+    - per_contour (bool): Also draw one subplot per contour highlighting it (default is True).
+      The cost of this grows quadratically with the number of contours.
+
+    Returns:
+    numpy.ndarray: Result image with the numbered contours.
+    """
+    contour_count = len(contours)
+
+    # 結果を描画
+    result_image = np.zeros_like(ferrite_image)
+    cv2.drawContours(result_image, contours, -1, 255, thickness=cv2.FILLED)
+
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    font_scale = 0.3
+    font_color = (0, 255, 255)  # 青色
+    font_thickness = 1
+
+    num_columns = 5
+    num_rows = (contour_count + num_columns - 1) // num_columns
+
+    if per_contour:
+        import matplotlib.pyplot as plt
+
+        # plt.figure(figsize=(10, 10))
+        plt.figure(figsize=(15, 15))
+
+    for i, contour in enumerate(contours):
+        cX = int(stats["centroid_x"][i])
+        cY = int(stats["centroid_y"][i])
+
+        if per_contour:
+            # 各輪郭を描画（青で塗りつぶす）
+            cv2.drawContours(
+                result_image, [contour], -1, (0, 0, 255), thickness=cv2.FILLED
+            )
+
+            plt.subplot(num_rows, num_columns, i + 1)
+            plt.imshow(result_image)
+            plt.axis("off")
+            plt.title(f"Contour {i+1}")
+
+        # 各輪郭を描画（白色で塗りつぶす）
+        cv2.drawContours(
+            result_image, [contour], -1, (255, 255, 255), thickness=cv2.FILLED
+        )
+        # 番号を輪郭の中心に配置
+        cv2.putText(
+            result_image,
+            str(i + 1),
+            (cX, cY),
+            font,
+            font_scale,
+            font_color,
+            font_thickness,
+        )
+
+    if per_contour:
+        plt.tight_layout()
+        plt.show()
+    return result_image
+
+
+@instrumentation.timed("analysis.plot")
+def plot_perlite_contours(
+    perlite_image: np.ndarray,
+    contours: List[np.ndarray],
+    stats: Dict[str, np.ndarray],
+) -> np.ndarray:
+    """
+    Draw the analyzed perlite contours with their numbers.
+
+    Parameters:
+    - perlite_image (numpy.ndarray): Analyzed perlite image. BGR color format.
+    - contours (List[numpy.ndarray]): Contours from perlite_contours.
+    - stats (Dict[str, numpy.ndarray]): Statistics of the contours.
+
+    Returns:
+    numpy.ndarray: Result image with the numbered contours.
+    """
+    # 結果を描画
+    result_image = np.zeros_like(perlite_image)
+    cv2.drawContours(result_image, contours, -1, 255, thickness=cv2.FILLED)
+
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    font_scale = 0.3
+    font_color = (0, 255, 255)  # 青色
+    font_thickness = 1
+
+    for i in range(len(contours)):
+        # 番号を輪郭の中心に配置
+        cv2.putText(
+            result_image,
+            str(i + 1),
+            (int(stats["centroid_x"][i]), int(stats["centroid_y"][i])),
+            font,
+            font_scale,
+            font_color,
+            font_thickness,
+        )
+    return result_image
+
+
+def exec_ferrite_analysis(
+    ferrite_image: np.ndarray, expansion: Union[None, int] = None
+) -> None:
+    """
+    Execute ferrite image analysis.
+
+    Parameters:
+    - ferrite_image (numpy.ndarray): Ferrite image to be analyzed. BGR color format.
+    - expansion (None | int, optional): Flag specifying whether to perform contour expansion. Default is None. When it's an integer, it represents the size of the kernel.
+
+    Returns:
+    None
+
+    The analysis results are plotted, and contour information is displayed in the console.
+    Use analyze_ferrite to get the numbers without plotting.
+    """
+    if expansion is not None and isinstance(expansion, int):
+        print("exec expansion")
+
+    contours = ferrite_contours(ferrite_image, expansion)
+    stats = contour_statistics(contours)
+    import matplotlib.pyplot as plt
+
+    result_image = plot_ferrite_contours(ferrite_image, contours, stats)
+
+    print_statistics(stats)
+
+    plt.figure(figsize=(12, 12))
+    plt.imshow(result_image)
+    plt.show()
+
+
+def exec_perlite_analysis(perlite_image: np.ndarray) -> None:
+    """
+    Execute perlite image analysis.
+
+    Parameters:
+    - perlite_image (numpy.ndarray): Perlite image to be analyzed. BGR color format.
+
+    Returns:
+    None
+
+    The analysis results are displayed in the console with contour information, and the plotted image is shown.
+    Use analyze_perlite to get the numbers without plotting.
+    """
+    contours, _ = find_contours(separate_perlite(binarize(perlite_image)))
+    contours, stats = filter_contours(contours, contour_statistics(contours))
+    import matplotlib.pyplot as plt
+
+    result_image = plot_perlite_contours(perlite_image, contours, stats)
+
+    print_statistics(stats)
+
+    plt.figure(figsize=(10, 10))
+    plt.imshow(result_image)
+    plt.show()
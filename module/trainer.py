@@ -0,0 +1,523 @@
+import argparse
+import copy
+import os
+import time
+from contextlib import nullcontext
+from typing import Callable, Dict, List, Optional, Union
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch import nn
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, Dataset, DistributedSampler
+
+from config import setting
+from module import (
+    checkpoint_manager,
+    instrumentation,
+    machine_learning_metrics,
+    machine_learning_model,
+    model_runtime,
+)
+
+
+class Trainer:
+    """
+    Training loop of the UNet (same steps as the training cell of app/unet_command.ipynb).
+
+    Parameters:
+    - train_dataset (Dataset): Training samples, e.g. image_loader.LoadDataSet.
+    - valid_dataset (Dataset): Validation samples.
+    - checkpoint_dir (str): Directory of best_model.pth, last_checkpoint.pth and the last epoch checkpoints.
+    - model (nn.Module, optional): Model to train (default is UNet(3, 1)).
+    - criterion (nn.Module, optional): Loss (default is machine_learning_metrics.DiceLoss()).
+    - learning_rate (float): Learning rate of Adam (default is 1e-3).
+    - batch_size (int): Samples per forward pass (default is 10).
+    - accumulation_steps (int): Batches whose gradients are added before each optimizer step,
+      so the effective batch size is batch_size * accumulation_steps (default is 1).
+    - num_workers (int): DataLoader worker processes (default is 0).
+    - prefetch_factor (int): Batches loaded ahead by each worker (default is 2).
+    - pin_memory (bool, optional): Use pinned host memory (default is True on CUDA).
+    - persistent_workers (bool): Keep the workers alive between epochs (default is True).
+    - batch_transform (callable, optional): Applied to every (images, masks) batch after loading,
+      e.g. image_loader.BatchTransform with LoadDataSet(..., uint8=True) (default is None).
+    - device (str | torch.device, optional): Device to train on (default is model_runtime.default_device()).
+    - resume (bool): Continue from last_checkpoint.pth when it exists (default is True).
+    - keep_last (int): Epoch checkpoints kept besides the best one (default is 3).
+    - log (callable): Function receiving the progress messages (default is print).
+    - profiler (instrumentation.StepProfiler, optional): Stepped after every training batch (default is None).
+    - on_epoch_end (callable, optional): Called on rank 0 with the metrics of every epoch,
+      e.g. to write the instrumentation statistics (default is None).
+
+    Call fit(num_epochs) to train. Each epoch reports the loss and IoU of both splits, the
+    training throughput (samples/sec) and the fraction of the epoch spent waiting for data.
+
+    When torch.distributed is initialized (see module.distributed_training), the model is wrapped
+    in DistributedDataParallel, every process reads its own part of the data through a
+    DistributedSampler, the metrics are reduced over all processes and only rank 0 logs and
+    writes checkpoints.
+    """
+
+    def __init__(
+        self,
+        train_dataset: Dataset,
+        valid_dataset: Dataset,
+        checkpoint_dir: str,
+        model: Optional[nn.Module] = None,
+        criterion: Optional[nn.Module] = None,
+        learning_rate: float = 1e-3,
+        batch_size: int = 10,
+        accumulation_steps: int = 1,
+        num_workers: int = 0,
+        prefetch_factor: int = 2,
+        pin_memory: Optional[bool] = None,
+        persistent_workers: bool = True,
+        batch_transform: Optional[Callable] = None,
+        device: Union[None, str, torch.device] = None,
+        resume: bool = True,
+        keep_last: int = 3,
+        log: Callable[[str], None] = print,
+        profiler: Optional[instrumentation.StepProfiler] = None,
+        on_epoch_end: Optional[Callable[[Dict[str, float]], None]] = None,
+    ) -> None:
+        if accumulation_steps < 1:
+            raise ValueError(
+                f"accumulation_steps must be >= 1, got {accumulation_steps}"
+            )
+        self.distributed = dist.is_available() and dist.is_initialized()
+        self.rank = dist.get_rank() if self.distributed else 0
+        self.world_size = dist.get_world_size() if self.distributed else 1
+
+        self.device = torch.device(device or model_runtime.default_device())
+        self.module = (model or machine_learning_model.UNet(3, 1)).to(self.device)
+        self.model = self.module
+        if self.distributed:
+            device_ids = [self.device.index] if self.device.type == "cuda" else None
+            self.model = DistributedDataParallel(self.module, device_ids=device_ids)
+        self.criterion = criterion or machine_learning_metrics.DiceLoss()
+        self.optimizer = torch.optim.Adam(self.module.parameters(), lr=learning_rate)
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoints = None
+        if self.rank == 0:
+            self.checkpoints = checkpoint_manager.CheckpointManager(
+                checkpoint_dir, keep_last
+            )
+        self.accumulation_steps = accumulation_steps
+        self.batch_transform = batch_transform
+        self.valid_transform = _without_flips(batch_transform)
+        # ログはrank 0だけが出す
+        self.log = log if self.rank == 0 else (lambda message: None)
+        self.profiler = profiler
+        self.on_epoch_end = on_epoch_end if self.rank == 0 else None
+
+        if pin_memory is None:
+            pin_memory = self.device.type == "cuda"
+        self.train_loader = self.make_loader(
+            train_dataset,
+            batch_size,
+            True,
+            num_workers,
+            prefetch_factor,
+            pin_memory,
+            persistent_workers,
+        )
+        self.valid_loader = self.make_loader(
+            valid_dataset,
+            batch_size,
+            False,
+            num_workers,
+            prefetch_factor,
+            pin_memory,
+            persistent_workers,
+        )
+
+        self.start_epoch = 0
+        self.valid_loss_min = np.inf
+        self.history: List[Dict[str, float]] = []
+        if resume:
+            self.resume()
+
+    def make_loader(
+        self,
+        dataset: Dataset,
+        batch_size: int,
+        shuffle: bool,
+        num_workers: int,
+        prefetch_factor: int,
+        pin_memory: bool,
+        persistent_workers: bool,
+    ) -> DataLoader:
+        """
+        Build the DataLoader of one split.
+
+        Parameters:
+        - dataset (Dataset): Samples of the split.
+        - batch_size (int): Samples per batch.
+        - shuffle (bool): Shuffle the samples every epoch.
+        - num_workers (int): Worker processes.
+        - prefetch_factor (int): Batches loaded ahead by each worker.
+        - pin_memory (bool): Use pinned host memory.
+        - persistent_workers (bool): Keep the workers alive between epochs.
+
+        Returns:
+        DataLoader: Loader of the split.
+        """
+        options = {}
+        if self.distributed:
+            options["sampler"] = DistributedSampler(dataset, shuffle=shuffle)
+            shuffle = False
+        # prefetch_factor と persistent_workers はワーカーがいるときだけ指定できる
+        if num_workers > 0:
+            options["prefetch_factor"] = prefetch_factor
+            options["persistent_workers"] = persistent_workers
+        return DataLoader(
+            dataset,
+            batch_size=batch_size,
+            shuffle=shuffle,
+            num_workers=num_workers,
+            pin_memory=pin_memory,
+            **options,
+        )
+
+    def checkpoint_path(self, name: str) -> str:
+        """
+        Path of a file in the checkpoint directory.
+
+        Parameters:
+        - name (str): File name (e.g. checkpoint_manager.LAST_CHECKPOINT_FILE).
+
+        Returns:
+        str: Path of the file.
+        """
+        return os.path.join(self.checkpoint_dir, name)
+
+    def resume(self) -> int:
+        """
+        Restore the model, optimizer and history from last_checkpoint.pth if it exists.
+
+        Returns:
+        int: Epoch to start from (0 without a checkpoint).
+        """
+        path = self.checkpoint_path(checkpoint_manager.LAST_CHECKPOINT_FILE)
+        if not os.path.exists(path):
+            return self.start_epoch
+        checkpoint = checkpoint_manager.load_checkpoint(path, self.device, mmap=False)
+        self.module.load_state_dict(checkpoint["state_dict"])
+        self.optimizer.load_state_dict(checkpoint["optimizer"])
+        self.start_epoch = checkpoint["epoch"]
+        self.valid_loss_min = float(checkpoint["valid_loss_min"])
+        self.history = list(checkpoint.get("history", []))
+        self.log(f"Resumed from {path} (epoch {self.start_epoch})")
+        return self.start_epoch
+
+    def state(self, epoch: int) -> Dict:
+        """
+        Checkpoint of the current state (same keys as the notebook, plus input_scale and history).
+
+        Parameters:
+        - epoch (int): Number of finished epochs.
+
+        Returns:
+        Dict: Checkpoint dictionary.
+        """
+        return {
+            "epoch": epoch,
+            "valid_loss_min": self.valid_loss_min,
+            "state_dict": self.module.state_dict(),
+            "optimizer": self.optimizer.state_dict(),
+            "input_scale": getattr(self.module, "input_scale", 255.0),
+            "history": self.history,
+        }
+
+    def save_checkpoint(self, epoch: int, is_best: bool) -> None:
+        """
+        Queue the checkpoint of an epoch for the background writer (rank 0 only).
+        It becomes last_checkpoint.pth and, when the validation loss improved, best_model.pth.
+
+        Parameters:
+        - epoch (int): Number of finished epochs.
+        - is_best (bool): Whether the validation loss is the lowest so far.
+
+        Returns:
+        None
+        """
+        if self.checkpoints is None:
+            return
+        self.checkpoints.save(self.state(epoch), epoch, is_best)
+
+    def _to_device(self, images: torch.Tensor, masks: torch.Tensor, transform):
+        with instrumentation.timer("train.host_to_device"):
+            images = images.to(self.device, non_blocking=True)
+            masks = masks.to(self.device, non_blocking=True)
+        if transform is not None:
+            images, masks = transform(images, masks)
+        return images, masks
+
+    def train_epoch(self, epoch: int = 0) -> Dict[str, float]:
+        """
+        Train for one epoch.
+
+        Parameters:
+        - epoch (int): Index of the epoch, seeding the shuffling of the DistributedSampler (default is 0).
+
+        Returns:
+        Dict[str, float]: train_loss, train_iou, samples_per_second, data_wait_fraction and seconds.
+        """
+        self.model.train()
+        metrics = machine_learning_metrics.MetricAccumulator()
+        self.optimizer.zero_grad(set_to_none=True)
+        n_samples = 0
+        data_wait = 0.0
+        n_batches = len(self.train_loader)
+        sampler = self.train_loader.sampler
+        if isinstance(sampler, DistributedSampler):
+            sampler.set_epoch(epoch)
+
+        start = time.perf_counter()
+        batches = iter(self.train_loader)
+        for i in range(n_batches):
+            wait_start = time.perf_counter()
+            images, masks = next(batches)
+            instrumentation.record("train.fetch", time.perf_counter() - wait_start)
+            images, masks = self._to_device(images, masks, self.batch_transform)
+            data_wait += time.perf_counter() - wait_start
+
+            # 最後のバッチでは端数でも更新する
+            step = (i + 1) % self.accumulation_steps == 0 or i + 1 == n_batches
+            # 端数のグループは実際のバッチ数で割り, 最後の更新を小さくしない
+            group_start = i - i % self.accumulation_steps
+            group_size = min(self.accumulation_steps, n_batches - group_start)
+            # 更新しないバッチでは勾配のall-reduceを省く
+            sync = nullcontext()
+            if self.distributed and not step:
+                sync = self.model.no_sync()
+            with sync:
+                with instrumentation.timer("train.forward"):
+                    output = self.model(images)
+                    loss = self.criterion(output, masks)
+                with instrumentation.timer("train.backward"):
+                    (loss / group_size).backward()
+            if step:
+                with instrumentation.timer("train.optimizer_step"):
+                    self.optimizer.step()
+                    self.optimizer.zero_grad(set_to_none=True)
+
+            with instrumentation.timer("train.metrics"):
+                metrics.update(output, masks, loss)
+            n_samples += images.shape[0]
+            instrumentation.count("train.samples", images.shape[0])
+            if self.profiler is not None:
+                self.profiler.step()
+        result = metrics.compute()
+        seconds = time.perf_counter() - start
+
+        # DistributedSamplerは各プロセスに同じ数のサンプルを割り当てる
+        n_samples *= self.world_size
+        return {
+            "train_loss": result["loss"],
+            "train_iou": result["iou"],
+            "samples_per_second": n_samples / seconds if seconds > 0 else 0.0,
+            "data_wait_fraction": data_wait / seconds if seconds > 0 else 0.0,
+            "seconds": seconds,
+        }
+
+    def validate(self) -> Dict[str, float]:
+        """
+        Evaluate the model on the validation split.
+
+        Returns:
+        Dict[str, float]: valid_loss and valid_iou.
+        """
+        self.model.eval()
+        metrics = machine_learning_metrics.MetricAccumulator()
+        with torch.no_grad():
+            for images, masks in self.valid_loader:
+                images, masks = self._to_device(images, masks, self.valid_transform)
+                with instrumentation.timer("valid.forward"):
+                    output = self.model(images)
+                metrics.update(output, masks, self.criterion(output, masks))
+        result = metrics.compute()
+        return {"valid_loss": result["loss"], "valid_iou": result["iou"]}
+
+    def fit(self, num_epochs: int) -> List[Dict[str, float]]:
+        """
+        Train until num_epochs epochs are finished, saving a checkpoint after every epoch.
+
+        Parameters:
+        - num_epochs (int): Total number of epochs (epochs restored by resume count).
+
+        Returns:
+        List[Dict[str, float]]: Metrics of every epoch.
+        """
+        for epoch in range(self.start_epoch, num_epochs):
+            result = {"epoch": epoch + 1, **self.train_epoch(epoch), **self.validate()}
+            self.history.append(result)
+            self.log(
+                f"Epoch: {epoch + 1}, "
+                f"Train Loss: {result['train_loss']:.6f}, Train IOU: {result['train_iou']:.6f}, "
+                f"Valid Loss: {result['valid_loss']:.6f}, Valid IOU: {result['valid_iou']:.6f}, "
+                f"{result['samples_per_second']:.1f} samples/s, "
+                f"data wait {result['data_wait_fraction']:.1%}"
+            )
+
+            is_best = result["valid_loss"] <= self.valid_loss_min
+            if is_best:
+                self.log(
+                    "Validation loss decreased ({:.6f} --> {:.6f}).  Saving model ...".format(
+                        self.valid_loss_min, result["valid_loss"]
+                    )
+                )
+                self.valid_loss_min = result["valid_loss"]
+            self.save_checkpoint(epoch + 1, is_best)
+            if self.on_epoch_end is not None:
+                self.on_epoch_end(result)
+        if self.checkpoints is not None:
+            self.checkpoints.wait()
+        return self.history
+
+
+def _without_flips(transform: Optional[Callable]) -> Optional[Callable]:
+    # 評価ではフリップしない
+    if transform is None or not hasattr(transform, "horizontal_flip"):
+        return transform
+    transform = copy.copy(transform)
+    transform.horizontal_flip = 0.0
+    transform.vertical_flip = 0.0
+    return transform
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Train the UNet on a LoadDataSet folder."
+    )
+    parser.add_argument(
+        "--data", help="dataset folder (default: train_path of --config)"
+    )
+    parser.add_argument(
+        "--checkpoint-dir", help="default: checkpoint_path/UNet of --config"
+    )
+    parser.add_argument("--epochs", type=int, default=300)
+    parser.add_argument("--image-size", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--accumulation-steps", type=int, default=1)
+    parser.add_argument("--learning-rate", type=float, default=1e-3)
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--prefetch-factor", type=int, default=2)
+    parser.add_argument("--manifest", help="dataset manifest (module.dataset_manifest)")
+    parser.add_argument("--train-split", help="split file of the training samples")
+    parser.add_argument("--valid-split", help="split file of the validation samples")
+    parser.add_argument("--val-ratio", type=float, default=0.25)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--cache-dir", help="decoded sample cache (module.sample_cache)"
+    )
+    parser.add_argument(
+        "--uint8",
+        action="store_true",
+        help="uint8 input pipeline with batched normalization (trains UNet with input_scale=1.0)",
+    )
+    parser.add_argument("--device")
+    parser.add_argument("--no-resume", action="store_true")
+    setting.add_argument(parser)
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args(argv)
+    if (args.train_split is None) != (args.valid_split is None):
+        parser.error("--train-split and --valid-split must be given together")
+    if args.profile_trace and dist.is_available() and dist.is_initialized():
+        # プロセスごとに別のファイルに書き出す
+        root, extension = os.path.splitext(args.profile_trace)
+        args.profile_trace = f"{root}.rank{dist.get_rank()}{extension}"
+    profiler = instrumentation.from_arguments(args)
+
+    from torch.utils.data import random_split
+
+    from module import image_loader
+
+    settings = setting.from_arguments(args)
+    data = args.data or settings.train_path
+    checkpoint_dir = args.checkpoint_dir or settings.unet_checkpoint_dir
+
+    size = args.image_size
+    device = torch.device(args.device or model_runtime.default_device())
+    batch_transform = None
+    if args.uint8:
+        transform = image_loader.get_uint8_transform(size, size)
+        batch_transform = image_loader.BatchTransform(size, size, device=device)
+        model = machine_learning_model.UNet(3, 1, input_scale=1.0)
+    else:
+        transform = image_loader.get_train_transform(size, size)
+        model = machine_learning_model.UNet(3, 1)
+
+    caches = []
+
+    def load(
+        split: Optional[str], name: Optional[str] = None
+    ) -> image_loader.LoadDataSet:
+        dataset = image_loader.LoadDataSet(
+            data,
+            size,
+            size,
+            transform=transform,
+            manifest=args.manifest,
+            split=split,
+            uint8=args.uint8,
+        )
+        if args.cache_dir is not None:
+            # SampleCacheはサンプルの集合が変わると作り直すので, splitごとに別のディレクトリにする
+            cache_dir = args.cache_dir
+            if name is not None:
+                cache_dir = os.path.join(cache_dir, name)
+            caches.append((dataset, cache_dir))
+        return dataset
+
+    if args.train_split is not None and args.valid_split is not None:
+        train_data = load(args.train_split, "train")
+        valid_data = load(args.valid_split, "valid")
+    else:
+        # ノートブックと同じくランダムに分割する (シードは固定)
+        dataset = load(None)
+        valid_size = int(np.round(len(dataset) * args.val_ratio, 0))
+        train_data, valid_data = random_split(
+            dataset,
+            [len(dataset) - valid_size, valid_size],
+            generator=torch.Generator().manual_seed(args.seed),
+        )
+
+    # 分散学習では rank 0 だけがキャッシュを作り, 他のプロセスは完成を待ってから開く
+    # (同じディレクトリのmemmapを同時に作り直すと互いのファイルを切り詰める)
+    distributed = dist.is_available() and dist.is_initialized()
+    rank = dist.get_rank() if distributed else 0
+    if rank == 0:
+        for dataset, cache_dir in caches:
+            dataset.build_cache(cache_dir)
+    if distributed and caches:
+        dist.barrier()
+        if rank != 0:
+            for dataset, cache_dir in caches:
+                dataset.build_cache(cache_dir)
+
+    trainer = Trainer(
+        train_data,
+        valid_data,
+        checkpoint_dir,
+        model=model,
+        learning_rate=args.learning_rate,
+        batch_size=args.batch_size,
+        accumulation_steps=args.accumulation_steps,
+        num_workers=args.workers,
+        prefetch_factor=args.prefetch_factor,
+        batch_transform=batch_transform,
+        device=device,
+        resume=not args.no_resume,
+        profiler=profiler,
+        on_epoch_end=lambda result: instrumentation.write_outputs(
+            args, {"run": "train", "epoch": result["epoch"]}
+        ),
+    )
+    with profiler:
+        trainer.fit(args.epochs)
+
+
+if __name__ == "__main__":
+    main()